@@ -13,7 +13,7 @@ import time
 from multiprocessing import freeze_support
 
 from exporter.config import FileType
-from exporter import HtmlExporter, TxtExporter, AiTxtExporter, DocxExporter, MarkdownExporter, ExcelExporter
+from exporter import HtmlExporter, TxtExporter, AiTxtExporter, DocxExporter, MarkdownExporter, ExcelExporter, ParquetExporter
 from wxManager import DatabaseConnection, MessageType
 
 
@@ -99,7 +99,8 @@ def batch_export_by_fmt():
         FileType.AI_TXT: AiTxtExporter,
         FileType.MARKDOWN: MarkdownExporter,
         FileType.XLSX: ExcelExporter,
-        FileType.DOCX: DocxExporter
+        FileType.DOCX: DocxExporter,
+        FileType.PARQUET: ParquetExporter
     }
     for file_type, exporter in exporters.items():
         execute = exporter(
@@ -5,3 +5,4 @@ from exporter.exporter_html import HtmlExporter
 from exporter.exporter_docx import DocxExporter
 from exporter.exporter_markdown import MarkdownExporter
 from exporter.exporter_xlsx import ExcelExporter
+from exporter.exporter_parquet import ParquetExporter
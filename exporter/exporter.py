@@ -4,19 +4,17 @@ import io
 import os
 import re
 import shutil
-import subprocess
-import sys
 import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Tuple
-
-import pysilk
+from typing import List, Tuple, Iterable, Iterator
 
 from wxManager import MessageType, DataBaseInterface
 from wxManager.model import Contact, Me, Message
 
 from wxManager.log import logger
+from wxManager.parser.util.audio_service import audio_engine
+from wxManager.parser.util.dir_cache import dir_cache
 from exporter.config import FileType
 
 
@@ -130,6 +128,8 @@ class ExporterBase(ExporterBaseBase):
         self.group_members_set = group_members
         self.origin_path = os.path.join(output_dir, '聊天记录', f'{self.contact.remark}({self.contact.wxid})')
         makedirs(self.origin_path)
+        # 解密后的图片缓存，所有联系人、所有导出格式共用，重复导出时直接硬链接不再解密
+        self.media_cache_dir = os.path.join(output_dir, '.cache', 'image')
 
     def print_progress(self, progress):
         logger.info(f'导出进度：{progress * 100:.2f}%')
@@ -166,8 +166,18 @@ class ExporterBase(ExporterBaseBase):
         # 判断该消息是否应该导出
         return self._is_select_by_type(message) and self._is_select_by_contact(message)
 
+    def iter_messages(self, batch_size=1000):
+        """
+        流式读取要导出的聊天记录，不会一次性把所有消息读进内存；同时把消息总数记到self.total_num，用于计算进度
+        @param batch_size: 每次从数据库读取的消息数
+        @return: 按时间顺序排列的消息生成器
+        """
+        self.total_num = max(self.database.get_messages_number(self.contact.wxid, self.time_range), 1)
+        return self.database.iter_messages(self.contact.wxid, time_range=self.time_range, batch_size=batch_size)
+
     def run(self):
         self.export()
+        logger.info(f'图片、视频路径的目录缓存：{dir_cache.get_stats()}')
 
     def export(self):
         return True
@@ -527,89 +537,49 @@ def copy_files(file_tasks: List[Tuple[str, str, str]]):
                 future.result()
 
 
-def get_ffmpeg_path():
-    # 获取打包后的资源目录
-    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-
-    # 构建 FFmpeg 可执行文件的路径
-    ffmpeg_path = os.path.join(resource_dir, 'ffmpeg.exe')
-    if not os.path.exists(ffmpeg_path):
-        ffmpeg_path = os.path.join(resource_dir, 'resources', 'ffmpeg.exe')
-    return ffmpeg_path
+def decode_audio_to_mp3(media_buffer, output_dir, filename):
+    return audio_engine.transcode_to_file(media_buffer, f"{output_dir}/{filename}.mp3")
 
 
-def decode_audio_to_mp3(media_buffer, output_dir, filename):
-    silk_path = f"{output_dir}/{filename}.silk"
-    pcm_path = f"{output_dir}/{filename}.pcm"
-    mp3_path = f"{output_dir}/{filename}.mp3"
-    if os.path.exists(mp3_path):
-        return mp3_path
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-    buf = media_buffer
-    if not buf:
-        return ''
-    with open(silk_path, "wb") as f:
-        f.write(buf)
-    # open(silk_path, "wb").write()
-    try:
-        pcm_buf = pysilk.decode(buf, to_wav=False, sample_rate=44100)
-        with open(pcm_path, 'wb') as f:
-            f.write(pcm_buf)
-        # pysilk.decode_file(open("brainpower.pcm", "rb"), to_wav=False)
-        # 调用系统上的 ffmpeg 可执行文件
-        # 获取 FFmpeg 可执行文件的路径
-        ffmpeg_path = get_ffmpeg_path()
-        # print(ffmpeg_path)
-        # # 调用 FFmpeg
-        if os.path.exists(ffmpeg_path):
-            cmd = f'''"{ffmpeg_path}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-            # system(cmd)
-            # 使用subprocess.run()执行命令
-            subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        else:
-            # 源码运行的时候下面的有效
-            # 这里不知道怎么捕捉异常
-            cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-            # system(cmd)
-            # 使用subprocess.run()执行命令
-            subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # if os.path.exists(silk_path):
-        #     os.remove(silk_path)
-        # if os.path.exists(pcm_path):
-        #     os.remove(pcm_path)
-    except Exception as e:
-        print(f"Error: {e}")
-        logger.error(f'语音错误\n{traceback.format_exc()}')
-        cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-        # system(cmd)
-        # 使用subprocess.run()执行命令
-        subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    finally:
-        return mp3_path
-
-
-def decode_audios(file_tasks: List[Tuple[str, str, str]]):
+def iter_audio_tasks(database: DataBaseInterface, audio_tasks: List[Tuple[int, str, str]], is_open_im=False) \
+        -> Iterator[Tuple[bytes, str, str]]:
     """
-
+    按server_id批量读取语音数据，读出一条交给decode_audios一条
     :param database:
-    :param file_tasks: List[
-        (原始文件路径,
+    :param audio_tasks: List[
+        (语音消息的server_id,
             输出文件夹,
             输出文件名
             )]
-    :return:
+    :param is_open_im: 是否是企业微信
+    :return: (语音数据, 输出文件夹, 输出文件名)
     """
-    if len(file_tasks) < 1:
+    targets = {}
+    for server_id, output_dir, filename in audio_tasks:
+        if os.path.exists(f"{output_dir}/{filename}.mp3"):
+            # 已经导出过的语音不用再读数据库
+            continue
+        targets.setdefault(server_id, []).append((output_dir, filename))
+    if not targets:
         return
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = []
-        for media_buffer, output_dir, dst_name in file_tasks:
-            futures.append(executor.submit(decode_audio_to_mp3, media_buffer, output_dir, dst_name))
+    for server_id, media_buffer in database.iter_media_buffers(list(targets), is_open_im):
+        for output_dir, filename in targets.pop(server_id, []):
+            yield media_buffer, output_dir, filename
+
+
+def decode_audios(file_tasks: Iterable[Tuple[bytes, str, str]]):
+    """
 
-        # 等待所有任务完成
-        for future in futures:
-            future.result()
+    :param database:
+    :param file_tasks: Iterable[
+        (语音数据,
+            输出文件夹,
+            输出文件名
+            )]，可以是生成器，转码进程池忙不过来时暂停读取
+    :return:
+    """
+    audio_engine.transcode_many(file_tasks)
+    logger.info(f'语音转码统计：{audio_engine.get_stats()}')
 
 
 def remove_privacy_info(text):
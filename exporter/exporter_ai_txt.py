@@ -24,8 +24,8 @@ class AiTxtExporter(ExporterBase):
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '_chat.txt')
         filename = get_new_filename(filename)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        messages = self.iter_messages()
+        total_steps = self.total_num
         # 创建一个默认字典，用于按日期分组
         grouped_messages = defaultdict(list)
         # 遍历消息，将其按日期分组
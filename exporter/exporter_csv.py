@@ -29,21 +29,19 @@ class CSVExporter(ExporterBase):
         filename = os.path.join(self.origin_path,f"{self.contact.remark}.csv")
         filename = get_new_filename(filename)
         columns = ['消息ID', '类型', '发送人', '时间', '内容', '备注', '昵称', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        messages = self.iter_messages()
+        total_steps = self.total_num
         # 写入CSV文件
         with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
             writer = csv.writer(file)
             writer.writerow(columns)
             # 写入数据
-            csv_res = []
             for index, message in enumerate(messages):
                 if index and index % 1000 == 0:
                     self.update_progress_callback(index / total_steps)
                 if not self.is_selected(message):
                     continue
-                csv_res.append(self.message_to_list(message))
-            writer.writerows(csv_res)
+                writer.writerow(self.message_to_list(message))
         self.update_progress_callback(1)
         self.finish_callback(self.exporter_id)
         print(f"【完成导出 CSV {self.contact.remark}】")
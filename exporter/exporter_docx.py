@@ -15,7 +15,7 @@ from docx.shared import Pt, Inches
 
 from wxManager import Me, MessageType
 from exporter.exporter import ExporterBase, get_new_filename
-from wxManager.decrypt.decrypt_dat import decode_dat
+from wxManager.decrypt.decrypt_dat import decode_dat_cached
 from wxManager.log import logger
 from wxManager.model import QuoteMessage, LinkMessage
 
@@ -90,11 +90,12 @@ class DocxExporter(ExporterBase):
             content.paragraphs[0].add_run(message.display_name + '\n')
         message.set_file_name()
         image_dir = os.path.join(self.origin_path, 'image')
-        image_path = decode_dat(
+        image_path = decode_dat_cached(
             Me().xor_key,
             os.path.join(Me().wx_dir, message.path),
             os.path.join(image_dir, message.str_time[:7]),
-            message.file_name
+            message.file_name,
+            self.media_cache_dir
         )
         if image_path and os.path.exists(image_path):
             try:
@@ -274,8 +275,8 @@ class DocxExporter(ExporterBase):
     def export(self):
         print(f"【开始导出 DOCX {self.contact.remark}】")
         origin_path = self.origin_path
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        messages = self.iter_messages()
+        total_steps = self.total_num
         self.save_avatars()
 
         def newdoc():
@@ -8,7 +8,7 @@ import time
 from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
 from wxManager.log import logger
 from wxManager.model import MessageType, Me
-from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename
+from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename, iter_audio_tasks
 
 icon_files = {
     'DOCX': ['doc', 'docx'],
@@ -46,7 +46,7 @@ class HtmlExporter(ExporterBase):
         html_head = html_head.replace("{{avatarUrls}}", json.dumps(avatar_urls)).replace('{{wxid}}',
                                                                                          f'"{self.contact.wxid}"')
         f.write(html_head)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = self.iter_messages()
 
         # QMe().save_avatar(self.origin_path + '/avatar/' + Me().wxid + '.png')
         # self.contact.save_avatar(self.origin_path + '/avatar/' + self.contact.wxid + '.png')
@@ -77,7 +77,7 @@ class HtmlExporter(ExporterBase):
         video_dir = os.path.join(self.origin_path, 'video')
         audio_dir = os.path.join(self.origin_path, 'voice')
         file_dir = os.path.join(self.origin_path, 'file')
-        total_steps = len(messages)
+        total_steps = self.total_num
         select_msg_cnt = 0  # 要导出的消息数量
         msg_index = 0
 
@@ -182,7 +182,7 @@ class HtmlExporter(ExporterBase):
                 message.set_file_name()
                 audio_tasks.append(
                     (
-                        self.database.get_media_buffer(message.server_id, self.contact.is_public()),
+                        message.server_id,
                         os.path.join(audio_dir, message.str_time[:7]),
                         message.file_name
                     )
@@ -237,14 +237,14 @@ class HtmlExporter(ExporterBase):
         # print(audio_tasks)
         logger.info('解析图片')
         # 使用多进程，导出所有图片
-        batch_decode_image_multiprocessing(Me().xor_key, image_tasks)
+        batch_decode_image_multiprocessing(Me().xor_key, image_tasks, self.media_cache_dir)
         print('开始复制文件')
         logger.info(f'开始复制{len(video_tasks + file_tasks)}')
         # 使用多线程，复制文件、视频到导出文件夹
         copy_files(video_tasks + file_tasks)
         print('开始导出语音')
         logger.info('开始导出语音')
-        decode_audios(audio_tasks)
+        decode_audios(iter_audio_tasks(self.database, audio_tasks, self.contact.is_public()))
 
         AllIndex = list(range(len(html_json)))
 
@@ -293,5 +293,5 @@ class HtmlExporter(ExporterBase):
             json.dump(html_json, f, ensure_ascii=False, indent=4)
 
         self.update_progress_callback(1)
-        print(f"【完成导出 HTML {self.contact.remark}】{len(messages)}")
+        print(f"【完成导出 HTML {self.contact.remark}】{select_msg_cnt}")
         self.finish_callback(self.exporter_id)
@@ -141,8 +141,8 @@ class MarkdownExporter(ExporterBase):
         origin_path = self.origin_path
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '.md')
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        messages = self.iter_messages()
+        total_steps = self.total_num
         num = 1
         years = set()
         months = set()
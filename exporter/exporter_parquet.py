@@ -0,0 +1,190 @@
+import os
+import re
+import shutil
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from wxManager import Message
+from wxManager.db_v4.message import convert_to_timestamp
+from exporter.exporter import ExporterBase
+
+ROW_GROUP_SIZE = 10000  # 攒够这么多条消息写一个row group
+
+# 所有消息共有的字段：列名 -> (取值函数, 类型)
+BASE_COLUMNS = {
+    'local_id': (lambda message: message.local_id, pa.int64()),
+    'server_id': (lambda message: message.server_id, pa.int64()),
+    'sort_seq': (lambda message: message.sort_seq, pa.int64()),
+    'timestamp': (lambda message: message.timestamp, pa.timestamp('s')),
+    'str_time': (lambda message: message.str_time, pa.string()),
+    'type': (lambda message: message.type, pa.int64()),
+    'type_name': (lambda message: message.type_name(), pa.string()),
+    'talker_id': (lambda message: message.talker_id, pa.string()),
+    'is_sender': (lambda message: bool(message.is_sender), pa.bool_()),
+    'sender_id': (lambda message: message.sender_id, pa.string()),
+    'display_name': (lambda message: message.display_name, pa.string()),
+    'status': (lambda message: message.status, pa.int64()),
+    'content': (lambda message: message.to_text(), pa.string()),
+}
+
+# 各类型消息特有的字段，没有这个字段的消息为null：列名 -> (Message属性名, 类型)
+EXTRA_COLUMNS = {
+    'file_name': ('file_name', pa.string()),  # 文件、图片、视频、语音
+    'file_size': ('file_size', pa.int64()),
+    'file_type': ('file_type', pa.string()),
+    'md5': ('md5', pa.string()),
+    'path': ('path', pa.string()),
+    'duration': ('duration', pa.int64()),  # 语音、视频
+    'audio_text': ('audio_text', pa.string()),
+    'url': ('href', pa.string()),  # 分享链接、音乐、小程序
+    'title': ('title', pa.string()),
+    'description': ('description', pa.string()),
+    'app_name': ('app_name', pa.string()),
+    'fee_desc': ('fee_desc', pa.string()),  # 转账
+    'pay_memo': ('pay_memo', pa.string()),
+    'pay_subtype': ('pay_subtype', pa.int64()),
+    'receiver_username': ('receiver_username', pa.string()),
+    'longitude': ('x', pa.float64()),  # 位置分享
+    'latitude': ('y', pa.float64()),
+    'poiname': ('poiname', pa.string()),
+}
+
+SCHEMA = pa.schema(
+    [(name, type_) for name, (_, type_) in BASE_COLUMNS.items()] +
+    [(name, type_) for name, (_, type_) in EXTRA_COLUMNS.items()] +
+    [('transfer_amount', pa.float64())]  # 从fee_desc里解析出来的金额（元）
+)
+
+
+def _convert(value, type_):
+    # 解析XML得到的数字可能是字符串，转换失败的写null
+    if value is None or value == '':
+        return None
+    try:
+        if pa.types.is_integer(type_):
+            return int(value)
+        if pa.types.is_floating(type_):
+            return float(value)
+        if pa.types.is_string(type_):
+            return str(value)
+    except (TypeError, ValueError):
+        return None
+    return value
+
+
+def parse_amount(fee_desc):
+    """
+    ￥1,000.00 -> 1000.0
+    """
+    if not fee_desc:
+        return None
+    match = re.search(r'\d[\d,]*(\.\d+)?', str(fee_desc))
+    return float(match.group().replace(',', '')) if match else None
+
+
+def message_to_row(message: Message) -> dict:
+    row = {name: _convert(func(message), type_) for name, (func, type_) in BASE_COLUMNS.items()}
+    for name, (attr, type_) in EXTRA_COLUMNS.items():
+        row[name] = _convert(getattr(message, attr, None), type_)
+    row['transfer_amount'] = parse_amount(row['fee_desc'])
+    return row
+
+
+class ParquetExporter(ExporterBase):
+    """
+    导出成Parquet数据集，所有联系人写在同一个目录里，按talker=联系人/month=年-月分区（hive风格），
+    DuckDB、pandas、Spark可以直接把整个目录当一张表查询：
+        duckdb: SELECT * FROM read_parquet('聊天记录/parquet/**/*.parquet', hive_partitioning=true)
+        pandas: pd.read_parquet('聊天记录/parquet')
+    指定了时间范围时只替换之前导出的数据里这段时间内的消息
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dataset_path = os.path.join(os.path.dirname(self.origin_path), 'parquet')
+        self.writer = None
+        self.rows = []
+
+    def _flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=SCHEMA))
+            self.rows = []
+
+    def _open_partition(self, month):
+        self._close_partition()
+        partition_dir = os.path.join(self.dataset_path, f'talker={self.contact.wxid}', f'month={month}')
+        os.makedirs(partition_dir, exist_ok=True)
+        self.writer = pq.ParquetWriter(
+            os.path.join(partition_dir, f'part-{uuid.uuid4().hex}.parquet'), SCHEMA, compression='zstd'
+        )
+
+    def _close_partition(self):
+        if self.writer:
+            self._flush()
+            self.writer.close()
+            self.writer = None
+
+    def _remove_time_range(self, talker_dir):
+        """
+        只导出一段时间时，从之前导出的数据里删掉这段时间内的消息，其他时间的不动
+        """
+        if not os.path.isdir(talker_dir):
+            return
+        start_time, end_time = convert_to_timestamp(self.time_range)
+        start_month = time.strftime('%Y-%m', time.localtime(start_time))
+        end_month = time.strftime('%Y-%m', time.localtime(end_time))
+        for name in os.listdir(talker_dir):
+            month = name.split('=', 1)[-1]
+            if not name.startswith('month=') or not start_month <= month <= end_month:
+                continue
+            partition_dir = os.path.join(talker_dir, name)
+            files = [os.path.join(partition_dir, file) for file in os.listdir(partition_dir) if file.endswith('.parquet')]
+            if not files:
+                continue
+            table = pa.concat_tables([pq.read_table(file) for file in files])
+            # Parquet里秒级时间戳是按毫秒存的，先换回秒
+            timestamps = table['timestamp'].cast(pa.timestamp('s')).cast(pa.int64())
+            # 和数据库查询一致：create_time>start and create_time<end
+            in_range = pc.fill_null(pc.and_(pc.greater(timestamps, start_time), pc.less(timestamps, end_time)), False)
+            kept = table.filter(pc.invert(in_range))
+            if kept.num_rows:
+                pq.write_table(
+                    kept, os.path.join(partition_dir, f'part-{uuid.uuid4().hex}.parquet'),
+                    row_group_size=ROW_GROUP_SIZE, compression='zstd'
+                )
+            for file in files:
+                os.remove(file)
+
+    def export(self):
+        print(f"【开始导出 Parquet {self.contact.remark}】")
+        # 重新导出时替换这个联系人之前导出的数据，其他联系人的不动
+        talker_dir = os.path.join(self.dataset_path, f'talker={self.contact.wxid}')
+        if self.time_range:
+            self._remove_time_range(talker_dir)
+        elif os.path.exists(talker_dir):
+            shutil.rmtree(talker_dir)
+        messages = self.iter_messages()
+        total_steps = self.total_num
+        month = None
+        try:
+            for index, message in enumerate(messages):
+                if index and index % 1000 == 0:
+                    self.update_progress_callback(index / total_steps)
+                if not self.is_selected(message):
+                    continue
+                # 消息按时间顺序读出来，换月份的时候换一个分区文件
+                if message.str_time[:7] != month:
+                    month = message.str_time[:7]
+                    self._open_partition(month)
+                self.rows.append(message_to_row(message))
+                if len(self.rows) >= ROW_GROUP_SIZE:
+                    self._flush()
+        finally:
+            self._close_partition()
+        self.update_progress_callback(1)
+        self.finish_callback(self.exporter_id)
+        print(f"【完成导出 Parquet {self.contact.remark}】")
@@ -21,17 +21,19 @@ class TxtExporter(ExporterBase):
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '.txt')
         filename = get_new_filename(filename)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        txt_res = []
-        for index, message in enumerate(messages):
-            if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
-            if not self.is_selected(message):
-                continue
-            txt_res.append(f'{self.title(message)}\n{message.to_text()}')
+        messages = self.iter_messages()
+        total_steps = self.total_num
         with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            f.write('\n\n'.join(txt_res))
+            first = True
+            for index, message in enumerate(messages):
+                if index and index % 1000 == 0:
+                    self.update_progress_callback(index / total_steps)
+                if not self.is_selected(message):
+                    continue
+                if not first:
+                    f.write('\n\n')
+                f.write(f'{self.title(message)}\n{message.to_text()}')
+                first = False
         self.update_progress_callback(1)
         print(f"【完成导出 TXT {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
@@ -6,7 +6,7 @@ from wxManager import Me, MessageType
 from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
 from wxManager.log import logger
 from wxManager.model import Message
-from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename
+from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename, iter_audio_tasks
 
 from PIL import JpegImagePlugin
 from PIL import ImageFile
@@ -111,14 +111,14 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['消息ID', '类型', '发送人', '时间', '内容', '备注', '昵称', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = self.iter_messages()
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         member_sheet = new_workbook.create_sheet("成员信息", 1)
         self.add_member_info(member_sheet)
         new_sheet.append(columns)
         num = 1
-        total_num = len(messages)
+        total_num = self.total_num
         image_tasks = []
         video_tasks = []
         file_tasks = []
@@ -127,7 +127,7 @@ class ExcelExporter(ExporterBase):
         video_dir = os.path.join(self.origin_path, 'video')
         audio_dir = os.path.join(self.origin_path, 'voice')
         file_dir = os.path.join(self.origin_path, 'file')
-        image_index = {}
+        image_rows = []  # 图片消息所在的行，导出完图片之后再插入，不用再遍历一遍所有消息
 
         def parser_merged(merged_message):
             for msg in merged_message.messages:
@@ -190,7 +190,6 @@ class ExcelExporter(ExporterBase):
             type_ = message.type
             if type_ == MessageType.Image:
                 message.set_file_name()
-                image_index[message.server_id] = self.row
                 image_tasks.append(
                     (
                         os.path.join(Me().wx_dir, message.path),
@@ -207,6 +206,7 @@ class ExcelExporter(ExporterBase):
                 )
                 message.path = f"./image/{message.str_time[:7]}/{message.file_name}"
                 message.thumb_path = f"./image/{message.str_time[:7]}/{message.file_name + '_t'}"
+                image_rows.append((self.row, message.path, message.thumb_path))
             elif type_ == MessageType.File:
                 origin_file_path = os.path.join(Me().wx_dir, message.path)
                 file_tasks.append(
@@ -235,7 +235,7 @@ class ExcelExporter(ExporterBase):
                 message.set_file_name()
                 audio_tasks.append(
                     (
-                        self.database.get_media_buffer(message.server_id),
+                        message.server_id,
                         os.path.join(audio_dir, message.str_time[:7]),
                         message.file_name
                     )
@@ -245,51 +245,47 @@ class ExcelExporter(ExporterBase):
             elif type_ == MessageType.MergedMessages:
                 parser_merged(message)
         # 使用多进程，导出所有图片
-        batch_decode_image_multiprocessing(Me().xor_key, image_tasks)
+        batch_decode_image_multiprocessing(Me().xor_key, image_tasks, self.media_cache_dir)
 
         # 使用多线程，复制文件、视频到导出文件夹
         copy_files(video_tasks + file_tasks)
 
-        decode_audios(audio_tasks)
+        decode_audios(iter_audio_tasks(self.database, audio_tasks))
         if MessageType.Image in self.message_types:
-            for index, message in enumerate(messages):
-                if message.type == MessageType.Image:
-                    if not self.is_selected(message):
-                        continue
-                    row = image_index[message.server_id]
-                    img_path = find_image_with_known_extensions(os.path.join(self.origin_path, message.path))
+            for row, path, thumb_path in image_rows:
+                img_path = find_image_with_known_extensions(os.path.join(self.origin_path, path))
+                if not img_path:
+                    img_path = find_image_with_known_extensions(os.path.join(self.origin_path, thumb_path))
                     if not img_path:
-                        img_path = find_image_with_known_extensions(os.path.join(self.origin_path, message.thumb_path))
-                        if not img_path:
-                            continue
-                    try:
-                        # 打开图片以获取其尺寸
-                        with PILImage.open(img_path) as img:
-                            width, height = img.size
-                        max_height = 500
-                        # 计算缩放比例
-                        scale = min(1.0, max_height / height)
-
-                        # 缩放后的图片尺寸
-                        scaled_width = int(width * scale)
-                        scaled_height = int(height * scale)
-
-                        # 插入图片
-                        img = Image(img_path)
-                        img.width = scaled_width
-                        img.height = scaled_height
-
-                        # 计算单元格的坐标
-                        cell = f"{get_column_letter(5)}{row}"
-
-                        # 将图片添加到工作表
-                        new_sheet.add_image(img, cell)
-
-                        # 设置行高
-                        new_sheet.row_dimensions[row].height = scaled_height * 0.75  # 0.75 是像素到 Excel 单位的转换因子
-                    except:
-                        logger.error(traceback.format_exc())
-                        pass
+                        continue
+                try:
+                    # 打开图片以获取其尺寸
+                    with PILImage.open(img_path) as img:
+                        width, height = img.size
+                    max_height = 500
+                    # 计算缩放比例
+                    scale = min(1.0, max_height / height)
+
+                    # 缩放后的图片尺寸
+                    scaled_width = int(width * scale)
+                    scaled_height = int(height * scale)
+
+                    # 插入图片
+                    img = Image(img_path)
+                    img.width = scaled_width
+                    img.height = scaled_height
+
+                    # 计算单元格的坐标
+                    cell = f"{get_column_letter(5)}{row}"
+
+                    # 将图片添加到工作表
+                    new_sheet.add_image(img, cell)
+
+                    # 设置行高
+                    new_sheet.row_dimensions[row].height = scaled_height * 0.75  # 0.75 是像素到 Excel 单位的转换因子
+                except:
+                    logger.error(traceback.format_exc())
+                    pass
         # 获取列的字母表示（A、B、C...）
         col_letter = get_column_letter(1)
         # 设置整列的单元格格式为文本
@@ -316,11 +312,11 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['日期', '时间', '标题', '描述', '链接', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = self.iter_messages()
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.total_num
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
@@ -358,11 +354,11 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['类型', '收款单位', '日期', '时间', '金额', '付款方式', '收单机构', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = self.iter_messages()
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.total_num
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
@@ -417,11 +413,11 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['类型', '日期', '时间', '金额', '详细信息', '汇总', '备注', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = self.iter_messages()
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.total_num
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
@@ -468,11 +464,11 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['日期', '排名', '步数', '当日冠军', '当日冠军步数', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        messages = self.iter_messages()
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.total_num
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/5/4 10:12
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-test_key_scanner.py
+@Description : 用合成的内存转储测试key_scanner，不需要微信进程
+"""
+import hashlib
+import hmac
+import multiprocessing
+import os
+import struct
+import tempfile
+import unittest
+
+from wxManager.decrypt.decrypt_v4 import IV_SIZE, PAGE_SIZE, RESERVE_SIZE, SALT_SIZE, derive_key_v4
+from wxManager.decrypt import key_scanner
+
+
+def make_first_page(key: bytes) -> bytes:
+    """
+    构造一个能通过HMAC校验的加密数据库第一页，密文部分用随机数据代替即可
+    """
+    salt = os.urandom(SALT_SIZE)
+    _, mac_key = derive_key_v4(key.hex(), salt)
+    body = os.urandom(PAGE_SIZE - SALT_SIZE - RESERVE_SIZE)
+    iv = os.urandom(IV_SIZE)
+    mac = hmac.new(mac_key, body + iv, hashlib.sha512)
+    mac.update(struct.pack('<I', 1))
+    tail = iv + mac.digest()
+    return salt + body + tail + b'\x00' * (RESERVE_SIZE - len(tail))
+
+
+def key_pointer(address: int) -> bytes:
+    """和KEY_POINTER_PATTERN匹配的结构体：指针 + 8字节0 + 长度0x20 + 容量0x2f"""
+    return struct.pack('<QQQQ', address, 0, 0x20, 0x2f)
+
+
+class TestKeyScanner(unittest.TestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+        self.buf = make_first_page(self.key)
+
+    def write_dump(self, keys):
+        """
+        依次放好每个候选密钥，后面跟着指向它们的结构体
+        :return: 转储文件路径
+        """
+        data = bytearray()
+        addresses = []
+        for key in keys:
+            addresses.append(len(data))
+            data += key
+        for address in addresses:
+            data += key_pointer(address)
+        fd, dump_path = tempfile.mkstemp(suffix='.dmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.addCleanup(os.remove, dump_path)
+        return dump_path
+
+    def test_find_planted_key(self):
+        decoys = [os.urandom(32) for _ in range(3)]
+        dump_path = self.write_dump(decoys[:1] + [self.key] + decoys[1:])
+        with key_scanner.MemoryDump(dump_path) as dump:
+            candidates = list(key_scanner.iter_key_candidates(dump))
+        self.assertEqual(candidates, decoys[:1] + [self.key] + decoys[1:])
+        self.assertEqual(key_scanner.scan_dump_for_key(dump_path, self.buf, processes=2), self.key.hex())
+
+    def test_no_key(self):
+        dump_path = self.write_dump([os.urandom(32), b'\x00' * 32])
+        self.assertIsNone(key_scanner.scan_dump_for_key(dump_path, self.buf, processes=1))
+
+    def test_stop_after_found(self):
+        # 找到密钥之后，剩下的候选不再做PBKDF2校验
+        found_event = multiprocessing.Event()
+        key_scanner._init_worker(found_event, self.buf)
+        self.assertIsNone(key_scanner._check_candidate(os.urandom(32)))
+        self.assertFalse(found_event.is_set())
+        self.assertEqual(key_scanner._check_candidate(self.key), self.key)
+        self.assertTrue(found_event.is_set())
+        self.assertIsNone(key_scanner._check_candidate(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/18 20:26
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-benchmark.py
+@Description : 对比普通打开方式和快照模式（immutable + mmap + 大页缓存）下读取聊天记录的耗时，
+               以及微信4.0消息内容的几种zstd解压方式的耗时
+"""
+import time
+
+from wxManager.model.db_model import DataBaseBase
+
+
+def _open_message_db(db_dir, version):
+    if version == 4:
+        from wxManager.db_v4 import MessageDB
+        db = MessageDB('message/message_0.db', is_series=True)
+    else:
+        from wxManager.db_v3.msg import Msg
+        db = Msg('Multi/MSG0.db', is_series=True)
+    db.init_database(db_dir)
+    return db
+
+
+def benchmark_open_modes(db_dir, username, version=4, repeat=3):
+    """
+    分别用普通模式和快照模式读取某个联系人的全部聊天记录
+    :param db_dir: 解密后的数据库文件夹
+    :param username: 联系人wxid
+    :param version: 微信版本，3或4
+    :param repeat: 每种模式重复次数，取最快的一次（第一次通常受系统文件缓存影响）
+    :return: {'normal': 秒, 'snapshot': 秒, 'messages': 消息数, 'speedup': 倍数}
+    """
+    snapshot_mode = DataBaseBase.snapshot_mode
+    result = {}
+    try:
+        for mode, enabled in (('normal', False), ('snapshot', True)):
+            DataBaseBase.snapshot_mode = enabled
+            db = _open_message_db(db_dir, version)
+            timings = []
+            for _ in range(repeat):
+                st = time.perf_counter()
+                messages = db.get_messages_by_username(username)
+                timings.append(time.perf_counter() - st)
+            db.close()
+            result[mode] = min(timings)
+            result['messages'] = len(messages)
+    finally:
+        DataBaseBase.snapshot_mode = snapshot_mode
+    result['speedup'] = result['normal'] / result['snapshot'] if result['snapshot'] else 0
+    return result
+
+
+def benchmark_decompress(db_dir, username, repeat=3):
+    """
+    用某个联系人的真实消息对比zstd解压方式（仅微信4.0）
+    :param db_dir: 解密后的数据库文件夹
+    :param username: 联系人wxid
+    :param repeat: 每种方式重复次数
+    :return: {'new_context': 秒, 'thread_local': 秒, 'batch': 秒, 'count': 条数}
+    """
+    from wxManager.parser.util import zstd_service
+
+    db = _open_message_db(db_dir, 4)
+    blobs = []
+    for messages in db.iter_messages(username):
+        for message in messages:
+            blobs.append(message[12])  # message_content
+            blobs.append(message[13])  # compress_content
+    db.close()
+    return zstd_service.benchmark(blobs, repeat)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) >= 4 and sys.argv[1] == 'zstd':
+        r = benchmark_decompress(sys.argv[2], sys.argv[3])
+        print(f"{r['count']} blobs: new context {r['new_context']:.3f}s, thread local {r['thread_local']:.3f}s, "
+              f"batch {r['batch']:.3f}s")
+        sys.exit(0)
+    if len(sys.argv) < 3:
+        print('usage: python -m wxManager.benchmark <db_dir> <username> [version]\n'
+              '       python -m wxManager.benchmark zstd <db_dir> <username>')
+        sys.exit(1)
+    r = benchmark_open_modes(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 4)
+    print(f"{r['messages']} messages: normal {r['normal']:.3f}s, snapshot {r['snapshot']:.3f}s, {r['speedup']:.2f}x")
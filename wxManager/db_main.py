@@ -13,7 +13,7 @@ from abc import ABC, abstractmethod
 
 import os
 from datetime import date
-from typing import List, Any, Tuple
+from typing import List, Any, Tuple, Iterator
 
 from wxManager import MessageType
 from wxManager.model.contact import Contact
@@ -44,6 +44,21 @@ class DataBaseInterface(ABC):
     ):
         raise ValueError("子类必须实现该方法")
 
+    def iter_messages(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size=1000
+    ):
+        """
+        按时间顺序逐条返回聊天记录，子类应该分批读取数据库，避免一次性加载全部消息
+        @param username_:
+        @param time_range:
+        @param batch_size: 每次从数据库读取的消息数
+        @return: 生成器
+        """
+        yield from self.get_messages(username_, time_range)
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -183,6 +198,15 @@ class DataBaseInterface(ABC):
     def get_media_buffer(self, server_id, is_open_im=False) -> bytes:
         pass
 
+    def iter_media_buffers(self, server_ids, is_open_im=False) -> Iterator[Tuple[int, bytes]]:
+        """
+        批量获取语音数据
+        @param server_ids: 语音消息的server_id列表
+        @param is_open_im: 是否是企业微信
+        @return: (server_id, 语音数据)，顺序和输入不一致，找不到的不返回
+        """
+        raise ValueError("子类必须实现该方法")
+
     def get_audio_path(self, reserved0, output_path, filename=''):
         raise ValueError("子类必须实现该方法")
 
@@ -18,6 +18,8 @@ from wxManager.model.db_model import DataBaseBase
 
 
 class Audio2TextDB(DataBaseBase):
+    writable = True  # 语音转文字的结果写在这里，不使用快照模式
+
     def create(self):
         sql = '''
         CREATE TABLE IF NOT EXISTS Audio2Text (
@@ -34,7 +36,7 @@ class Audio2TextDB(DataBaseBase):
 
     def get_audio_text(self, server_id):
         sql = '''select text from Audio2Text where msgSvrId=?'''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [server_id])
         result = cursor.fetchone()
         if result:
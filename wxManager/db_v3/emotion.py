@@ -44,7 +44,7 @@ class Emotion(DataBaseBase):
                 from CustomEmotion
                 where md5 = ?
             """
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5])
             return cursor.fetchone()[0]
@@ -79,7 +79,7 @@ class Emotion(DataBaseBase):
                 from CustomEmotion
                 where md5 = ?
             """
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5])
             return cursor.fetchone()[0]
@@ -92,7 +92,7 @@ class Emotion(DataBaseBase):
         from EmotionDes1
         where MD5=? or MD5=?
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5, md5.upper()])
             result = cursor.fetchone()
@@ -108,7 +108,7 @@ class Emotion(DataBaseBase):
                 from EmotionItem
                 where MD5=? or MD5=?
                 '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5, md5.upper()])
             result = cursor.fetchone()
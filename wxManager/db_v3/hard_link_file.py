@@ -57,7 +57,7 @@ class HardLinkFile(DataBaseBase):
             join HardLinkFileID as HardLinkFileID2 on HardLinkFileAttribute.DirID2 = HardLinkFileID2.DirID
             where MD5 = ?;
             """
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5])
         except sqlite3.OperationalError:
@@ -63,7 +63,7 @@ class HardLinkImage(DataBaseBase):
             join HardLinkImageID as HardLinkImageID2 on HardLinkImageAttribute.DirID2 = HardLinkImageID2.DirID
             where MD5 = ?;
         """
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5])
         except AttributeError:
@@ -58,7 +58,7 @@ class HardLinkVideo(DataBaseBase):
             join HardLinkVideoID as HardLinkVideoID2 on HardLinkVideoAttribute.DirID2 = HardLinkVideoID2.DirID
             where MD5 = ?;
             """
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         try:
             cursor.execute(sql, [md5])
         except sqlite3.OperationalError:
@@ -1,26 +1,18 @@
 import os.path
 import shutil
-import subprocess
-import sys
 import traceback
 import sqlite3
 import base64
+from typing import Iterable, Iterator, Tuple
 
 import xml.etree.ElementTree as ET
 
 from wxManager.merge import increase_data
 from wxManager.log import logger
 from wxManager.model import DataBaseBase
+from wxManager.parser.util.audio_service import audio_engine, silk_to_pcm
 
-
-def get_ffmpeg_path():
-    # 获取打包后的资源目录
-    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-
-    # 构建 FFmpeg 可执行文件的路径
-    ffmpeg_path = os.path.join(resource_dir, 'app', 'resources', 'data', 'ffmpeg.exe')
-
-    return ffmpeg_path
+MAX_SQL_VARIABLES = 900  # SQLite一条语句默认最多999个参数
 
 
 class MediaMsg(DataBaseBase):
@@ -32,59 +24,50 @@ class MediaMsg(DataBaseBase):
             from Media
             where Reserved0 = ?
         '''
-        for db in self.DB:
-            cursor = db.cursor()
+        for pool in self.pool:
+            cursor = pool.cursor()
             cursor.execute(sql, [reserved0])
             result = cursor.fetchone()
             if result:
                 return result[0]
         return None
 
+    def iter_media_buffers(self, reserved0s: Iterable[int]) -> Iterator[Tuple[int, bytes]]:
+        """
+        批量获取语音数据，每个分库每批只查询一次，查到一条返回一条
+        @param reserved0s: 语音消息的MsgSvrID
+        @return: (reserved0, 语音数据)，顺序和输入不一致，找不到的不返回
+        """
+        pending = set(reserved0s)
+        for pool in self.pool:
+            if not pending:
+                break
+            cursor = pool.cursor()
+            ids = list(pending)
+            for i in range(0, len(ids), MAX_SQL_VARIABLES):
+                batch = ids[i:i + MAX_SQL_VARIABLES]
+                sql = f'''
+                    select Reserved0, Buf
+                    from Media
+                    where Reserved0 in ({','.join('?' * len(batch))})
+                '''
+                cursor.execute(sql, batch)
+                for reserved0, buf in cursor:
+                    if reserved0 in pending:
+                        pending.discard(reserved0)
+                        yield reserved0, buf
+            cursor.close()
+
     def get_audio(self, reserved0, output_path, filename=''):
         if not filename:
             filename = reserved0
-        silk_path = f"{output_path}/{filename}.silk"
-        pcm_path = f"{output_path}/{filename}.pcm"
         mp3_path = f"{output_path}/{filename}.mp3"
         if os.path.exists(mp3_path):
             return mp3_path
         buf = self.get_media_buffer(reserved0)
         if not buf:
             return ''
-        with open(silk_path, "wb") as f:
-            f.write(buf)
-        # open(silk_path, "wb").write()
-        try:
-            decode(silk_path, pcm_path, 44100)
-            # 调用系统上的 ffmpeg 可执行文件
-            # 获取 FFmpeg 可执行文件的路径
-            ffmpeg_path = get_ffmpeg_path()
-            # # 调用 FFmpeg
-            if os.path.exists(ffmpeg_path):
-                cmd = f'''"{ffmpeg_path}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-                # system(cmd)
-                # 使用subprocess.run()执行命令
-                subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            else:
-                # 源码运行的时候下面的有效
-                # 这里不知道怎么捕捉异常
-                cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-                # system(cmd)
-                # 使用subprocess.run()执行命令
-                subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if os.path.exists(silk_path):
-                os.remove(silk_path)
-            if os.path.exists(pcm_path):
-                os.remove(pcm_path)
-        except Exception as e:
-            print(f"Error: {e}")
-            logger.error(f'语音发送错误\n{traceback.format_exc()}')
-            cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-            # system(cmd)
-            # 使用subprocess.run()执行命令
-            subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        finally:
-            return mp3_path
+        return audio_engine.transcode_to_file(buf, mp3_path)
 
     def get_audio_path(self, reserved0, output_path, filename=''):
         if not filename:
@@ -105,20 +88,10 @@ class MediaMsg(DataBaseBase):
         buf = self.get_media_buffer(reserved0, open_im)
         if not buf:
             return ''
-        if not filename:
-            filename = reserved0
-        silk_path = f"{output_path}/{filename}.silk"
-        pcm_path = f"{output_path}/{filename}.pcm"
-        with open(silk_path, "wb") as f:
-            f.write(buf)
-        decode(silk_path, pcm_path, 16000)
-        speech_data = []
-        with open(pcm_path, 'rb') as speech_file:
-            speech_data = speech_file.read()
+        speech_data = silk_to_pcm(buf, 16000)
         length = len(speech_data)
         if length == 0:
-            logger.error('file %s length read 0 bytes' % pcm_path)
-            pass
+            logger.error(f'{reserved0} 语音解码失败')
         speech = base64.b64encode(speech_data).decode('utf-8')
         params = {'dev_pid': DEV_PID,
                   'format': 'pcm',
@@ -130,8 +103,6 @@ class MediaMsg(DataBaseBase):
                   'len': length
                   }
         try:
-            os.remove(silk_path)
-            os.remove(pcm_path)
             resp = requests.post(ASR_URL, json=params)
             if resp.status_code == 200:
                 result_dict = resp.json()
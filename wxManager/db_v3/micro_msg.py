@@ -30,6 +30,7 @@ def is_database_exist():
 
 
 class MicroMsg(DataBaseBase):
+    writable = True  # 会修改联系人备注，不使用快照模式
 
     def get_label_by_id(self, label_id) -> str:
         sql = '''
@@ -37,7 +38,7 @@ class MicroMsg(DataBaseBase):
             where LabelId = ?
         '''
         try:
-            cursor = self.DB.cursor()
+            cursor = self.pool.cursor()
             cursor.execute(sql, [label_id])
             result = cursor.fetchone()
             if result:
@@ -66,7 +67,7 @@ class MicroMsg(DataBaseBase):
                             ELSE RemarkQuanPin
                         END ASC
                   '''
-            cursor = self.DB.cursor()
+            cursor = self.pool.cursor()
             cursor.execute(sql)
             result = cursor.fetchall()
         except sqlite3.OperationalError:
@@ -76,10 +77,45 @@ class MicroMsg(DataBaseBase):
             FROM Contact INNER 
             JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName WHERE (Type!=4 AND Type!=0) 
             AND NickName != '' ORDER BY CASE WHEN RemarkQuanPin = '' THEN QuanPin ELSE RemarkQuanPin END ASC'''
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
+            cursor = self.pool.cursor()
+            cursor.execute(sql)
+            result = cursor.fetchall()
         return result
 
+    def get_all_contacts(self) -> list:
+        """
+        一次性读出整张Contact表（包括陌生人、群成员），字段和get_contact_by_username一致，标签id已经换成标签名
+        """
+        if not self.open_flag:
+            return []
+        cursor = self.pool.cursor()
+        try:
+            cursor.execute('SELECT LabelId, LabelName FROM ContactLabel')
+            labels = {str(label_id): label_name for label_id, label_name in cursor.fetchall()}
+        except sqlite3.OperationalError:
+            labels = {}
+        try:
+            sql = '''
+                   SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,LabelIDList
+                   FROM Contact
+                   INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                '''
+            cursor.execute(sql)
+            result = cursor.fetchall()
+        except sqlite3.OperationalError:
+            # 解决ContactLabel表不存在的问题
+            sql = '''
+               SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,""
+               FROM Contact
+               INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+            '''
+            cursor.execute(sql)
+            result = cursor.fetchall()
+        return [
+            [*row[:-1], ','.join(labels.get(label_id, '') for label_id in row[-1].strip(',').split(',')) if row[-1] else '']
+            for row in result
+        ]
+
     def get_contact_by_username(self, username) -> list:
         if not self.open_flag:
             return []
@@ -90,7 +126,7 @@ class MicroMsg(DataBaseBase):
                    INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
                    WHERE UserName = ?
                 '''
-            cursor = self.DB.cursor()
+            cursor = self.pool.cursor()
             cursor.execute(sql, [username])
             result1 = cursor.fetchone()
         except sqlite3.OperationalError:
@@ -102,8 +138,9 @@ class MicroMsg(DataBaseBase):
                INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
                WHERE UserName = ?
             '''
-            self.cursor.execute(sql, [username])
-            result1 = self.cursor.fetchone()
+            cursor = self.pool.cursor()
+            cursor.execute(sql, [username])
+            result1 = cursor.fetchone()
         if result1:
             result = [*result1[:-1], self.get_labels(result1[-1])]
             return result
@@ -134,7 +171,7 @@ class MicroMsg(DataBaseBase):
         if not self.open_flag:
             return None
         sql = '''SELECT ChatRoomName, RoomData,UserNameList,DisplayNameList FROM ChatRoom WHERE ChatRoomName = ?'''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [chatroomname])
         result = cursor.fetchone()
         return result
@@ -168,7 +205,7 @@ class MicroMsg(DataBaseBase):
         SELECT strUsrName, nOrder,nUnreadCount,strNickName ,nIsSend,strContent,nMsgType,nTime,strftime('%Y/%m/%d', nTime, 'unixepoch','localtime') AS strTime
         FROM Session
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql)
         result = cursor.fetchall()
         if result:
@@ -14,6 +14,7 @@ from wxManager.model import DataBaseBase
 
 
 class Misc(DataBaseBase):
+    writable = True  # 会写入新的头像，不使用快照模式
 
     def get_avatar_buffer(self, username):
         if not self.open_flag:
@@ -23,7 +24,7 @@ class Misc(DataBaseBase):
             from ContactHeadImg1
             where usrName=?;
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [username])
         result = cursor.fetchall()
         cursor.close()
@@ -5,7 +5,6 @@ import traceback
 import concurrent
 import hashlib
 import threading
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 from typing import Tuple
 
@@ -13,6 +12,9 @@ from wxManager import MessageType
 from wxManager.merge import increase_data, increase_update_data
 from wxManager.log import logger
 from wxManager.model import DataBaseBase
+from wxManager.model.shard_cursor import MAX_SORT_KEY, MIN_SORT_KEY, ShardCursor, ShardCursorCache
+
+lock = threading.Lock()  # 写入语音转文字结果
 
 
 def convert_to_timestamp_(time_input) -> int:
@@ -89,6 +91,9 @@ def get_local_type(type_: MessageType):
 
 
 class Msg(DataBaseBase):
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.message_cursors = ShardCursorCache()  # 聊天界面向上翻页用的游标
 
     def _get_messages_by_num(self, cursor, username_, start_sort_seq, msg_num):
         sql = '''
@@ -105,30 +110,155 @@ class Msg(DataBaseBase):
         else:
             return []
 
+    def _get_messages_before(self, cursor, username_, position, msg_num):
+        """
+        按(CreateTime, localId)倒序取position之前的msg_num条消息，同一秒内的多条消息也不会在翻页时丢失
+        """
+        create_time, local_id = position
+        sql = '''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+            from MSG
+            where StrTalker = ? and (CreateTime < ? or (CreateTime = ? and localId < ?))
+            order by CreateTime desc, localId desc
+            limit ?
+        '''
+        cursor.execute(sql, [username_, create_time, create_time, local_id, msg_num])
+        return cursor.fetchall()
+
+    def get_messages_cursor(self, username, start_sort_seq=MAX_SORT_KEY) -> ShardCursor:
+        """
+        跨分库按CreateTime倒序翻页的游标
+        @param username:
+        @param start_sort_seq: 从CreateTime小于start_sort_seq的消息开始
+        @return: ShardCursor，调用next_page(msg_num)获取下一页
+        """
+        return ShardCursor(
+            self.pool,
+            lambda cursor, position, limit: self._get_messages_before(cursor, username, position, limit),
+            key=lambda message: (message[5], message[0]),
+            position=(start_sort_seq, 0)
+        )
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = []
-        # for db in self.DB:
-        #     cursor = db.cursor()
-        #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-        lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
+        # 接着上一页继续翻的时候复用游标，各分库的读取位置和没用完的数据都保留在游标里
+        cursor = self.message_cursors.get(
+            username, start_sort_seq, lambda: self.get_messages_cursor(username, start_sort_seq)
+        )
+        return [cursor.next_page(msg_num)]
 
-        def task(db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
-            cursor = db.cursor()
-            try:
-                data = self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-                with lock:  # 确保对 results 的操作是线程安全的
-                    results.append(data)
-            finally:
-                cursor.close()
+    def _get_messages_after(self, cursor, username_, position, limit, start_time=0, end_time=0):
+        create_time, local_id = position
+        sql = f'''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+            from MSG
+            where StrTalker = ? and (CreateTime > ? or (CreateTime = ? and localId > ?))
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if end_time else ''}
+            order by CreateTime, localId
+            limit ?
+        '''
+        cursor.execute(sql, [username_, create_time, create_time, local_id, limit])
+        return cursor.fetchall()
 
-        # 使用线程池
-        with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
-        self.commit()
-        return results
+    def iter_messages(self, username: str,
+                      time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                      batch_size=1000):
+        """
+        按(CreateTime, localId)顺序分批返回聊天记录，各分库的结果归并之后再分批，内存里最多只有每个分库一批数据
+        @param username:
+        @param time_range:
+        @param batch_size: 每批的消息数
+        @return: 生成器，每次返回一批原始消息
+        """
+        start_time, end_time = convert_to_timestamp(time_range)
+        cursor = ShardCursor(
+            self.pool,
+            lambda cursor_, position, limit: self._get_messages_after(
+                cursor_, username, position, limit, start_time, end_time
+            ),
+            key=lambda message: (message[5], message[0]),
+            position=(MIN_SORT_KEY, MIN_SORT_KEY),
+            descending=False
+        )
+        while True:
+            messages = cursor.next_page(batch_size)
+            if not messages:
+                break
+            yield messages
+
+    def iter_shard_messages(self, username: str, file_name, batch_size=1000):
+        """
+        按(CreateTime, localId)顺序分批返回某一个分库里的聊天记录
+        @param username:
+        @param file_name: 分库文件名
+        @param batch_size: 每批的消息数
+        @return: 生成器，每次返回一批原始消息
+        """
+        if file_name not in self.db_file_name:
+            return
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        position = (MIN_SORT_KEY, MIN_SORT_KEY)
+        while True:
+            messages = self._get_messages_after(cursor, username, position, batch_size)
+            if not messages:
+                break
+            yield messages
+            position = (messages[-1][5], messages[-1][0])
+
+    def get_cache_watermarks(self, username) -> dict:
+        """
+        解析结果缓存的失效依据
+        @param username:
+        @return: {分库文件名: (最大localId, 分库文件修改时间)}
+        """
+        result = {}
+        for index, pool in enumerate(self.pool):
+            cursor = pool.cursor()
+            cursor.execute('SELECT max(localId) FROM MSG WHERE StrTalker=?', [username])
+            max_local_id = cursor.fetchone()[0]
+            if max_local_id:
+                result[self.db_file_name[index]] = (max_local_id, os.path.getmtime(self.db_path[index]))
+        return result
+
+    def get_cache_checksum(self, username, file_name, max_local_id) -> tuple:
+        """
+        localId不超过max_local_id的消息的行数和类型、状态之和，删除、撤回消息之后会变化
+        """
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(
+            'SELECT count(*), total(Type), total(Status) FROM MSG WHERE StrTalker=? AND localId<=?',
+            [username, max_local_id]
+        )
+        return tuple(cursor.fetchone())
+
+    def get_messages_by_local_id(self, username: str, file_name, start_local_id, end_local_id):
+        """
+        @return: 某个分库里localId在(start_local_id, end_local_id]之间的原始消息
+        """
+        if file_name not in self.db_file_name:
+            return []
+        sql = '''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+            from MSG
+            where StrTalker=? and localId>? and localId<=?
+            order by CreateTime
+        '''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [username, start_local_id, end_local_id])
+        return cursor.fetchall()
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None, ) -> int:
+        start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            select count(*) from MSG
+            where StrTalker = ? {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if end_time else ''}
+        '''
+        num = 0
+        for pool in self.pool:
+            cursor = pool.cursor()
+            cursor.execute(sql, [username])
+            num += cursor.fetchone()[0]
+        return num
 
     def _get_messages_by_username(self, cursor, username: str,
                                   time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
@@ -153,8 +283,8 @@ class Msg(DataBaseBase):
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range)
-                for db in self.DB
+                executor.submit(self._with_cursor, pool, self._get_messages_by_username, username, time_range)
+                for pool in self.pool
             ]
 
             # 等待所有任务完成，并获取结果
@@ -179,8 +309,8 @@ class Msg(DataBaseBase):
     from MSG
     where MsgSvrID=?
 '''
-        for db in self.DB:
-            cursor = db.cursor()
+        for pool in self.pool:
+            cursor = pool.cursor()
             cursor.execute(sql, [server_id])
             result = cursor.fetchone()
             if result:
@@ -205,8 +335,8 @@ class Msg(DataBaseBase):
 
     def get_messages_calendar(self, username):
         res = []
-        for db in self.DB:
-            r1 = self._get_messages_calendar(db.cursor(), username)
+        for pool in self.pool:
+            r1 = self._get_messages_calendar(pool.cursor(), username)
             if r1:
                 res.extend(r1)
         res.sort()
@@ -236,8 +366,8 @@ class Msg(DataBaseBase):
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range)
-                for db in self.DB
+                executor.submit(self._with_cursor, pool, self._get_messages_by_type, username, type_, time_range)
+                for pool in self.pool
             ]
 
             # 等待所有任务完成，并获取结果
@@ -257,18 +387,32 @@ class Msg(DataBaseBase):
                 '''
         sql_update = f'''
                     UPDATE MSG SET StrContent = ? WHERE MsgSvrID = ?'''
-        try:
-            lock.acquire(True)
-            self.cursor.execute(sql_xml, [MsgSvrID_])
-            strContent = self.cursor.fetchone()[0]
-            insert_position = strContent.find('</msg>')
-            new_strContent = strContent[:insert_position] + voicetrans_tag + strContent[insert_position:]
-            self.cursor.execute(sql_update, [new_strContent, MsgSvrID_])
-            self.DB.commit()
-        except sqlite3.DatabaseError:
-            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
-        finally:
-            lock.release()
+        if not self.open_flag:
+            return
+        # self.DB在快照模式下是只读的，写入时单独打开可写连接
+        for db_path in self.db_path:
+            db = self.connect_writable(db_path)
+            if db is None:
+                logger.warning('直接读取加密数据库时不能写入语音转文字结果')
+                return
+            try:
+                with lock:
+                    cursor = db.cursor()
+                    cursor.execute(sql_xml, [MsgSvrID_])
+                    result = cursor.fetchone()
+                    if not result:
+                        continue
+                    strContent = result[0]
+                    insert_position = strContent.find('</msg>')
+                    new_strContent = strContent[:insert_position] + voicetrans_tag + strContent[insert_position:]
+                    cursor.execute(sql_update, [new_strContent, MsgSvrID_])
+                    db.commit()
+                return
+            except sqlite3.DatabaseError:
+                logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+                return
+            finally:
+                db.close()
 
     def merge(self, db_file_name):
         def task_(db_path, cursor, db):
@@ -298,4 +442,5 @@ class Msg(DataBaseBase):
         # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
         #     executor.map(lambda args: task_(*args), tasks)
         self.commit()
+        self.message_cursors.clear()
         print(len(tasks))
@@ -10,6 +10,8 @@ from wxManager.model import DataBaseBase
 
 
 class OpenIMContactDB(DataBaseBase):
+    writable = True  # 会修改联系人备注，不使用快照模式
+
     def get_contacts(self):
         result = []
         if not self.open_flag:
@@ -19,7 +21,7 @@ class OpenIMContactDB(DataBaseBase):
                     FROM OpenIMContact
                     WHERE Type!=0 AND Type!=4
                   '''
-            cursor = self.DB.cursor()
+            cursor = self.pool.cursor()
             cursor.execute(sql)
             result = cursor.fetchall()
             self.commit()  # 提交更改
@@ -35,6 +37,31 @@ class OpenIMContactDB(DataBaseBase):
                     res.append((*contact, ''))
         return res
 
+    def get_all_contacts(self):
+        """
+        一次性读出整张OpenIMContact表，字段和get_contact_by_username一致
+        """
+        result = []
+        if not self.open_flag:
+            return result
+        try:
+            sql = '''SELECT UserName,NickName,Type,Remark,BigHeadImgUrl,SmallHeadImgUrl,Source,NickNamePYInit,NickNameQuanPin,RemarkPYInit,RemarkQuanPin,CustomInfoDetail,DescWordingId
+                    FROM OpenIMContact
+                  '''
+            cursor = self.pool.cursor()
+            cursor.execute(sql)
+            result = cursor.fetchall()
+        except sqlite3.OperationalError:
+            logger.error(f'数据库错误:\n{traceback.format_exc()}')
+        wordings = {}
+        res = []
+        for contact in result:
+            if contact[12] not in wordings:
+                wording = self.get_wordinfo(contact[12])
+                wordings[contact[12]] = wording[1] if wording else ''
+            res.append([*contact, wordings[contact[12]]])
+        return res
+
     def set_remark(self, username, remark):
         update_sql = '''
             UPDATE OpenIMContact
@@ -55,7 +82,7 @@ class OpenIMContactDB(DataBaseBase):
                     FROM OpenIMContact
                     WHERE UserName=?
                   '''
-            cursor = self.DB.cursor()
+            cursor = self.pool.cursor()
             cursor.execute(sql, [username_])
             result = cursor.fetchone()
             self.commit()  # 提交更改
@@ -89,7 +116,7 @@ class OpenIMContactDB(DataBaseBase):
                 FROM OpenIMWordingInfo
                 WHERE WordingId=?
             '''
-            cursor = self.DB.cursor()
+            cursor = self.pool.cursor()
             cursor.execute(sql, [wording_id])
             result = cursor.fetchone()
             self.commit()  # 提交更改
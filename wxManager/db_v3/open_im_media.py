@@ -13,10 +13,12 @@ import os.path
 import shutil
 import sqlite3
 import traceback
+from typing import Iterable, Iterator, Tuple
 
 from wxManager.merge import increase_data
 from wxManager.log import logger
 from wxManager.model import DataBaseBase
+from wxManager.db_v3.media_msg import MAX_SQL_VARIABLES
 
 
 class OpenIMMediaDB(DataBaseBase):
@@ -26,7 +28,7 @@ class OpenIMMediaDB(DataBaseBase):
             from OpenIMMedia
             where Reserved0 = ?
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [reserved0])
         result = cursor.fetchone()
         self.commit()
@@ -35,6 +37,27 @@ class OpenIMMediaDB(DataBaseBase):
         else:
             return None
 
+    def iter_media_buffers(self, reserved0s: Iterable[int]) -> Iterator[Tuple[int, bytes]]:
+        """
+        批量获取语音数据，每批只查询一次，查到一条返回一条
+        @param reserved0s: 语音消息的MsgSvrID
+        @return: (reserved0, 语音数据)，顺序和输入不一致，找不到的不返回
+        """
+        ids = list(set(reserved0s))
+        if not ids or not self.open_flag:
+            return
+        cursor = self.pool.cursor()
+        for i in range(0, len(ids), MAX_SQL_VARIABLES):
+            batch = ids[i:i + MAX_SQL_VARIABLES]
+            sql = f'''
+                select Reserved0, Buf
+                from OpenIMMedia
+                where Reserved0 in ({','.join('?' * len(batch))})
+            '''
+            cursor.execute(sql, batch)
+            yield from cursor
+        cursor.close()
+
     def merge(self, db_path):
         if not (os.path.exists(db_path) or os.path.isfile(db_path)):
             print(f'{db_path} 不存在')
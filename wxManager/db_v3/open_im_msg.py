@@ -127,7 +127,7 @@ class OpenIMMsgDB(DataBaseBase):
             return []
 
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = [self._get_messages_by_num(self.DB.cursor(), username, start_sort_seq, msg_num)]
+        results = [self._get_messages_by_num(self.pool.cursor(), username, start_sort_seq, msg_num)]
         self.commit()
         return results
 
@@ -151,7 +151,50 @@ class OpenIMMsgDB(DataBaseBase):
 
     def get_messages_by_username(self, username: str,
                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
-        return self._get_messages_by_username(self.DB.cursor(), username, time_range)
+        return self._get_messages_by_username(self.pool.cursor(), username, time_range)
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None, ) -> int:
+        start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            select count(*) from ChatCRMsg
+            where StrTalker = ? {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if end_time else ''}
+        '''
+        cursor = self.pool.cursor()
+        cursor.execute(sql, [username])
+        return cursor.fetchone()[0]
+
+    def _get_messages_after(self, cursor, username_, position, limit, start_time=0, end_time=0):
+        create_time, local_id = position
+        sql = f'''
+            select localId,TalkerId,Type,statusEx,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,'',Reserved1
+            from ChatCRMsg
+            where StrTalker = ? and (CreateTime > ? or (CreateTime = ? and localId > ?))
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if end_time else ''}
+            order by CreateTime, localId
+            limit ?
+        '''
+        cursor.execute(sql, [username_, create_time, create_time, local_id, limit])
+        return cursor.fetchall()
+
+    def iter_messages(self, username: str,
+                      time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                      batch_size=1000):
+        """
+        按(CreateTime, localId)顺序分批返回聊天记录，和Msg.iter_messages一样按上一批的最后一条消息往后翻页
+        @param username:
+        @param time_range:
+        @param batch_size: 每批的消息数
+        @return: 生成器，每次返回一批原始消息
+        """
+        start_time, end_time = convert_to_timestamp(time_range)
+        position = (-1, -1)
+        while True:
+            messages = self._get_messages_after(self.pool.cursor(), username, position, batch_size, start_time, end_time)
+            if not messages:
+                break
+            yield messages
+            position = (messages[-1][5], messages[-1][0])
 
     def get_message_by_server_id(self, username, server_id):
         """
@@ -214,7 +257,7 @@ class OpenIMMsgDB(DataBaseBase):
 
     def get_messages_calendar(self, username):
         res = []
-        r1 = self._get_messages_calendar(self.DB.cursor(), username)
+        r1 = self._get_messages_calendar(self.pool.cursor(), username)
         if r1:
             res.extend(r1)
         res.sort()
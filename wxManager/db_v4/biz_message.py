@@ -9,7 +9,6 @@
 @Description : 
 """
 import concurrent
-import hashlib
 import os
 import shutil
 import sqlite3
@@ -19,8 +18,10 @@ from datetime import date, datetime
 from typing import Tuple
 
 from wxManager import MessageType
+from wxManager.db_v4.catalog import ShardCatalog, get_table_name
 from wxManager.merge import increase_data, increase_update_data
 from wxManager.model.db_model import DataBaseBase
+from wxManager.model.shard_cursor import MAX_SORT_KEY, MIN_SORT_KEY, ShardCursor, ShardCursorCache
 
 
 def convert_to_timestamp_(time_input) -> int:
@@ -67,6 +68,15 @@ class BizMessageDB(DataBaseBase):
         "create_time,'unixepoch','localtime') as StrTime,status,upload_status,server_seq,origin_source,source,"
         "message_content,compress_content")
 
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.catalog = ShardCatalog()
+        self.message_cursors = ShardCursorCache()  # 聊天界面向上翻页用的游标
+
+    def self_init(self):
+        # 一次性读出所有分库的表名，之后的查询只访问有这个联系人消息表的分库
+        self.catalog.refresh(self.pool)
+
     def get_messages(self):
         pass
 
@@ -79,9 +89,7 @@ class BizMessageDB(DataBaseBase):
 
     def _get_messages_by_username(self, cursor, username: str,
                                   time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        table_name = get_table_name(username)
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         sql = f'''
@@ -103,8 +111,9 @@ order by sort_seq
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range)
-                for db in self.DB
+                executor.submit(self._with_cursor, self.pool[index], self._get_messages_by_username, username,
+                                time_range)
+                for index in self.catalog.route(self.pool, username, *convert_to_timestamp(time_range))
             ]
 
             # 等待所有任务完成，并获取结果
@@ -122,11 +131,11 @@ order by sort_seq
         #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
         lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
 
-        def task(db):
+        def task(pool):
             """
             每个线程执行的任务，获取某个数据库实例中的查询结果。
             """
-            cursor = db.cursor()
+            cursor = pool.cursor()
             try:
                 data = self._get_messages_by_username(cursor, username, time_range)
                 with lock:  # 确保对 results 的操作是线程安全的
@@ -135,15 +144,13 @@ order by sort_seq
                 cursor.close()
 
         # 使用线程池
-        with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
+        with ThreadPoolExecutor(max_workers=len(self.pool)) as executor:
+            executor.map(task, self.pool)
         self.commit()
         return results
 
     def _get_messages_by_num(self, cursor, username, start_sort_seq, msg_num):
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return []
+        table_name = get_table_name(username)
         sql = f'''
         select {BizMessageDB.columns}
         from {table_name} as msg
@@ -166,46 +173,197 @@ order by sort_seq
         @param server_id:
         @return: messages, 最后一条消息的start_sort_seq
         """
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        table_name = get_table_name(username)
         sql = f'''
 select {BizMessageDB.columns}
 from {table_name} as msg
 join Name2Id on msg.real_sender_id = Name2Id.rowid
 where server_id = ?
 '''
-        for db in self.DB:
-            cursor = db.cursor()
-            if not self.table_exists(cursor, table_name):
-                continue
+        for index in self.catalog.get_shards(username):
+            cursor = self.pool[index].cursor()
             cursor.execute(sql, [server_id])
             result = cursor.fetchone()
             if result:
                 return result
 
+    def get_messages_cursor(self, username, start_sort_seq=MAX_SORT_KEY) -> ShardCursor:
+        """
+        跨分库按sort_seq倒序翻页的游标
+        @param username:
+        @param start_sort_seq: 从小于start_sort_seq的消息开始
+        @return: ShardCursor，调用next_page(msg_num)获取下一页
+        """
+        return ShardCursor(
+            [self.pool[index] for index in self.catalog.get_shards(username)],
+            lambda cursor, position, limit: self._get_messages_by_num(cursor, username, position[0], limit),
+            key=lambda message: (message[3],),
+            position=(start_sort_seq,)
+        )
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = []
-        # for db in self.DB:
-        #     cursor = db.cursor()
-        #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-        lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
+        # 接着上一页继续翻的时候复用游标，各分库的读取位置和没用完的数据都保留在游标里
+        cursor = self.message_cursors.get(
+            username, start_sort_seq, lambda: self.get_messages_cursor(username, start_sort_seq)
+        )
+        return [cursor.next_page(msg_num)]
 
-        def task(db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
-            cursor = db.cursor()
-            try:
-                data = self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-                with lock:  # 确保对 results 的操作是线程安全的
-                    results.append(data)
-            finally:
-                cursor.close()
+    def _get_messages_after(self, cursor, username, sort_seq, limit, start_time=0, end_time=0):
+        table_name = get_table_name(username)
+        sql = f'''
+select {BizMessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where sort_seq > ? {'AND create_time>' + str(start_time) + ' AND create_time<' + str(end_time) if end_time else ''}
+order by sort_seq
+limit ?
+        '''
+        cursor.execute(sql, [sort_seq, limit])
+        return cursor.fetchall()
 
-        # 使用线程池
-        with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
-        self.commit()
-        return results
+    def iter_messages(self, username: str,
+                      time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                      batch_size=1000):
+        """
+        按sort_seq顺序分批返回聊天记录，各分库的结果归并之后再分批，内存里最多只有每个分库一批数据
+        @param username:
+        @param time_range:
+        @param batch_size: 每批的消息数
+        @return: 生成器，每次返回一批原始消息
+        """
+        start_time, end_time = convert_to_timestamp(time_range)
+        cursor = ShardCursor(
+            [self.pool[index] for index in self.catalog.route(self.pool, username, start_time, end_time)],
+            lambda cursor_, position, limit: self._get_messages_after(
+                cursor_, username, position[0], limit, start_time, end_time
+            ),
+            key=lambda message: (message[3],),
+            position=(MIN_SORT_KEY,),
+            descending=False
+        )
+        while True:
+            messages = cursor.next_page(batch_size)
+            if not messages:
+                break
+            yield messages
+
+    def _range_conditions(self, time_range, type_):
+        conditions = []
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append(f'create_time>{start_time} AND create_time<{end_time}')
+        if type_ is not None:
+            conditions.append(f'local_type={int(get_local_type(type_))}')
+        return ''.join(' AND ' + condition for condition in conditions)
+
+    def get_sort_seq_ranges(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                            batch_size=10000, type_: MessageType = None):
+        """
+        把某个联系人的消息按sort_seq切成每段最多batch_size条的区间，多进程解析时各进程按区间自己读取数据库
+        @param username:
+        @param time_range:
+        @param batch_size: 每个区间的消息数
+        @param type_: 只要某种类型的消息
+        @return: [(分库文件名, 起始sort_seq, 结束sort_seq), ...]，区间两端都包含
+        """
+        start_time, end_time = convert_to_timestamp(time_range)
+        table_name = get_table_name(username)
+        sql = f'SELECT sort_seq FROM {table_name} WHERE 1=1{self._range_conditions(time_range, type_)} ORDER BY sort_seq'
+        ranges = []
+        for index in self.catalog.route(self.pool, username, start_time, end_time):
+            cursor = self.pool[index].cursor()
+            cursor.execute(sql)
+            sort_seqs = [row[0] for row in cursor.fetchall()]
+            for i in range(0, len(sort_seqs), batch_size):
+                ranges.append((self.db_file_name[index], sort_seqs[i], sort_seqs[min(i + batch_size, len(sort_seqs)) - 1]))
+        return ranges
+
+    def get_messages_by_range(self, username: str, file_name, start_sort_seq, end_sort_seq,
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                              type_: MessageType = None):
+        """
+        读取get_sort_seq_ranges切分出来的一个区间
+        @param username:
+        @param file_name: 分库文件名
+        @param start_sort_seq: 起始sort_seq（包含）
+        @param end_sort_seq: 结束sort_seq（包含）
+        @param time_range: 和切分时一致
+        @param type_: 和切分时一致
+        @return: 原始消息列表
+        """
+        if file_name not in self.db_file_name:
+            return []
+        table_name = get_table_name(username)
+        sql = f'''
+select {BizMessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where sort_seq BETWEEN ? AND ?{self._range_conditions(time_range, type_)}
+order by sort_seq
+        '''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [start_sort_seq, end_sort_seq])
+        return cursor.fetchall()
+
+    def get_cache_watermarks(self, username) -> dict:
+        """
+        解析结果缓存的失效依据
+        @param username:
+        @return: {分库文件名: (最大local_id, 分库文件修改时间)}
+        """
+        table_name = get_table_name(username)
+        result = {}
+        for index in self.catalog.get_shards(username):
+            cursor = self.pool[index].cursor()
+            cursor.execute(f'SELECT max(local_id) FROM {table_name}')
+            max_local_id = cursor.fetchone()[0]
+            if max_local_id:
+                result[self.db_file_name[index]] = (max_local_id, os.path.getmtime(self.db_path[index]))
+        return result
+
+    def get_cache_checksum(self, username, file_name, max_local_id) -> tuple:
+        """
+        local_id不超过max_local_id的消息的行数和类型、状态之和，删除、撤回消息之后会变化
+        """
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(
+            f'SELECT count(*), total(local_type), total(status) FROM {get_table_name(username)} WHERE local_id<=?',
+            [max_local_id]
+        )
+        return tuple(cursor.fetchone())
+
+    def get_messages_by_local_id(self, username: str, file_name, start_local_id, end_local_id):
+        """
+        @return: 某个分库里local_id在(start_local_id, end_local_id]之间的原始消息
+        """
+        if file_name not in self.db_file_name:
+            return []
+        table_name = get_table_name(username)
+        sql = f'''
+select {BizMessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where local_id>? AND local_id<=?
+order by sort_seq
+        '''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [start_local_id, end_local_id])
+        return cursor.fetchall()
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None, ) -> int:
+        if not time_range:
+            return self.catalog.count(self.pool, username)
+        start_time, end_time = convert_to_timestamp(time_range)
+        table_name = get_table_name(username)
+        sql = f'SELECT count(*) FROM {table_name} WHERE create_time>? AND create_time<?'
+        num = 0
+        for index in self.catalog.route(self.pool, username, start_time, end_time):
+            cursor = self.pool[index].cursor()
+            cursor.execute(sql, [start_time, end_time])
+            num += cursor.fetchone()[0]
+        return num
 
     def _get_messages_calendar(self, cursor, username):
         """
@@ -213,9 +371,7 @@ where server_id = ?
         @param username_:
         @return:
         """
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        table_name = get_table_name(username)
         sql = f'''SELECT DISTINCT strftime('%Y-%m-%d',create_time,'unixepoch','localtime') AS date
             from {table_name} as msg
             ORDER BY date desc;
@@ -226,8 +382,8 @@ where server_id = ?
 
     def get_messages_calendar(self, username):
         res = []
-        for db in self.DB:
-            r1 = self._get_messages_calendar(db.cursor(), username)
+        for index in self.catalog.get_shards(username):
+            r1 = self._get_messages_calendar(self.pool[index].cursor(), username)
             if r1:
                 res.extend(r1)
         res.sort()
@@ -235,9 +391,7 @@ where server_id = ?
 
     def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
                               time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        table_name = get_table_name(username)
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         local_type = get_local_type(type_)
@@ -260,8 +414,9 @@ order by sort_seq
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range)
-                for db in self.DB
+                executor.submit(self._with_cursor, self.pool[index], self._get_messages_by_type, username, type_,
+                                time_range)
+                for index in self.catalog.route(self.pool, username, *convert_to_timestamp(time_range))
             ]
 
             # 等待所有任务完成，并获取结果
@@ -313,4 +468,6 @@ order by sort_seq
         # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
         #     executor.map(lambda args: task_(*args), tasks)
         self.commit()
+        self.catalog.refresh(self.pool)
+        self.message_cursors.clear()
         print(len(tasks))
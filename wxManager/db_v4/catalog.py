@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/19 21:12
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-catalog.py
+@Description : 聊天记录分库路由表
+               微信4.0每个联系人的消息存放在message_N.db的Msg_<md5(username)>表里，一个联系人可能分散在多个分库中；
+               初始化时一次性读出每个分库的sqlite_master，之后查询只访问真正有这张表的分库，
+               每个分库的行数和最早/最晚消息时间在第一次用到时再统计并缓存，用于按时间范围跳过分库
+"""
+import hashlib
+import threading
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+
+@lru_cache(maxsize=4096)
+def get_table_name(username: str) -> str:
+    return f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+
+
+def get_table_usernames(cursor) -> Dict[str, str]:
+    """消息表名只有md5，用分库里的Name2Id反查联系人wxid"""
+    cursor.execute('SELECT user_name FROM Name2Id')
+    return {get_table_name(username): username for (username,) in cursor.fetchall() if username}
+
+
+class ShardCatalog:
+    def __init__(self):
+        self.tables: Dict[str, List[int]] = {}  # 表名 -> 含有这张表的分库下标（和self.pool的下标一致）
+        self.stats: Dict[Tuple[str, int], Tuple[int, int, int]] = {}  # (表名, 分库下标) -> (行数, 最早时间, 最晚时间)
+        self.lock = threading.Lock()
+
+    def refresh(self, pools):
+        """
+        重新读取所有分库的表名，数据库初始化、合并之后调用
+        :param pools: 每个分库的连接池，和DataBaseBase.pool一致
+        """
+        tables = {}
+        for index, pool in enumerate(pools):
+            cursor = pool.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg\\_%' ESCAPE '\\';")
+            for (table_name,) in cursor.fetchall():
+                tables.setdefault(table_name, []).append(index)
+        with self.lock:
+            self.tables = tables
+            self.stats = {}
+
+    def get_shards(self, username: str) -> List[int]:
+        """含有该联系人消息表的分库下标"""
+        return self.tables.get(get_table_name(username), [])
+
+    def get_tables(self, index: int) -> List[str]:
+        """某个分库里所有的消息表"""
+        return [table_name for table_name, shards in self.tables.items() if index in shards]
+
+    def get_stats(self, pools, username: str, index: int) -> Tuple[int, int, int]:
+        """
+        某个分库里该联系人的(行数, 最早create_time, 最晚create_time)，第一次调用时统计
+        """
+        table_name = get_table_name(username)
+        key = (table_name, index)
+        stats = self.stats.get(key)
+        if stats is None:
+            cursor = pools[index].cursor()
+            cursor.execute(f'SELECT count(*), min(create_time), max(create_time) FROM {table_name}')
+            count, min_time, max_time = cursor.fetchone()
+            stats = (count, min_time or 0, max_time or 0)
+            with self.lock:
+                self.stats[key] = stats
+        return stats
+
+    def route(self, pools, username: str, start_time=0, end_time=0) -> List[int]:
+        """
+        需要查询的分库下标
+        :param pools: 每个分库的连接池
+        :param username: 联系人wxid
+        :param start_time: 时间范围（不含边界），和end_time都为0时表示不限时间
+        :param end_time:
+        :return: 分库下标列表
+        """
+        shards = self.get_shards(username)
+        if not start_time and not end_time:
+            return shards
+        result = []
+        for index in shards:
+            count, min_time, max_time = self.get_stats(pools, username, index)
+            if count and max_time > start_time and min_time < end_time:
+                result.append(index)
+        return result
+
+    def count(self, pools, username: str) -> int:
+        """该联系人的消息总数"""
+        return sum(self.get_stats(pools, username, index)[0] for index in self.get_shards(username))
+
+
+if __name__ == '__main__':
+    pass
@@ -16,6 +16,8 @@ from wxManager.model.db_model import DataBaseBase
 
 
 class ContactDB(DataBaseBase):
+    writable = True  # 会修改联系人备注，不使用快照模式
+
     def create_index(self):
         sql = "CREATE INDEX IF NOT EXISTS contact_username ON contact(username);"
         try:
@@ -27,21 +29,23 @@ class ContactDB(DataBaseBase):
         except:
             return False
 
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.label_map = None  # label_id -> 标签名，标签很少，整表读一次
+
     def get_label_by_id(self, label_id) -> str:
-        sql = '''
-            select label_name_ from contact_label
-            where label_id_ = ?
-        '''
-        try:
-            cursor = self.DB.cursor()
-            cursor.execute(sql, [label_id])
-            result = cursor.fetchone()
-            if result:
-                return result[0]
-            else:
+        if self.label_map is None:
+            sql = '''
+                select label_id_, label_name_ from contact_label
+            '''
+            try:
+                cursor = self.pool.cursor()
+                cursor.execute(sql)
+                self.label_map = {str(label_id_): label_name for label_id_, label_name in cursor.fetchall()}
+                cursor.close()
+            except:
                 return ''
-        except:
-            return ''
+        return self.label_map.get(str(label_id), '')
 
     def get_labels(self, label_id_list) -> str:
         if not label_id_list:
@@ -80,9 +84,25 @@ ORDER BY
         ELSE remark_quan_pin
     END ASC
         '''
-        self.cursor.execute(sql)
-        results = self.cursor.fetchall()
-        self.DB.commit()
+        cursor = self.pool.cursor()
+        cursor.execute(sql)
+        results = cursor.fetchall()
+        return results
+
+    def get_all_contacts(self):
+        """
+        一次性读出整张contact表（包括陌生人、群成员），字段和get_contact_by_username一致
+        """
+        if not self.open_flag:
+            return []
+        sql = '''
+SELECT username, alias, local_type,flag, remark, nick_name, pin_yin_initial, remark_pin_yin_initial, small_head_url, big_head_url,extra_buffer,head_img_md5,chat_room_notify,is_in_chat_room,description,chat_room_type
+FROM contact
+        '''
+        cursor = self.pool.cursor()
+        cursor.execute(sql)
+        results = cursor.fetchall()
+        cursor.close()
         return results
 
     def get_contact_by_username(self, username):
@@ -91,7 +111,7 @@ SELECT username, alias, local_type,flag, remark, nick_name, pin_yin_initial, rem
 FROM contact
 WHERE username=?
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [username])
         result = cursor.fetchone()
         cursor.close()
@@ -106,7 +126,7 @@ select id,ext_buffer,username,owner
 from chat_room
 where username=?
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [username])
         result = cursor.fetchone()
         cursor.close()
@@ -143,6 +163,7 @@ where username=?
             increase_update_data(db_path, self.cursor, self.DB, 'openim_appid', 'lang_id')
             # increase_update_data(db_path, self.cursor, self.DB, 'chat_room_member', 'room_id_')
             increase_data(db_path, self.cursor, self.DB, 'name2id', 'username')
+            self.label_map = None
         except:
             print(f"数据库操作错误: {traceback.format_exc()}")
             self.DB.rollback()
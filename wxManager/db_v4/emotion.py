@@ -29,7 +29,7 @@ class EmotionDB(DataBaseBase):
         from kNonStoreEmoticonTable
         where md5=?
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [md5])
         result = cursor.fetchone()
         if result:
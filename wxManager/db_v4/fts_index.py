@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/25 20:16
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-fts_index.py
+@Description : 聊天记录全文索引
+               微信4.0的消息内容大多是zstd压缩的，直接LIKE查询需要解压全部历史；
+               这里把文本消息解压、规范化之后写进单独的SQLite文件，用FTS5的trigram分词（适合中文，不需要分词词典），
+               按(分库, 表)记录已经索引到的最大local_id，之后每次只增量索引新增的消息
+"""
+import sqlite3
+import threading
+import unicodedata
+from typing import Iterable, List, Tuple
+
+from wxManager.db_v4.catalog import get_table_usernames
+from wxManager.parser.util.zstd_service import decompress_batch
+
+FTS_INDEX_FILE = 'fts_index.db'
+TEXT_LOCAL_TYPE = 1  # 只索引文本消息
+FETCH_SIZE = 5000
+
+
+def normalize_text(text: str) -> str:
+    """全角转半角、统一大小写和空白，索引和查询都用同样的规则"""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+class MessageFTSIndex:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = None
+        self.ready = False  # 至少完整索引过一次
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            conn.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS MessageFTS USING fts5(
+                    content,
+                    username UNINDEXED,
+                    shard UNINDEXED,
+                    local_id UNINDEXED,
+                    create_time UNINDEXED,
+                    tokenize='trigram'
+                );
+                CREATE TABLE IF NOT EXISTS Watermark(
+                    shard TEXT,
+                    table_name TEXT,
+                    max_local_id INTEGER,
+                    PRIMARY KEY (shard, table_name)
+                );
+            ''')
+            self.conn = conn
+        return self.conn
+
+    def update(self, shards: Iterable[Tuple[str, object, List[str]]]) -> int:
+        """
+        增量索引
+        :param shards: [(分库文件名, 分库连接池, [表名, ...]), ...]
+        :return: 本次新增的索引条数
+        """
+        with self.lock:
+            conn = self._open()
+            watermarks = {
+                (shard, table_name): max_local_id
+                for shard, table_name, max_local_id in conn.execute('SELECT shard, table_name, max_local_id FROM Watermark')
+            }
+            total = 0
+            for shard, pool, tables in shards:
+                cursor = pool.cursor()
+                usernames = get_table_usernames(cursor)
+                for table_name in tables:
+                    username = usernames.get(table_name)
+                    if not username:
+                        continue
+                    is_chatroom = username.endswith('@chatroom')
+                    last_local_id = watermarks.get((shard, table_name), 0)
+                    cursor.execute(
+                        f'SELECT local_id, create_time, message_content, local_type FROM {table_name} '
+                        f'WHERE local_id>? ORDER BY local_id',
+                        [last_local_id]
+                    )
+                    while True:
+                        rows = cursor.fetchmany(FETCH_SIZE)
+                        if not rows:
+                            break
+                        contents = decompress_batch([row[2] for row in rows])
+                        records = []
+                        for row, content in zip(rows, contents):
+                            if row[3] != TEXT_LOCAL_TYPE or not content:
+                                continue
+                            if isinstance(content, bytes):
+                                content = content.strip(b'\x00').decode('utf-8', errors='ignore')
+                            if is_chatroom and ':\n' in content:
+                                # 群聊文字消息格式：<wxid>:\n<content>
+                                content = content.split(':\n', 1)[1]
+                            content = normalize_text(content)
+                            if content:
+                                records.append((content, username, shard, row[0], row[1]))
+                        conn.executemany(
+                            'INSERT INTO MessageFTS(content, username, shard, local_id, create_time) VALUES (?,?,?,?,?)',
+                            records
+                        )
+                        conn.execute('INSERT OR REPLACE INTO Watermark VALUES (?,?,?)', (shard, table_name, rows[-1][0]))
+                        total += len(records)
+            conn.commit()
+            self.ready = True
+            return total
+
+    def search(self, keyword, username='', num=5, start_time=0, end_time=0) -> List[Tuple[str, int, str, str, int]]:
+        """
+        :param keyword: 关键词
+        :param username: 只搜某个联系人，为空时搜索全部
+        :param num: 最多返回条数
+        :param start_time: 时间范围（不含边界），和end_time都为0时表示不限时间
+        :param end_time:
+        :return: [(分库文件名, local_id, 联系人wxid, 规范化后的消息文本, create_time), ...]，按相关度排序
+        """
+        keyword = normalize_text(keyword)
+        if not keyword:
+            return []
+        conditions = []
+        args = []
+        if username:
+            conditions.append('username=?')
+            args.append(username)
+        if end_time:
+            conditions.append('create_time>? AND create_time<?')
+            args.extend([start_time, end_time])
+        where = ''.join(' AND ' + condition for condition in conditions)
+        if len(keyword) >= 3:
+            # trigram分词至少需要3个字符，按bm25相关度排序
+            sql = f'''
+                SELECT shard, local_id, username, content, create_time FROM MessageFTS
+                WHERE MessageFTS MATCH ?{where}
+                ORDER BY bm25(MessageFTS), create_time DESC
+                LIMIT ?
+            '''
+            args = ['"' + keyword.replace('"', '""') + '"'] + args
+        else:
+            # 一两个字的关键词用不上trigram，只能在已经解压好的文本里LIKE，优先返回短消息和新消息
+            sql = f'''
+                SELECT shard, local_id, username, content, create_time FROM MessageFTS
+                WHERE content LIKE ? ESCAPE '\\'{where}
+                ORDER BY length(content), create_time DESC
+                LIMIT ?
+            '''
+            args = ['%' + keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'] + args
+        with self.lock:
+            conn = self._open()
+            return conn.execute(sql, args + [num]).fetchall()
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            self.ready = False
+
+
+def context_window(text: str, keyword: str, max_len=10) -> str:
+    """
+    截取关键词前后各max_len个字符
+    :param text: 消息文本
+    :param keyword: 关键词
+    :param max_len: 前后各保留的字符数
+    """
+    text = normalize_text(text)
+    keyword = normalize_text(keyword)
+    index = text.find(keyword)
+    if index < 0:
+        return text[:max_len * 2 + len(keyword)]
+    start = max(0, index - max_len)
+    end = index + len(keyword) + max_len
+    return ('...' if start > 0 else '') + text[start:end] + ('...' if end < len(text) else '')
+
+
+if __name__ == '__main__':
+    pass
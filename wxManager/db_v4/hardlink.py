@@ -10,6 +10,7 @@
 """
 import hashlib
 import os
+import threading
 import traceback
 from lxml import etree
 
@@ -18,13 +19,17 @@ from wxManager.merge import increase_data
 from wxManager.model.db_model import DataBaseBase
 from wxManager.log import logger
 from wxManager.model.message import Message
+from wxManager.parser.util.dir_cache import dir_cache
 from wxManager.parser.util.protocbuf import file_info_pb2
-from google.protobuf.json_format import MessageToJson, MessageToDict
 
 image_root_path = "msg\\attach\\"
 video_root_path = "msg\\video\\"
 file_root_path = "msg\\file\\"
 
+IMAGE_TABLE = 'image_hardlink_info_v3'
+VIDEO_TABLE = 'video_hardlink_info_v3'
+FILE_TABLE = 'file_hardlink_info_v3'
+
 
 def get_md5_from_xml(content, type_="img"):
     if not content:
@@ -49,107 +54,102 @@ def get_md5_from_xml(content, type_="img"):
         return None
 
 
+def get_dir3(extra_buffer) -> str:
+    if not extra_buffer:
+        return ''
+    message = file_info_pb2.FileInfoData()
+    message.ParseFromString(extra_buffer)
+    return message.dir3
+
+
 class HardLinkDB(DataBaseBase):
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.md5_maps = {}  # 表名 -> {md5: (file_size, type, file_name, dir1, dir2, rowid, modify_time, extra_buffer)}
+        self.lock = threading.Lock()
+
     def get_image_path(self):
         pass
 
-    def create_index(self):
-        sql = "CREATE INDEX IF NOT EXISTS image_hardlink_info_v3_md5 ON image_hardlink_info_v3(md5);"
-        try:
-            cursor = self.DB.cursor()
-            cursor.execute(sql)
-            self.commit()
-            cursor.close()
-        except:
-            pass
-
-        sql = "CREATE INDEX IF NOT EXISTS video_hardlink_info_v3_md5 ON video_hardlink_info_v3(md5);"
-        try:
-            cursor = self.DB.cursor()
-            cursor.execute(sql)
-            self.commit()
-            cursor.close()
-        except:
-            pass
-
-        sql = "CREATE INDEX IF NOT EXISTS file_hardlink_info_v3_md5 ON file_hardlink_info_v3(md5);"
-        try:
-            cursor = self.DB.cursor()
-            cursor.execute(sql)
-            self.commit()
-            cursor.close()
-        except:
-            pass
+    def load_md5_map(self, table_name) -> dict:
+        """
+        一次性读出整张硬链接表，目录id替换成目录名，之后按md5查找只是字典查询，
+        一个有几万张图片的聊天解析路径时不用每张图都查一次数据库
+        整表顺序读取，不需要md5索引（快照模式下是只读连接，也建不了索引）
+        @param table_name: image_hardlink_info_v3、video_hardlink_info_v3或file_hardlink_info_v3
+        @return: {md5: (file_size, type, file_name, dir1, dir2, rowid, modify_time, extra_buffer)}
+        """
+        md5_map = self.md5_maps.get(table_name)
+        if md5_map is not None:
+            return md5_map
+        with self.lock:
+            md5_map = self.md5_maps.get(table_name)
+            if md5_map is not None:
+                return md5_map
+            md5_map = {}
+            try:
+                cursor = self.pool.cursor()
+                cursor.execute('SELECT rowid, username FROM dir2id')
+                dirs = dict(cursor.fetchall())
+                cursor.execute(f'''
+                    SELECT md5, file_size, type, file_name, dir1, dir2, _rowid_, modify_time, extra_buffer
+                    FROM {table_name}
+                    ORDER BY _rowid_
+                ''')
+                for md5, file_size, type_, file_name, dir1, dir2, rowid, modify_time, extra_buffer in cursor:
+                    if md5 in md5_map or dir1 not in dirs:
+                        continue
+                    if table_name == IMAGE_TABLE and dir2 not in dirs:
+                        continue
+                    md5_map[md5] = (file_size, type_, file_name, dirs[dir1], dirs.get(dir2), rowid, modify_time,
+                                    extra_buffer)
+            except:
+                logger.error(traceback.format_exc())
+            self.md5_maps[table_name] = md5_map
+            return md5_map
 
     def get_image_by_md5(self, md5: str):
-        sql = '''
-        select file_size,type,file_name,dir2id.username,dir2id2.username,_rowid_,modify_time,extra_buffer
-        from image_hardlink_info_v3
-        join dir2id on dir2id.rowid = dir1
-        join dir2id as dir2id2 on dir2id2.rowid=dir2
-        where md5=?
-        '''
-        cursor = self.DB.cursor()
-        cursor.execute(sql, [md5])
-        result = cursor.fetchall()
-        if result:
-            return result[0]
-        return None
+        return self.load_md5_map(IMAGE_TABLE).get(md5)
 
     def get_video_by_md5(self, md5: str):
-        sql = '''
-        SELECT file_size, type, file_name, dir2id.username, dir2id2.username, _rowid_, modify_time, extra_buffer
-        FROM video_hardlink_info_v3
-        JOIN dir2id ON dir2id.rowid = dir1
-        LEFT JOIN dir2id AS dir2id2 ON dir2id2.rowid = dir2 AND dir2 != 0
-        WHERE md5 = ?
-        '''
-        cursor = self.DB.cursor()
-        cursor.execute(sql, [md5])
-        result = cursor.fetchall()
-        if result:
-            return result[0]
-        return None
+        return self.load_md5_map(VIDEO_TABLE).get(md5)
 
     def get_file_by_md5(self, md5: str):
-        sql = '''
-        select file_size,type,file_name,dir2id.username,dir2id2.username,_rowid_,modify_time,extra_buffer
-        from file_hardlink_info_v3
-        join dir2id on dir2id.rowid = dir1
-        LEFT JOIN dir2id AS dir2id2 ON dir2id2.rowid = dir2 AND dir2 != 0
-        where md5=?
-        '''
-        cursor = self.DB.cursor()
-        cursor.execute(sql, [md5])
-        result = cursor.fetchall()
-        if result:
-            return result[0]
-        return None
+        return self.load_md5_map(FILE_TABLE).get(md5)
+
+    @staticmethod
+    def _video_path(video_info, thumb=False):
+        type_ = video_info[1]
+        if type_ == 5:
+            dir1 = video_info[3]
+            dir2 = video_info[4]
+            dir3 = get_dir3(video_info[7])
+            file_name = video_info[2]
+            result = os.path.join(video_root_path, dir1, dir2, 'Rec', dir3, 'V', file_name)
+        else:
+            dir1 = video_info[3]
+            data_image = video_info[2].split('.')[0] + '_thumb.jpg' if thumb else video_info[2]
+            dat_image = os.path.join(video_root_path, dir1, data_image)
+            result = dat_image
+        return result
 
     def get_video(self, md5, thumb=False):
         video_info = self.get_video_by_md5(md5)
         if video_info:
-            type_ = video_info[1]
-            if type_ == 5:
-                dir1 = video_info[3]
-                dir2 = video_info[4]
-                extra_buffer = video_info[7]
-                # 创建顶级消息对象
-                message = file_info_pb2.FileInfoData()
-                # 解析二进制数据
-                message.ParseFromString(extra_buffer)
-                extra_dic = MessageToDict(message)
-                dir3 = extra_dic.get('dir3', '')
-                file_name = video_info[2]
-                result = os.path.join(video_root_path, dir1, dir2, 'Rec', dir3, 'V', file_name)
-            else:
-                dir1 = video_info[3]
-                data_image = video_info[2].split('.')[0] + '_thumb.jpg' if thumb else video_info[2]
-                dat_image = os.path.join(video_root_path, dir1, data_image)
-                result = dat_image
-            return result
+            return self._video_path(video_info, thumb)
         return ''
 
+    def get_video_paths(self, md5):
+        """
+        视频和封面的路径，只查一次
+        @param md5:
+        @return: (视频路径, 封面路径)，找不到时都为空字符串
+        """
+        video_info = self.get_video_by_md5(md5)
+        if video_info:
+            return self._video_path(video_info, False), self._video_path(video_info, True)
+        return '', ''
+
     def get_image_thumb(self, message: Message, talker_username):
         """
         @param message:
@@ -177,18 +177,13 @@ class HardLinkDB(DataBaseBase):
         dir0 = "Img"
         local_id = message.local_id
         create_time = message.timestamp
-        data_image = f'{message.file_name}_W.dat' if message.file_name else f'{local_id}_{create_time}_W.dat'
-        path1 = os.path.join(image_root_path, dir1, dir2, dir0, data_image)
-        if os.path.exists(os.path.join(Me().wx_dir, path1)):
-            return path1
-        else:
-            data_image = f'{message.file_name}_h.dat' if message.file_name else f'{local_id}_{create_time}_h.dat'
-            path1 = os.path.join(image_root_path, dir1, dir2, dir0, data_image)
-            if os.path.exists(os.path.join(Me().wx_dir, path1)):
-                return path1
-            data_image = f'{message.file_name}.dat' if message.file_name else f'{local_id}_{create_time}.dat'
-            path1 = os.path.join(image_root_path, dir1, dir2, dir0, data_image)
-            return path1
+        prefix = message.file_name if message.file_name else f'{local_id}_{create_time}'
+        dir_path = os.path.join(image_root_path, dir1, dir2, dir0)
+        # 整个月份目录只scandir一次，之后判断文件是否存在都是集合查询
+        data_image = dir_cache.first_existing(
+            os.path.join(Me().wx_dir, dir_path), (f'{prefix}_W.dat', f'{prefix}_h.dat')
+        )
+        return os.path.join(dir_path, data_image or f'{prefix}.dat')
 
     def get_image(self, content, message, up_dir="", md5=None, thumb=False, talker_username='') -> str:
         """
@@ -201,12 +196,11 @@ class HardLinkDB(DataBaseBase):
         @return:
         """
         result = '.'
-        self.create_index()
         if thumb:
             return self.get_image_thumb(message, talker_username)
         else:
             result = self.get_image_by_time(message, talker_username)
-            if os.path.exists(os.path.join(Me().wx_dir, result)):
+            if dir_cache.exists(os.path.join(Me().wx_dir, result)):
                 return result
         if not md5:
             md5 = get_md5_from_xml(content)
@@ -217,13 +211,7 @@ class HardLinkDB(DataBaseBase):
                 if type_ == 4:
                     dir1 = imginfo[3]
                     dir2 = imginfo[4]
-                    extra_buffer = imginfo[7]
-                    # 创建顶级消息对象
-                    message = file_info_pb2.FileInfoData()
-                    # 解析二进制数据
-                    message.ParseFromString(extra_buffer)
-                    extra_dic = MessageToDict(message)
-                    dir3 = extra_dic.get('dir3', '')
+                    dir3 = get_dir3(imginfo[7])
                     file_name = imginfo[2]
                     result = os.path.join(image_root_path, dir1, dir2, 'Rec', dir3, 'Img', file_name)
                 else:
@@ -246,13 +234,7 @@ class HardLinkDB(DataBaseBase):
             if type_ == 6:
                 dir1 = file_info[3]
                 dir2 = file_info[4]
-                extra_buffer = file_info[7]
-                # 创建顶级消息对象
-                message = file_info_pb2.FileInfoData()
-                # 解析二进制数据
-                message.ParseFromString(extra_buffer)
-                extra_dic = MessageToDict(message)
-                dir3 = extra_dic.get('dir3', '')
+                dir3 = get_dir3(file_info[7])
                 file_name = file_info[2]
                 filepath = os.path.join(image_root_path, dir1, dir2, dir3, file_name)
             else:
@@ -272,6 +254,8 @@ class HardLinkDB(DataBaseBase):
             increase_data(db_path, self.cursor, self.DB, 'image_hardlink_info_v3', 'md5', exclude_column='_rowid_')
             increase_data(db_path, self.cursor, self.DB, 'video_hardlink_info_v3', 'md5', exclude_column='_rowid_')
             increase_data(db_path, self.cursor, self.DB, 'dir2id', 'username')
+            self.md5_maps.clear()
+            dir_cache.invalidate()  # 合并进来的新图片可能在已经缓存过的目录里
         except:
             print(f"数据库操作错误: {traceback.format_exc()}")
             self.DB.rollback()
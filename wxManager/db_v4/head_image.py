@@ -22,6 +22,8 @@ from wxManager.log import logger
 
 
 class HeadImageDB(DataBaseBase):
+    writable = True  # 会写入新的头像，不使用快照模式
+
     def get_avatar_buffer(self, username):
         if not self.open_flag:
             return b''
@@ -30,11 +32,10 @@ select image_buffer
 from head_image
 where username = ?
         '''
-        cursor = self.DB.cursor()
+        cursor = self.pool.cursor()
         cursor.execute(sql, [username])
         result = cursor.fetchall()
         cursor.close()
-        self.DB.commit()
         if result:
             return result[0][0]
         else:
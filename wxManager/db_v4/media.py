@@ -10,23 +10,14 @@
 """
 import os
 import shutil
-import subprocess
-import sys
 import traceback
+from typing import Iterable, Iterator, Tuple
 
 from wxManager.merge import increase_update_data, increase_data
 from wxManager.model import DataBaseBase
-from wxManager.log import logger
+from wxManager.parser.util.audio_service import audio_engine
 
-
-def get_ffmpeg_path():
-    # 获取打包后的资源目录
-    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-
-    # 构建 FFmpeg 可执行文件的路径
-    ffmpeg_path = os.path.join(resource_dir, 'app', 'resources', 'data', 'ffmpeg.exe')
-
-    return ffmpeg_path
+MAX_SQL_VARIABLES = 900  # SQLite一条语句默认最多999个参数
 
 
 class MediaDB(DataBaseBase):
@@ -38,14 +29,43 @@ class MediaDB(DataBaseBase):
         '''
         if not self.DB:
             return b''
-        for db in self.DB:
-            cursor = db.cursor()
+        for pool in self.pool:
+            cursor = pool.cursor()
             cursor.execute(sql, [server_id])
             result = cursor.fetchone()
             if result:
                 return result[0]
         return b''
 
+    def iter_media_buffers(self, server_ids: Iterable[int]) -> Iterator[Tuple[int, bytes]]:
+        """
+        批量获取语音数据，每个分库每批server_id只查询一次，查到一条返回一条，不会把所有语音同时读进内存
+        @param server_ids: 语音消息的server_id
+        @return: (server_id, 语音数据)，顺序和输入不一致，找不到的server_id不返回
+        """
+        if not self.DB:
+            return
+        pending = set(server_ids)
+        for pool in self.pool:
+            if not pending:
+                break
+            cursor = pool.cursor()
+            ids = list(pending)
+            for i in range(0, len(ids), MAX_SQL_VARIABLES):
+                batch = ids[i:i + MAX_SQL_VARIABLES]
+                sql = f'''
+                select svr_id, voice_data
+                from VoiceInfo
+                where svr_id in ({','.join('?' * len(batch))})
+                '''
+                cursor.execute(sql, batch)
+                for server_id, voice_data in cursor:
+                    # 同一个server_id可能在多个分库里都有
+                    if server_id in pending:
+                        pending.discard(server_id)
+                        yield server_id, voice_data
+            cursor.close()
+
     def get_audio_path(self, server_id, output_dir, filename=''):
         if filename:
             return f'{output_dir}/{filename}.mp3'
@@ -55,48 +75,13 @@ class MediaDB(DataBaseBase):
     def get_audio(self, server_id, output_dir, filename=''):
         if not filename:
             filename = server_id
-        silk_path = f"{output_dir}/{filename}.silk"
-        pcm_path = f"{output_dir}/{filename}.pcm"
         mp3_path = f"{output_dir}/{filename}.mp3"
         if os.path.exists(mp3_path):
             return mp3_path
         buf = self.get_media_buffer(server_id)
         if not buf:
             return ''
-        with open(silk_path, "wb") as f:
-            f.write(buf)
-        # open(silk_path, "wb").write()
-        try:
-            decode(silk_path, pcm_path, 44100)
-            # 调用系统上的 ffmpeg 可执行文件
-            # 获取 FFmpeg 可执行文件的路径
-            ffmpeg_path = get_ffmpeg_path()
-            # # 调用 FFmpeg
-            if os.path.exists(ffmpeg_path):
-                cmd = f'''"{ffmpeg_path}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-                # system(cmd)
-                # 使用subprocess.run()执行命令
-                subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            else:
-                # 源码运行的时候下面的有效
-                # 这里不知道怎么捕捉异常
-                cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-                # system(cmd)
-                # 使用subprocess.run()执行命令
-                subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if os.path.exists(silk_path):
-                os.remove(silk_path)
-            if os.path.exists(pcm_path):
-                os.remove(pcm_path)
-        except Exception as e:
-            print(f"Error: {e}")
-            logger.error(f'语音错误\n{traceback.format_exc()}')
-            cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-            # system(cmd)
-            # 使用subprocess.run()执行命令
-            subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        finally:
-            return mp3_path
+        return audio_engine.transcode_to_file(buf, mp3_path)
 
     def merge(self, db_path):
         # todo 判断数据库对应情况
@@ -9,7 +9,6 @@
 @Description : 
 """
 import concurrent
-import hashlib
 import os
 import shutil
 import sqlite3
@@ -20,8 +19,15 @@ from datetime import date, datetime
 from typing import Tuple
 
 from wxManager import MessageType
+from wxManager.db_v4.catalog import ShardCatalog, get_table_name, get_table_usernames
+from wxManager.db_v4.fts_index import FTS_INDEX_FILE, MessageFTSIndex
+from wxManager.db_v4.server_id_index import SERVER_ID_INDEX_FILE, ServerIdIndex
+from wxManager.log import logger
 from wxManager.merge import increase_data, increase_update_data
+from wxManager.parser.util.zstd_service import decompress_batch
 from wxManager.model.db_model import DataBaseBase
+from wxManager.model.stats_cube import STATS_CUBE_FILE, StatsCube
+from wxManager.model.shard_cursor import MAX_SORT_KEY, MIN_SORT_KEY, ShardCursor, ShardCursorCache
 
 
 def convert_to_timestamp_(time_input) -> int:
@@ -68,6 +74,257 @@ class MessageDB(DataBaseBase):
         "create_time,'unixepoch','localtime') as StrTime,status,upload_status,server_seq,origin_source,source,"
         "message_content,compress_content,packed_info_data")
 
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.catalog = ShardCatalog()
+        self.message_cursors = ShardCursorCache()  # 聊天界面向上翻页用的游标
+        self.server_id_index = None
+        self.fts_index = None
+        self.stats_cube = None
+        self.index_stamps = {}  # 索引名 -> 上次增量更新时各分库的修改时间
+
+    def self_init(self):
+        # 一次性读出所有分库的表名，之后的查询只访问有这个联系人消息表的分库
+        self.catalog.refresh(self.pool)
+        # 索引文件是程序自己生成的，加密模式下放在单独的缓存文件夹里
+        index_dir = os.path.join(self.get_cache_dir(self.db_dir), 'message')
+        os.makedirs(index_dir, exist_ok=True)
+        self.server_id_index = ServerIdIndex(os.path.join(index_dir, SERVER_ID_INDEX_FILE))
+        self.fts_index = MessageFTSIndex(os.path.join(index_dir, FTS_INDEX_FILE))
+        self.stats_cube = StatsCube(os.path.join(index_dir, STATS_CUBE_FILE))
+
+    def get_shard_stamp(self) -> tuple:
+        """
+        各分库文件（包括-wal文件）的修改时间和大小，微信写入新消息之后会变化
+        """
+        stamp = []
+        for db_path in self.db_path:
+            for path in (db_path, f'{db_path}-wal'):
+                try:
+                    st = os.stat(path)
+                    stamp.append((st.st_mtime_ns, st.st_size))
+                except OSError:
+                    stamp.append(None)
+        return tuple(stamp)
+
+    def _index_outdated(self, name, index) -> bool:
+        """
+        索引从没建过或者分库变化了，需要增量更新；分库没变化时不用逐张表查水位
+        @param name: 索引名
+        @param index: 索引实例
+        """
+        stamp = self.get_shard_stamp()
+        if index.ready and self.index_stamps.get(name) == stamp:
+            return False
+        if name in self.index_stamps:
+            # 分库变化了，可能有新联系人的消息表
+            self.catalog.refresh(self.pool)
+        self.index_stamps[name] = stamp
+        return True
+
+    def update_server_id_index(self):
+        """
+        增量更新server_id索引，第一次查询引用消息时自动调用
+        @return: 新增的索引条数
+        """
+        if not self.server_id_index:
+            return 0
+        shards = [
+            (file_name, self.pool[index], self.catalog.get_tables(index))
+            for index, file_name in enumerate(self.db_file_name)
+        ]
+        try:
+            return self.server_id_index.update(shards)
+        except sqlite3.Error:
+            # 数据库目录不可写（例如直接打开的加密数据库），退回逐个分库查找
+            logger.error(f'server_id索引创建失败：{traceback.format_exc()}')
+            self.server_id_index.close()
+            self.server_id_index = None
+            return 0
+
+    def update_fts_index(self):
+        """
+        增量更新全文索引，第一次搜索或者分库变化之后搜索时自动调用
+        @return: 新增的索引条数
+        """
+        if not self.fts_index:
+            return 0
+        shards = [
+            (file_name, self.pool[index], self.catalog.get_tables(index))
+            for index, file_name in enumerate(self.db_file_name)
+        ]
+        try:
+            return self.fts_index.update(shards)
+        except sqlite3.Error:
+            # 数据库目录不可写或者SQLite没有编译FTS5
+            logger.error(f'全文索引创建失败：{traceback.format_exc()}')
+            self.fts_index.close()
+            self.fts_index = None
+            return 0
+
+    @staticmethod
+    def _table_checksum(cursor, table_name, max_local_id) -> tuple:
+        """
+        local_id不超过max_local_id的消息的行数和类型、状态之和，删除、撤回消息之后会变化
+        """
+        cursor.execute(
+            f'SELECT count(*), total(local_type), total(status) FROM {table_name} WHERE local_id<=?',
+            [max_local_id]
+        )
+        return tuple(cursor.fetchone())
+
+    def _iter_stats_rows(self, watermarks):
+        """
+        逐个分库、逐张表读出水位之后的消息，交给统计表聚合
+        @param watermarks: {(分库文件名, 表名): (联系人, 已经统计到的最大local_id, 校验和)}
+        """
+        sql = '''
+            SELECT msg.local_id, Name2Id.user_name, msg.local_type, msg.create_time,
+            CASE WHEN msg.local_type=1 THEN msg.message_content END
+            FROM {} as msg
+            LEFT JOIN Name2Id ON msg.real_sender_id = Name2Id.rowid
+            WHERE msg.local_id>? AND msg.local_id<=?
+            ORDER BY msg.local_id
+        '''
+        for index, file_name in enumerate(self.db_file_name):
+            cursor = self.pool[index].cursor()
+            usernames = get_table_usernames(cursor)
+            for table_name in self.catalog.get_tables(index):
+                username = usernames.get(table_name)
+                if not username:
+                    continue
+                watermark = watermarks.get((file_name, table_name), (username, 0, ''))[1]
+                cursor.execute(f'SELECT max(local_id) FROM {table_name}')
+                max_local_id = cursor.fetchone()[0] or 0
+                if max_local_id <= watermark:
+                    continue
+                # 先算好统计到max_local_id时的校验和，下次用来判断已经统计的消息有没有被改过
+                checksum = str(self._table_checksum(cursor, table_name, max_local_id))
+                is_chatroom = username.endswith('@chatroom')
+                cursor.execute(sql.format(table_name), [watermark, max_local_id])
+                while rows := cursor.fetchmany(5000):
+                    records = []
+                    for row, content in zip(rows, decompress_batch([row[4] for row in rows])):
+                        length = 0
+                        if content:
+                            if isinstance(content, bytes):
+                                content = content.strip(b'\x00').decode('utf-8', errors='ignore')
+                            if is_chatroom and ':\n' in content:
+                                # 群聊文字消息格式：<wxid>:\n<content>
+                                content = content.split(':\n', 1)[1]
+                            length = len(content.strip())
+                        records.append((username, row[1], row[2], row[3], length))
+                    yield file_name, table_name, username, rows[-1][0], checksum, records
+
+    def _get_stale_talkers(self, watermarks) -> set:
+        """
+        已经统计过的消息被删除或改写了的联系人（校验和对不上，或者分库、表不见了）
+        """
+        stale = set()
+        for (file_name, table_name), (talker, max_local_id, checksum) in watermarks.items():
+            if talker in stale:
+                continue
+            if file_name not in self.db_file_name:
+                stale.add(talker)
+                continue
+            index = self.db_file_name.index(file_name)
+            if table_name not in self.catalog.get_tables(index) or \
+                    str(self._table_checksum(self.pool[index].cursor(), table_name, max_local_id)) != checksum:
+                stale.add(talker)
+        return stale
+
+    def update_stats_cube(self):
+        """
+        增量更新聊天统计表，第一次统计或者分库变化之后统计时自动调用
+        @return: 新统计的消息条数
+        """
+        if not self.stats_cube:
+            return 0
+        try:
+            watermarks = self.stats_cube.get_watermarks()
+            stale = self._get_stale_talkers(watermarks)
+            if stale:
+                # 删掉这些联系人的统计，在所有分库里从头统计
+                self.stats_cube.remove_talkers(stale)
+                watermarks = self.stats_cube.get_watermarks()
+            return self.stats_cube.update(self._iter_stats_rows(watermarks))
+        except sqlite3.Error:
+            # 数据库目录不可写，退回直接查询聊天记录
+            logger.error(f'聊天统计表创建失败：{traceback.format_exc()}')
+            self.stats_cube.close()
+            self.stats_cube = None
+            return 0
+
+    def get_stats_cube(self) -> StatsCube | None:
+        """
+        @return: 已经统计好的聊天统计表，不可用时返回None
+        """
+        if self.stats_cube and self._index_outdated('stats_cube', self.stats_cube):
+            self.update_stats_cube()
+        return self.stats_cube
+
+    def search_messages(self, keyword, username='', num=5,
+                        time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+        """
+        全文搜索文本消息
+        @param keyword: 关键词
+        @param username: 只搜某个联系人，为空时搜索全部
+        @param num: 最多返回条数
+        @param time_range:
+        @return: [(联系人wxid, 原始消息, 规范化后的消息文本), ...]，按相关度排序；索引不可用时返回None
+        """
+        if not self.fts_index:
+            return None
+        if self._index_outdated('fts_index', self.fts_index):
+            self.update_fts_index()
+            if not self.fts_index:
+                return None
+        start_time, end_time = convert_to_timestamp(time_range)
+        result = []
+        for file_name, local_id, username_, content, _ in self.fts_index.search(
+                keyword, username, num, start_time, end_time):
+            message = self.get_message_by_local_id(file_name, local_id, username_)
+            if message:
+                result.append((username_, message, content))
+        return result
+
+    def get_message_by_local_id(self, file_name, local_id, username):
+        if file_name not in self.db_file_name:
+            return None
+        table_name = get_table_name(username)
+        sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where local_id = ?
+'''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [local_id])
+        return cursor.fetchone()
+
+    def _get_message_by_index(self, server_id):
+        if not self.server_id_index:
+            return None
+        if not self.server_id_index.ready:
+            self.update_server_id_index()
+            if not self.server_id_index:
+                return None
+        location = self.server_id_index.lookup(server_id)
+        if not location:
+            return None
+        file_name, table_name, local_id = location
+        if file_name not in self.db_file_name:
+            return None
+        sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where local_id = ? and server_id = ?
+'''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [local_id, server_id])
+        return cursor.fetchone()
+
     def get_messages(self):
         pass
 
@@ -80,9 +337,7 @@ class MessageDB(DataBaseBase):
 
     def _get_messages_by_username(self, cursor, username: str,
                                   time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        table_name = get_table_name(username)
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         sql = f'''
@@ -104,8 +359,9 @@ order by sort_seq
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range)
-                for db in self.DB
+                executor.submit(self._with_cursor, self.pool[index], self._get_messages_by_username, username,
+                                time_range)
+                for index in self.catalog.route(self.pool, username, *convert_to_timestamp(time_range))
             ]
 
             # 等待所有任务完成，并获取结果
@@ -123,11 +379,11 @@ order by sort_seq
         #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
         lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
 
-        def task(db):
+        def task(pool):
             """
             每个线程执行的任务，获取某个数据库实例中的查询结果。
             """
-            cursor = db.cursor()
+            cursor = pool.cursor()
             try:
                 data = self._get_messages_by_username(cursor, username, time_range)
                 with lock:  # 确保对 results 的操作是线程安全的
@@ -136,15 +392,13 @@ order by sort_seq
                 cursor.close()
 
         # 使用线程池
-        with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
+        with ThreadPoolExecutor(max_workers=len(self.pool)) as executor:
+            executor.map(task, self.pool)
         self.commit()
         return results
 
     def _get_messages_by_num(self, cursor, username, start_sort_seq, msg_num):
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return []
+        table_name = get_table_name(username)
         sql = f'''
         select {MessageDB.columns}
         from {table_name} as msg
@@ -167,46 +421,206 @@ order by sort_seq
         @param server_id:
         @return: messages, 最后一条消息的start_sort_seq
         """
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        result = self._get_message_by_index(server_id)
+        if result:
+            return result
+        # 索引之后新增的消息，或者索引不可用
+        table_name = get_table_name(username)
         sql = f'''
 select {MessageDB.columns}
 from {table_name} as msg
 join Name2Id on msg.real_sender_id = Name2Id.rowid
 where server_id = ?
 '''
-        for db in self.DB:
-            cursor = db.cursor()
-            if not self.table_exists(cursor, table_name):
-                continue
+        for index in self.catalog.get_shards(username):
+            cursor = self.pool[index].cursor()
             cursor.execute(sql, [server_id])
             result = cursor.fetchone()
             if result:
                 return result
 
+    def close(self):
+        if self.server_id_index:
+            self.server_id_index.close()
+        if self.fts_index:
+            self.fts_index.close()
+        if self.stats_cube:
+            self.stats_cube.close()
+        super().close()
+
+    def get_messages_cursor(self, username, start_sort_seq=MAX_SORT_KEY) -> ShardCursor:
+        """
+        跨分库按sort_seq倒序翻页的游标
+        @param username:
+        @param start_sort_seq: 从小于start_sort_seq的消息开始
+        @return: ShardCursor，调用next_page(msg_num)获取下一页
+        """
+        return ShardCursor(
+            [self.pool[index] for index in self.catalog.get_shards(username)],
+            lambda cursor, position, limit: self._get_messages_by_num(cursor, username, position[0], limit),
+            key=lambda message: (message[3],),
+            position=(start_sort_seq,)
+        )
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
-        results = []
-        # for db in self.DB:
-        #     cursor = db.cursor()
-        #     yield self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-        lock = threading.Lock()  # 锁，用于确保线程安全地写入 results
+        # 接着上一页继续翻的时候复用游标，各分库的读取位置和没用完的数据都保留在游标里
+        cursor = self.message_cursors.get(
+            username, start_sort_seq, lambda: self.get_messages_cursor(username, start_sort_seq)
+        )
+        return [cursor.next_page(msg_num)]
+
+    def _get_messages_after(self, cursor, username, sort_seq, limit, start_time=0, end_time=0):
+        table_name = get_table_name(username)
+        sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where sort_seq > ? {'AND create_time>' + str(start_time) + ' AND create_time<' + str(end_time) if end_time else ''}
+order by sort_seq
+limit ?
+        '''
+        cursor.execute(sql, [sort_seq, limit])
+        return cursor.fetchall()
 
-        def task(db):
-            """
-            每个线程执行的任务，获取某个数据库实例中的查询结果。
-            """
-            cursor = db.cursor()
-            try:
-                data = self._get_messages_by_num(cursor, username, start_sort_seq, msg_num)
-                with lock:  # 确保对 results 的操作是线程安全的
-                    results.append(data)
-            finally:
-                cursor.close()
+    def iter_messages(self, username: str,
+                      time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                      batch_size=1000):
+        """
+        按sort_seq顺序分批返回聊天记录，各分库的结果归并之后再分批，内存里最多只有每个分库一批数据
+        @param username:
+        @param time_range:
+        @param batch_size: 每批的消息数
+        @return: 生成器，每次返回一批原始消息
+        """
+        start_time, end_time = convert_to_timestamp(time_range)
+        cursor = ShardCursor(
+            [self.pool[index] for index in self.catalog.route(self.pool, username, start_time, end_time)],
+            lambda cursor_, position, limit: self._get_messages_after(
+                cursor_, username, position[0], limit, start_time, end_time
+            ),
+            key=lambda message: (message[3],),
+            position=(MIN_SORT_KEY,),
+            descending=False
+        )
+        while True:
+            messages = cursor.next_page(batch_size)
+            if not messages:
+                break
+            yield messages
+
+    def _range_conditions(self, time_range, type_):
+        conditions = []
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append(f'create_time>{start_time} AND create_time<{end_time}')
+        if type_ is not None:
+            conditions.append(f'local_type={int(get_local_type(type_))}')
+        return ''.join(' AND ' + condition for condition in conditions)
+
+    def get_sort_seq_ranges(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                            batch_size=10000, type_: MessageType = None):
+        """
+        把某个联系人的消息按sort_seq切成每段最多batch_size条的区间，多进程解析时各进程按区间自己读取数据库
+        @param username:
+        @param time_range:
+        @param batch_size: 每个区间的消息数
+        @param type_: 只要某种类型的消息
+        @return: [(分库文件名, 起始sort_seq, 结束sort_seq), ...]，区间两端都包含
+        """
+        start_time, end_time = convert_to_timestamp(time_range)
+        table_name = get_table_name(username)
+        sql = f'SELECT sort_seq FROM {table_name} WHERE 1=1{self._range_conditions(time_range, type_)} ORDER BY sort_seq'
+        ranges = []
+        for index in self.catalog.route(self.pool, username, start_time, end_time):
+            cursor = self.pool[index].cursor()
+            cursor.execute(sql)
+            sort_seqs = [row[0] for row in cursor.fetchall()]
+            for i in range(0, len(sort_seqs), batch_size):
+                ranges.append((self.db_file_name[index], sort_seqs[i], sort_seqs[min(i + batch_size, len(sort_seqs)) - 1]))
+        return ranges
+
+    def get_messages_by_range(self, username: str, file_name, start_sort_seq, end_sort_seq,
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                              type_: MessageType = None):
+        """
+        读取get_sort_seq_ranges切分出来的一个区间
+        @param username:
+        @param file_name: 分库文件名
+        @param start_sort_seq: 起始sort_seq（包含）
+        @param end_sort_seq: 结束sort_seq（包含）
+        @param time_range: 和切分时一致
+        @param type_: 和切分时一致
+        @return: 原始消息列表
+        """
+        if file_name not in self.db_file_name:
+            return []
+        table_name = get_table_name(username)
+        sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where sort_seq BETWEEN ? AND ?{self._range_conditions(time_range, type_)}
+order by sort_seq
+        '''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [start_sort_seq, end_sort_seq])
+        return cursor.fetchall()
 
-        # 使用线程池
-        with ThreadPoolExecutor(max_workers=len(self.DB)) as executor:
-            executor.map(task, self.DB)
-        self.commit()
-        return results
+    def get_cache_watermarks(self, username) -> dict:
+        """
+        解析结果缓存的失效依据
+        @param username:
+        @return: {分库文件名: (最大local_id, 分库文件修改时间)}
+        """
+        table_name = get_table_name(username)
+        result = {}
+        for index in self.catalog.get_shards(username):
+            cursor = self.pool[index].cursor()
+            cursor.execute(f'SELECT max(local_id) FROM {table_name}')
+            max_local_id = cursor.fetchone()[0]
+            if max_local_id:
+                result[self.db_file_name[index]] = (max_local_id, os.path.getmtime(self.db_path[index]))
+        return result
+
+    def get_cache_checksum(self, username, file_name, max_local_id) -> tuple:
+        """
+        local_id不超过max_local_id的消息的行数和类型、状态之和，删除、撤回消息之后会变化
+        """
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        return self._table_checksum(cursor, get_table_name(username), max_local_id)
+
+    def get_messages_by_local_id(self, username: str, file_name, start_local_id, end_local_id):
+        """
+        @return: 某个分库里local_id在(start_local_id, end_local_id]之间的原始消息
+        """
+        if file_name not in self.db_file_name:
+            return []
+        table_name = get_table_name(username)
+        sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where local_id>? AND local_id<=?
+order by sort_seq
+        '''
+        cursor = self.pool[self.db_file_name.index(file_name)].cursor()
+        cursor.execute(sql, [start_local_id, end_local_id])
+        return cursor.fetchall()
+
+    def get_messages_number(self, username: str,
+                            time_range: Tuple[int | float | str | date, int | float | str | date] = None, ) -> int:
+        if not time_range:
+            return self.catalog.count(self.pool, username)
+        start_time, end_time = convert_to_timestamp(time_range)
+        table_name = get_table_name(username)
+        sql = f'SELECT count(*) FROM {table_name} WHERE create_time>? AND create_time<?'
+        num = 0
+        for index in self.catalog.route(self.pool, username, start_time, end_time):
+            cursor = self.pool[index].cursor()
+            cursor.execute(sql, [start_time, end_time])
+            num += cursor.fetchone()[0]
+        return num
 
     def _get_messages_calendar(self, cursor, username):
         """
@@ -214,9 +628,7 @@ where server_id = ?
         @param username_:
         @return:
         """
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        table_name = get_table_name(username)
         sql = f'''SELECT DISTINCT strftime('%Y-%m-%d',create_time,'unixepoch','localtime') AS date
             from {table_name} as msg
             ORDER BY date desc;
@@ -227,8 +639,8 @@ where server_id = ?
 
     def get_messages_calendar(self, username):
         res = []
-        for db in self.DB:
-            r1 = self._get_messages_calendar(db.cursor(), username)
+        for index in self.catalog.get_shards(username):
+            r1 = self._get_messages_calendar(self.pool[index].cursor(), username)
             if r1:
                 res.extend(r1)
         res.sort()
@@ -236,9 +648,7 @@ where server_id = ?
 
     def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
                               time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        if not self.table_exists(cursor, table_name):
-            return None
+        table_name = get_table_name(username)
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         local_type = get_local_type(type_)
@@ -261,8 +671,9 @@ order by sort_seq
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range)
-                for db in self.DB
+                executor.submit(self._with_cursor, self.pool[index], self._get_messages_by_type, username, type_,
+                                time_range)
+                for index in self.catalog.route(self.pool, username, *convert_to_timestamp(time_range))
             ]
 
             # 等待所有任务完成，并获取结果
@@ -315,6 +726,14 @@ order by sort_seq
         # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
         #     executor.map(lambda args: task_(*args), tasks)
         self.commit()
+        self.catalog.refresh(self.pool)
+        self.message_cursors.clear()
+        if self.server_id_index and self.server_id_index.ready:
+            self.update_server_id_index()
+        if self.fts_index and self.fts_index.ready:
+            self.update_fts_index()
+        if self.stats_cube and self.stats_cube.ready:
+            self.update_stats_cube()
         print(len(tasks))
 
 
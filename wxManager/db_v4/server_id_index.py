@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/20 15:37
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-server_id_index.py
+@Description : server_id全局索引
+               引用消息只记录了被引用消息的server_id，原来需要逐个分库、逐张表查找；
+               这里单独建一个SQLite文件保存 server_id -> (分库文件名, 表名, local_id)，
+               按(分库, 表)记录已经索引到的最大local_id，之后每次只增量索引新增的消息
+"""
+import sqlite3
+import threading
+from typing import Iterable, List, Tuple
+
+SERVER_ID_INDEX_FILE = 'server_id_index.db'
+
+
+class ServerIdIndex:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = None
+        self.ready = False  # 至少完整索引过一次
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS ServerIdIndex(
+                    server_id INTEGER PRIMARY KEY,
+                    shard TEXT,
+                    table_name TEXT,
+                    local_id INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS Watermark(
+                    shard TEXT,
+                    table_name TEXT,
+                    max_local_id INTEGER,
+                    PRIMARY KEY (shard, table_name)
+                );
+            ''')
+            self.conn = conn
+        return self.conn
+
+    def update(self, shards: Iterable[Tuple[str, object, List[str]]]) -> int:
+        """
+        增量索引
+        :param shards: [(分库文件名, 分库连接池, [表名, ...]), ...]
+        :return: 本次新增的索引条数
+        """
+        with self.lock:
+            conn = self._open()
+            watermarks = {
+                (shard, table_name): max_local_id
+                for shard, table_name, max_local_id in conn.execute('SELECT shard, table_name, max_local_id FROM Watermark')
+            }
+            total = 0
+            for shard, pool, tables in shards:
+                cursor = pool.cursor()
+                for table_name in tables:
+                    last_local_id = watermarks.get((shard, table_name), 0)
+                    cursor.execute(
+                        f'SELECT local_id, server_id FROM {table_name} WHERE local_id>? ORDER BY local_id',
+                        [last_local_id]
+                    )
+                    rows = cursor.fetchall()
+                    if not rows:
+                        continue
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO ServerIdIndex VALUES (?,?,?,?)',
+                        ((server_id, shard, table_name, local_id) for local_id, server_id in rows if server_id)
+                    )
+                    conn.execute('INSERT OR REPLACE INTO Watermark VALUES (?,?,?)', (shard, table_name, rows[-1][0]))
+                    total += len(rows)
+            conn.commit()
+            self.ready = True
+            return total
+
+    def lookup(self, server_id) -> Tuple[str, str, int] | None:
+        """
+        :return: (分库文件名, 表名, local_id)，没有索引到返回None
+        """
+        with self.lock:
+            conn = self._open()
+            return conn.execute(
+                'SELECT shard, table_name, local_id FROM ServerIdIndex WHERE server_id=?', [server_id]
+            ).fetchone()
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            self.ready = False
+
+
+if __name__ == '__main__':
+    pass
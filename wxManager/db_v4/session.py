@@ -24,9 +24,9 @@ select username, type, unread_count, unread_first_msg_srv_id,last_timestamp, sum
 from SessionTable
 order by sort_timestamp desc
         '''
-        self.cursor.execute(sql)
-        result = self.cursor.fetchall()
-        self.commit()
+        cursor = self.pool.cursor()
+        cursor.execute(sql)
+        result = cursor.fetchall()
         if result:
             return result
         else:
@@ -10,14 +10,17 @@
 """
 from typing import List
 
-import psutil
-
-from wxManager.decrypt.wx_info_v3 import dump_wechat_info_v3
-from wxManager.decrypt.wx_info_v4 import dump_wechat_info_v4
 from wxManager.decrypt.common import WeChatInfo
 
 
+# 读取微信进程内存的模块依赖Windows（winreg、pymem、yara等），用到时再导入，
+# 这样在其它平台上也能使用解密、密钥扫描等模块
+
+
 def get_info_v4() -> List[WeChatInfo]:
+    import psutil
+    from wxManager.decrypt.wx_info_v4 import dump_wechat_info_v4
+
     result_v4 = []
     for process in psutil.process_iter(['name', 'exe', 'pid']):
         if process.name() == 'Weixin.exe':
@@ -37,6 +40,9 @@ def get_info_v4() -> List[WeChatInfo]:
 
 
 def get_info_v3(version_list) -> List[WeChatInfo]:
+    import psutil
+    from wxManager.decrypt.wx_info_v3 import dump_wechat_info_v3
+
     result = []
     for process in psutil.process_iter(['name', 'exe', 'pid']):
         if process.name() == 'WeChat.exe':
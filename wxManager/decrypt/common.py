@@ -8,14 +8,15 @@
 @File        : MemoTrace-common.py 
 @Description : 
 """
-import psutil
-import win32api
-
 if __name__ == '__main__':
     pass
 
 
 def get_version(pid):
+    # 只在Windows下读取微信进程时用到，不在模块开头导入
+    import psutil
+    import win32api
+
     p = psutil.Process(pid)
     version_info = win32api.GetFileVersionInfo(p.exe(), '\\')
     version = f"{win32api.HIWORD(version_info['FileVersionMS'])}.{win32api.LOWORD(version_info['FileVersionMS'])}.{win32api.HIWORD(version_info['FileVersionLS'])}.{win32api.LOWORD(version_info['FileVersionLS'])}"
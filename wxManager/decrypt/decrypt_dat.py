@@ -8,8 +8,12 @@
 @File        : wxManager-decrypt_dat.py
 @Description : 微信4.0图片加密原理解析：https://blog.lc044.love/post/16
 """
+import hashlib
+import json
 import os
+import shutil
 import struct
+from functools import lru_cache
 from typing import List, Tuple
 from concurrent.futures import ProcessPoolExecutor
 from aiofiles import open as aio_open
@@ -32,6 +36,24 @@ AES_KEY_MAP = {
 }
 
 
+XOR_BUFFER_SIZE = 0x100000  # 分块异或时每次处理1MB
+
+
+@lru_cache(maxsize=256)
+def _xor_table(xor_key: int) -> bytes:
+    return bytes(i ^ xor_key for i in range(256))
+
+
+def xor_bytes(data, xor_key: int) -> bytes:
+    """
+    单字节异或，整块数据交给bytes.translate在C里查表完成，比逐字节的Python循环快两个数量级
+    :param data: bytes / bytearray / memoryview
+    :param xor_key: 异或密钥，0-255
+    :return:
+    """
+    return bytes(data).translate(_xor_table(xor_key & 0xff))
+
+
 def get_aes_key(header):
     return AES_KEY_MAP.get(header[:6], b'')
 
@@ -107,62 +129,158 @@ def decode_dat(xor_key: int, file_path, out_path, dst_name='') -> str | bytes:
             return file_outpath
 
         # 分块读取和写入
-        buffer_size = 1024  # 定义缓冲区大小
         with open(file_outpath, 'wb') as file_out:
-            file_out.write(bytes([byte ^ decode_code for byte in header]))
+            file_out.write(xor_bytes(header, decode_code))
             while True:
-                header = file_in.read(buffer_size)
-                if not header:
+                data = file_in.read(XOR_BUFFER_SIZE)
+                if not data:
                     break
-                file_out.write(bytes([byte ^ decode_code for byte in header]))
+                file_out.write(xor_bytes(data, decode_code))
 
     # print(os.path.basename(file_outpath))
     return file_outpath
 
 
-def get_decode_code_v4(wx_dir):
+IMAGE_KEY_STATE_FILE = os.path.join(os.path.expanduser('~'), '.wxManager', 'image_key.json')
+
+
+def _xor_key_from_sample(data: bytes) -> int:
+    """根据_t.dat缩略图推导异或密钥，缩略图都是jpg，结尾固定是ff d9"""
+    if not is_v4_image(data):
+        return -1
+    file_tail = data[-2:]
+    jpg_known_tail = b'\xff\xd9'
+    # 推导出密钥
+    xor_key = [c ^ p for c, p in zip(file_tail, jpg_known_tail)]
+    if len(set(xor_key)) == 1:
+        return xor_key[0]
+    return -1
+
+
+def _aes_generation(header: bytes) -> str:
+    """V1/V2，对应AES_KEY_MAP"""
+    return header[2:4].decode('ascii', 'ignore')
+
+
+def _newest_image_header(wx_dir) -> bytes:
+    """
+    最近收到的图片（msg/attach/<联系人>/<YYYY-MM>/Img下修改时间最新的.dat）的文件头，
+    每个联系人只看最新的一个月，不用遍历全部图片
+    :return: 没有图片时返回b''
+    """
+    attach_dir = os.path.join(wx_dir, 'msg', 'attach')
+    newest_path, newest_mtime = '', 0
+    try:
+        talker_dirs = [entry.path for entry in os.scandir(attach_dir) if entry.is_dir()]
+    except OSError:
+        return b''
+    for talker_dir in talker_dirs:
+        try:
+            months = sorted(entry.name for entry in os.scandir(talker_dir) if entry.is_dir())
+            if not months:
+                continue
+            for entry in os.scandir(os.path.join(talker_dir, months[-1], 'Img')):
+                if entry.name.endswith('.dat') and entry.stat().st_mtime > newest_mtime:
+                    newest_path, newest_mtime = entry.path, entry.stat().st_mtime
+        except OSError:
+            continue
+    if not newest_path:
+        return b''
+    with open(newest_path, 'rb') as f:
+        return f.read(6)
+
+
+def _current_aes_generation(wx_dir, sample_header: bytes) -> str:
+    """当前微信使用的图片AES密钥代数，以最近收到的图片为准，没有图片时用推导密钥的那张缩略图"""
+    header = _newest_image_header(wx_dir)
+    return _aes_generation(header if is_v4_image(header) else sample_header)
+
+
+def _load_image_key_state() -> dict:
+    try:
+        with open(IMAGE_KEY_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_image_key_state(wx_dir, xor_key, sample_path, header):
+    state = _load_image_key_state()
+    state[os.path.normcase(os.path.abspath(wx_dir))] = {
+        'xor_key': xor_key,
+        'sample': os.path.relpath(sample_path, wx_dir),
+        'aes_generation': _current_aes_generation(wx_dir, header),
+    }
+    try:
+        os.makedirs(os.path.dirname(IMAGE_KEY_STATE_FILE), exist_ok=True)
+        tmp_path = IMAGE_KEY_STATE_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, IMAGE_KEY_STATE_FILE)
+    except OSError:
+        pass
+
+
+def get_cached_image_key(wx_dir) -> dict:
+    """
+    读取上次找到的图片密钥，用当时推导密钥的那张缩略图重新校验异或密钥，
+    再用最近收到的图片检查AES密钥代数，微信升级换了图片密钥之后代数会变，这时重新查找
+    :return: {'xor_key': int, 'sample': str, 'aes_generation': str}，缓存不存在或已失效时返回空字典
+    """
+    info = _load_image_key_state().get(os.path.normcase(os.path.abspath(wx_dir)))
+    if not info:
+        return {}
+    sample_path = os.path.join(wx_dir, info.get('sample', ''))
+    try:
+        with open(sample_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return {}
+    if _xor_key_from_sample(data) != info.get('xor_key'):
+        return {}
+    header = _newest_image_header(wx_dir)
+    if is_v4_image(header) and _aes_generation(header) != info.get('aes_generation'):
+        # 新收到的图片换了AES密钥代数，说明微信升级过，重新查找
+        return {}
+    return info
+
+
+def get_decode_code_v4(wx_dir, use_cache=True):
     """
     从微信文件夹里找到异或密钥，原理详见：https://blog.lc044.love/post/16
+    找到的密钥保存在IMAGE_KEY_STATE_FILE里，下次校验通过就不用再遍历文件夹
     :param wx_dir:
+    :param use_cache: 是否使用上次保存的密钥
     :return:
     """
     cache_dir = os.path.join(wx_dir, 'cache')
     if not os.path.isdir(wx_dir) or not os.path.exists(cache_dir):
         raise ValueError(f'微信路径输入错误，请检查：{wx_dir}')
 
+    if use_cache:
+        info = get_cached_image_key(wx_dir)
+        if info:
+            return info['xor_key']
+
     def find_xor_key(dir0):
-        ok_flag = False
         for root, dirs, files in os.walk(dir0):
-            if ok_flag:
-                break
             for file in files:
                 if file.endswith("_t.dat"):
                     # 构造源文件和目标文件的完整路径
                     src_file_path = os.path.join(root, file)
                     with open(src_file_path, 'rb') as f:
                         data = f.read()
-                        if not is_v4_image(data):
-                            continue
-                        file_tail = data[-2:]
-
-                        jpg_known_tail = b'\xff\xd9'
-                        # 推导出密钥
-                        xor_key = [c ^ p for c, p in zip(file_tail, jpg_known_tail)]
-                        if len(set(xor_key)) == 1:
-                            print(f'[*] 找到异或密钥: 0x{xor_key[0]:x}')
-                            return xor_key[0]
+                    xor_key = _xor_key_from_sample(data)
+                    if xor_key != -1:
+                        print(f'[*] 找到异或密钥: 0x{xor_key:x}')
+                        _save_image_key_state(wx_dir, xor_key, src_file_path, data[:6])
+                        return xor_key
         return -1
 
-    xor_key_ = find_xor_key(cache_dir)
-    if xor_key_ != -1:
-        return xor_key_
-    else:
-        dirs = ['temp', 'msg']
-        for dir_name in dirs:
-            cache_dir = os.path.join(wx_dir, dir_name)
-            xor_key_ = find_xor_key(cache_dir)
-            if xor_key_ != -1:
-                return xor_key_
+    for dir_name in ['cache', 'temp', 'msg']:
+        xor_key_ = find_xor_key(os.path.join(wx_dir, dir_name))
+        if xor_key_ != -1:
+            return xor_key_
     return 0
 
 
@@ -238,8 +356,10 @@ def decode_dat_v4(xor_key: int, file_path, out_path, dst_name='') -> str | bytes
     # 将解密后的数据写入输出文件
     with open(output_file, 'wb') as f:
         f.write(decrypted_data)
-        f.write(res_data[0:-0x100000])
-        f.write(bytes([byte ^ xor_key for byte in res_data[-0x100000:]]))
+        # 只有末尾1MB被异或，前面的原样写出，用memoryview避免切片复制
+        res_view = memoryview(res_data)
+        f.write(res_view[0:-0x100000])
+        f.write(xor_bytes(res_view[-0x100000:], xor_key))
 
     # print(f"解密完成，已保存到: {output_file}")
     return output_file
@@ -291,13 +411,78 @@ async def decode_dat_v4_async(xor_key: int, file_path, out_path, dst_name='') ->
     # 将解密后的数据写入输出文件
     async with aio_open(output_file, 'wb') as f:
         await f.write(decrypted_data)
-        await f.write(res_data[:-0x100000])
-        await f.write(bytes([byte ^ xor_key for byte in res_data[-0x100000:]]))
+        res_view = memoryview(res_data)
+        await f.write(res_view[:-0x100000])
+        await f.write(xor_bytes(res_view[-0x100000:], xor_key))
 
     print(f"解密完成，已保存到: {output_file}")
     return output_file
 
 
+# 解密后可能的文件后缀，按出现频率排序
+DECODED_EXTENSIONS = ('jpg', 'png', 'gif', 'webp', 'bmp', 'tiff', 'ico', 'bin')
+
+
+def get_media_cache_key(xor_key: int, file_path) -> str:
+    """
+    解密结果缓存的键：源文件路径+大小+修改时间，再加上异或密钥（密钥不对解出来的是乱码）
+    """
+    stat = os.stat(file_path)
+    key = f'{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{xor_key}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def find_cached_media(cache_dir, cache_key) -> str:
+    shard_dir = os.path.join(cache_dir, cache_key[:2])
+    for ext in DECODED_EXTENSIONS:
+        cached_path = os.path.join(shard_dir, f'{cache_key}.{ext}')
+        if os.path.isfile(cached_path):
+            return cached_path
+    return ''
+
+
+def link_or_copy(src_path, dst_path):
+    """优先硬链接（不占额外空间，也不用复制数据），跨盘符或者文件系统不支持时退回复制"""
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+def decode_dat_cached(xor_key: int, file_path, out_path, dst_name='', cache_dir='') -> str:
+    """
+    带缓存的decode_dat，同一个dat文件只解密一次，之后的导出直接从缓存硬链接过去
+    :param xor_key: 异或加密密钥
+    :param file_path: dat文件路径
+    :param out_path: 输出文件夹
+    :param dst_name: 输出文件名，默认为输入文件名
+    :param cache_dir: 缓存文件夹，为空时不使用缓存
+    :return: 输出文件路径
+    """
+    if not cache_dir:
+        return decode_dat(xor_key, file_path, out_path, dst_name)
+    if not os.path.isfile(file_path):
+        return ''
+    cache_key = get_media_cache_key(xor_key, file_path)
+    cached_path = find_cached_media(cache_dir, cache_key)
+    if not cached_path:
+        shard_dir = os.path.join(cache_dir, cache_key[:2])
+        # 先解密到临时文件名再改名，中途中断也不会留下半个文件在缓存里
+        tmp_path = decode_dat(xor_key, file_path, shard_dir, f'{cache_key}.tmp{os.getpid()}')
+        if not tmp_path:
+            return ''
+        cached_path = os.path.join(shard_dir, f'{cache_key}.{tmp_path.rsplit(".", 1)[-1]}')
+        os.replace(tmp_path, cached_path)
+
+    output_file_name = os.path.basename(file_path)[:-4] if not dst_name else dst_name
+    output_file = os.path.join(out_path, f'{output_file_name}.{cached_path.rsplit(".", 1)[-1]}')
+    if os.path.exists(output_file):
+        return output_file
+    os.makedirs(out_path, exist_ok=True)
+    link_or_copy(cached_path, output_file)
+    return output_file
+
+
 def decode_wrapper(tasks):
     """用于包装解码函数的顶层定义"""
     # results = []
@@ -305,10 +490,10 @@ def decode_wrapper(tasks):
     #     results.append(decode_dat(*args))
     # return results
 
-    return decode_dat(*tasks)
+    return decode_dat_cached(*tasks)
 
 
-def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str, str]]):
+def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str, str]], cache_dir=''):
     """
 
     :param xor_key: 异或加密密钥
@@ -316,6 +501,7 @@ def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str,
     item: [input_path: 输入图片路径
             output_dir: 输出图片文件夹
             dst_name: 输出文件名]
+    :param cache_dir: 解密结果缓存文件夹，为空时不使用缓存
     :return:
     """
     if len(file_infos) < 1:
@@ -326,7 +512,7 @@ def batch_decode_image_multiprocessing(xor_key, file_infos: List[Tuple[str, str,
         return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
 
     with ProcessPoolExecutor(max_workers=10) as executor:
-        tasks = [(xor_key, file_path, out_path, file_name) for file_path, out_path, file_name in file_infos]
+        tasks = [(xor_key, file_path, out_path, file_name, cache_dir) for file_path, out_path, file_name in file_infos]
         # print(len(split_list(tasks, 10)), '总任务数', len(file_infos))
         results = list(executor.map(decode_wrapper, tasks, chunksize=200))  # 使用顶层定义的函数
     return results
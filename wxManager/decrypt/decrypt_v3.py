@@ -21,6 +21,7 @@ from concurrent.futures import ProcessPoolExecutor
 from typing import Union, List
 from Crypto.Cipher import AES
 
+from wxManager.decrypt.manifest import incremental_decrypt
 from wxManager.log import logger
 
 SQLITE_FILE_HEADER = "SQLite format 3\x00"  # SQLite文件头
@@ -30,10 +31,57 @@ DEFAULT_PAGESIZE = 4096
 DEFAULT_ITER = 64000
 
 
+RESERVE_SIZE = 48  # 每页末尾的保留段：16字节IV + 20字节HMAC + 12字节空字节
+READ_CHUNK_PAGES = 256  # 流式解密时每次读取的页数（1MB），内存占用与数据库大小无关
+
+
+def derive_key_v3(password: bytes, salt: bytes):
+    """
+    由主密钥和盐值派生出解密密钥和HMAC密钥
+    :param password: 主密钥
+    :param salt: 数据库文件开头的16字节盐值
+    :return: (byteKey, mac_key)
+    """
+    byteKey = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
+    mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
+    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
+    return byteKey, mac_key
+
+
+def check_first_page_v3(mac_key, first_page) -> bool:
+    """
+    校验第一页的HMAC，判断密钥是否正确
+    :param mac_key: HMAC密钥
+    :param first_page: 第一页数据（包含开头的盐值）
+    :return:
+    """
+    first = first_page[16:DEFAULT_PAGESIZE]
+    hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
+    hash_mac.update(b'\x01\x00\x00\x00')
+    return hash_mac.digest() == first[-32:-12]
+
+
+def decrypt_page_v3(byteKey, page, page_index) -> bytes:
+    """
+    解密单个数据库页，输出页与输入页等长
+    :param byteKey: 解密密钥
+    :param page: 加密的页数据（第一页包含开头的盐值）
+    :param page_index: 页号，从0开始
+    :return:
+    """
+    if page_index == 0:
+        page = page[16:]
+    t = AES.new(byteKey, AES.MODE_CBC, page[-RESERVE_SIZE:-32])
+    decrypted = t.decrypt(page[:-RESERVE_SIZE])
+    if page_index == 0:
+        return SQLITE_FILE_HEADER.encode() + decrypted + page[-RESERVE_SIZE:]
+    return decrypted + page[-RESERVE_SIZE:]
+
+
 # 通过密钥解密数据库
 def decrypt_db_file_v3(key: str, db_path, out_path):
     """
-    通过密钥解密数据库
+    通过密钥解密数据库，按块流式读取和写入，内存占用与数据库大小无关
     :param key: 密钥 64位16进制字符串
     :param db_path:  待解密的数据库路径(必须是文件)
     :param out_path:  解密后的数据库输出路径(必须是文件)
@@ -49,40 +97,69 @@ def decrypt_db_file_v3(key: str, db_path, out_path):
 
     password = bytes.fromhex(key.strip())
     try:
-        with open(db_path, "rb") as file:
-            blist = file.read()
+        file = open(db_path, "rb")
     except:
         logger.error(traceback.format_exc())
         logger.info(db_path + '->' + out_path)
         return False, 'error'
-    salt = blist[:16]
-    byteKey = hashlib.pbkdf2_hmac("sha1", password, salt, DEFAULT_ITER, KEY_SIZE)
-    first = blist[16:DEFAULT_PAGESIZE]
-    if len(salt) != 16:
-        return False, f"[-] db_path:'{db_path}' File Error!"
+    with file:
+        first_page = file.read(DEFAULT_PAGESIZE)
+        salt = first_page[:16]
+        if len(salt) != 16:
+            return False, f"[-] db_path:'{db_path}' File Error!"
+        byteKey, mac_key = derive_key_v3(password, salt)
+        if not check_first_page_v3(mac_key, first_page):
+            return False, f"[-] Key Error! (db_path:'{db_path}' )"
+
+        with open(out_path, "wb") as deFile:
+            deFile.write(decrypt_page_v3(byteKey, first_page, 0))
+            page_index = 1
+            while True:
+                chunk = file.read(DEFAULT_PAGESIZE * READ_CHUNK_PAGES)
+                if not chunk:
+                    break
+                view = memoryview(chunk)
+                for i in range(0, len(chunk), DEFAULT_PAGESIZE):
+                    deFile.write(decrypt_page_v3(byteKey, view[i:i + DEFAULT_PAGESIZE], page_index))
+                    page_index += 1
+    return True, [db_path, out_path, key]
 
-    mac_salt = bytes([(salt[i] ^ 58) for i in range(16)])
-    mac_key = hashlib.pbkdf2_hmac("sha1", byteKey, mac_salt, 2, KEY_SIZE)
-    hash_mac = hmac.new(mac_key, first[:-32], hashlib.sha1)
-    hash_mac.update(b'\x01\x00\x00\x00')
 
-    if hash_mac.digest() != first[-32:-12]:
-        return False, f"[-] Key Error! (db_path:'{db_path}' )"
+def _derive_keys(key: str, salt: bytes):
+    return derive_key_v3(bytes.fromhex(key.strip()), salt)
+
 
-    newblist = [blist[i:i + DEFAULT_PAGESIZE] for i in range(DEFAULT_PAGESIZE, len(blist), DEFAULT_PAGESIZE)]
+def _decrypt_page_with_keys(derived_keys, page, page_index):
+    byteKey, mac_key = derived_keys
+    if page_index == 0 and not check_first_page_v3(mac_key, page):
+        return None
+    return decrypt_page_v3(byteKey, page, page_index)
 
-    with open(out_path, "wb") as deFile:
-        deFile.write(SQLITE_FILE_HEADER.encode())
-        t = AES.new(byteKey, AES.MODE_CBC, first[-48:-32])
-        decrypted = t.decrypt(first[:-48])
-        deFile.write(decrypted)
-        deFile.write(first[-48:])
 
-        for i in newblist:
-            t = AES.new(byteKey, AES.MODE_CBC, i[-48:-32])
-            decrypted = t.decrypt(i[:-48])
-            deFile.write(decrypted)
-            deFile.write(i[-48:])
+def decrypt_db_file_v3_incremental(key: str, db_path, out_path):
+    """
+    增量解密：借助输出文件旁的页清单，只解密密文发生变化或新增的页
+    :param key: 密钥 64位16进制字符串
+    :param db_path:  待解密的数据库路径(必须是文件)
+    :param out_path:  解密后的数据库输出路径(必须是文件)
+    :return:
+    """
+    if not os.path.exists(db_path) or not os.path.isfile(db_path):
+        return False, f"[-] db_path:'{db_path}' File not found!"
+    if not os.path.exists(os.path.dirname(out_path)):
+        return False, f"[-] out_path:'{out_path}' File not found!"
+    if len(key) != 64:
+        return False, f"[-] key:'{key}' Len Error!"
+    try:
+        ok, decrypted_pages, total_pages = incremental_decrypt(key, db_path, out_path, DEFAULT_PAGESIZE,
+                                                               _derive_keys, _decrypt_page_with_keys)
+    except:
+        logger.error(traceback.format_exc())
+        logger.info(db_path + '->' + out_path)
+        return False, 'error'
+    if not ok:
+        return False, f"[-] Key Error! (db_path:'{db_path}' )"
+    logger.info(f'增量解密 {decrypted_pages}/{total_pages} 页: {out_path}')
     return True, [db_path, out_path, key]
 
 
@@ -91,7 +168,20 @@ def decode_wrapper(tasks):
     return decrypt_db_file_v3(*tasks)
 
 
-def decrypt_db_files(key, src_dir: str, dest_dir: str):
+def incremental_decode_wrapper(tasks):
+    """用于包装增量解码函数的顶层定义"""
+    return decrypt_db_file_v3_incremental(*tasks)
+
+
+def decrypt_db_files(key, src_dir: str, dest_dir: str, incremental=False):
+    """
+    解密src_dir下的所有数据库
+    :param key: 密钥 64位16进制字符串
+    :param src_dir: 微信数据库文件夹
+    :param dest_dir: 输出文件夹
+    :param incremental: 是否增量解密，只解密上次解密之后发生变化的页
+    :return:
+    """
     if not os.path.exists(src_dir):
         print(f"源文件夹 {src_dir} 不存在")
         return
@@ -116,5 +206,6 @@ def decrypt_db_files(key, src_dir: str, dest_dir: str):
                 print(dest_file_path)
                 decrypt_tasks.append((key, src_file_path, dest_file_path))
                 # decrypt_db_file_v3(key, src_file_path, dest_file_path)
+    wrapper = incremental_decode_wrapper if incremental else decode_wrapper
     with ProcessPoolExecutor(max_workers=16) as executor:
-        results = list(executor.map(decode_wrapper, decrypt_tasks))  # 使用顶层定义的函数
+        results = list(executor.map(wrapper, decrypt_tasks))  # 使用顶层定义的函数
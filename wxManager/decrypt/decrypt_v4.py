@@ -1,12 +1,16 @@
+import hashlib
 import hmac
 import os
 import struct
-from concurrent.futures import ProcessPoolExecutor
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from Crypto.Cipher import AES
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Hash import SHA512
 
+from wxManager.decrypt.manifest import PageManifest, build_manifest, get_key_id, incremental_decrypt
+
 # Constants
 IV_SIZE = 16
 HMAC_SHA256_SIZE = 64
@@ -16,6 +20,56 @@ ROUND_COUNT = 256000
 PAGE_SIZE = 4096
 SALT_SIZE = 16
 SQLITE_HEADER = b"SQLite format 3"
+# 每页末尾保留 IV_SIZE + HMAC_SHA256_SIZE 字节，向上取整为 AES_BLOCK_SIZE 的整数倍
+RESERVE_SIZE = ((IV_SIZE + HMAC_SHA256_SIZE + AES_BLOCK_SIZE - 1) // AES_BLOCK_SIZE) * AES_BLOCK_SIZE
+
+PARALLEL_THRESHOLD = 64 * 1024 * 1024  # 超过该大小的数据库使用多进程分页解密
+PAGES_PER_TASK = 4096  # 每个子任务最多解密的页数（16MB）
+
+
+def derive_key_v4(pkey, salt):
+    """
+    由主密钥和数据库盐值派生出解密密钥和HMAC密钥，每个数据库只需计算一次
+    :param pkey: 密钥 64位16进制字符串
+    :param salt: 数据库文件开头的16字节盐值
+    :return: (key, mac_key)
+    """
+    mac_salt = bytes(x ^ 0x3a for x in salt)
+    passphrase = bytes.fromhex(pkey)
+    key = PBKDF2(passphrase, salt, dkLen=KEY_SIZE, count=ROUND_COUNT, hmac_hash_module=SHA512)
+    mac_key = PBKDF2(key, mac_salt, dkLen=KEY_SIZE, count=2, hmac_hash_module=SHA512)
+    return key, mac_key
+
+
+def decrypt_page_v4(key, mac_key, page, page_index):
+    """
+    解密单个数据库页，输出页与输入页等长，因此可以直接写到输出文件的相同偏移处
+    :param key: 解密密钥
+    :param mac_key: HMAC密钥
+    :param page: 加密的页数据（第一页包含开头的盐值）
+    :param page_index: 页号，从0开始
+    :return: 解密后的页数据，全0页原样返回，HMAC校验失败返回None
+    """
+    if not page.strip(b'\x00'):
+        return page
+    offset = SALT_SIZE if page_index == 0 else 0
+    end = len(page)
+
+    # HMAC校验，页号从1开始计数
+    mac = hmac.new(mac_key, page[offset:end - RESERVE_SIZE + IV_SIZE], hashlib.sha512)
+    mac.update(struct.pack('<I', page_index + 1))
+    hash_mac = mac.digest()
+    hash_mac_start_offset = end - RESERVE_SIZE + IV_SIZE
+    if hash_mac != page[hash_mac_start_offset:hash_mac_start_offset + len(hash_mac)]:
+        return None
+
+    # AES-256-CBC 解密
+    iv = page[end - RESERVE_SIZE:end - RESERVE_SIZE + IV_SIZE]
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    decrypted_data = cipher.decrypt(page[offset:end - RESERVE_SIZE])
+    if page_index == 0:
+        return SQLITE_HEADER + b'\x00' + decrypted_data + page[end - RESERVE_SIZE:end]
+    return decrypted_data + page[end - RESERVE_SIZE:end]
 
 
 def decrypt_db_file_v4(pkey, in_db_path, out_db_path):
@@ -30,27 +84,12 @@ def decrypt_db_file_v4(pkey, in_db_path, out_db_path):
             print("File is empty or corrupted.")
             return False
 
-        mac_salt = bytes(x ^ 0x3a for x in salt)
-
-        # Convert pkey from hex to bytes
-        passphrase = bytes.fromhex(pkey)
-
         # Use PBKDF2 to derive key and mac_key
-        key = PBKDF2(passphrase, salt, dkLen=KEY_SIZE, count=ROUND_COUNT, hmac_hash_module=SHA512)
-        mac_key = PBKDF2(key, mac_salt, dkLen=KEY_SIZE, count=2, hmac_hash_module=SHA512)
-
-        # Write SQLITE_HEADER to the output file
-        f_out.write(SQLITE_HEADER)
-        f_out.write(b'\x00')
-
-        # Reserve space for IV_SIZE + HMAC_SHA256_SIZE, rounded to a multiple of AES_BLOCK_SIZE
-        reserve = IV_SIZE + HMAC_SHA256_SIZE
-        reserve = ((reserve + AES_BLOCK_SIZE - 1) // AES_BLOCK_SIZE) * AES_BLOCK_SIZE
+        key, mac_key = derive_key_v4(pkey, salt)
 
         # Process each page
         cur_page = 0
         while True:
-
             # For the first page, include SALT_SIZE adjustment
             if cur_page == 0:
                 # Read one full PAGE_SIZE starting from after the salt
@@ -62,44 +101,140 @@ def decrypt_db_file_v4(pkey, in_db_path, out_db_path):
                 page = f_in.read(PAGE_SIZE)
             if not page:
                 break  # End of file
-            # print(f'第{cur_page + 1}页')
-            offset = SALT_SIZE if cur_page == 0 else 0
-            end = len(page)
 
             # If the page is all zero bytes, append it directly and exit
-            if all(x == 0 for x in page):
+            if not page.strip(b'\x00'):
                 f_out.write(page)
                 print("Exiting early due to zeroed page.")
                 break
 
-            # Perform HMAC check
-            mac = hmac.new(mac_key, page[offset:end - reserve + IV_SIZE], SHA512)
-            mac.update(struct.pack('<I', cur_page + 1))  # Add page number
-            hash_mac = mac.digest()
-
-            # Check if HMAC matches
-            hash_mac_start_offset = end - reserve + IV_SIZE
-            if hash_mac != page[hash_mac_start_offset:hash_mac_start_offset + len(hash_mac)]:
+            decrypted_page = decrypt_page_v4(key, mac_key, page, cur_page)
+            if decrypted_page is None:
                 print(f'Key error: {key}')
                 return None
-                raise ValueError("Hash verification failed")
+            f_out.write(decrypted_page)
 
-            # AES-256-CBC decryption
-            iv = page[end - reserve:end - reserve + IV_SIZE]
-            cipher = AES.new(key, AES.MODE_CBC, iv)
-            decrypted_data = cipher.decrypt(page[offset:end - reserve])
+            cur_page += 1
 
-            # Remove padding
-            pad_len = decrypted_data[-1]
-            # decrypted_data = decrypted_data[:-pad_len]
+    print("Decryption completed.")
+    return True
 
-            # Write decrypted data and HMAC/IV to output
-            f_out.write(decrypted_data)
-            f_out.write(page[end - reserve:end])
 
-            cur_page += 1
+def _decrypt_page_range(key, mac_key, in_db_path, out_db_path, start_page, end_page):
+    """
+    子进程任务：解密[start_page, end_page)范围内的页，并直接写到预分配输出文件的对应偏移处
+    :return: (已解密的页数, 是否全部校验通过)
+    """
+    with open(in_db_path, 'rb') as f_in, open(out_db_path, 'r+b') as f_out:
+        f_in.seek(start_page * PAGE_SIZE)
+        f_out.seek(start_page * PAGE_SIZE)
+        for page_index in range(start_page, end_page):
+            page = f_in.read(PAGE_SIZE)
+            if not page:
+                break
+            decrypted_page = decrypt_page_v4(key, mac_key, page, page_index)
+            if decrypted_page is None:
+                return page_index - start_page, False
+            f_out.write(decrypted_page)
+    return end_page - start_page, True
 
-    print("Decryption completed.")
+
+def decrypt_db_file_v4_parallel(pkey, in_db_path, out_db_path, max_workers=None, progress_callback=None,
+                                derived_keys=None):
+    """
+    多进程分页解密大数据库：主进程只派生一次密钥，然后把文件切分成若干页区间交给进程池，
+    每个子进程把解密后的页直接写到预分配输出文件的对应偏移处
+    :param pkey: 密钥 64位16进制字符串
+    :param in_db_path: 待解密的数据库路径
+    :param out_db_path: 解密后的数据库输出路径
+    :param max_workers: 进程数，默认为CPU核心数
+    :param progress_callback: 进度回调函数，func(done_pages: int, total_pages: int, pages_per_second: float)
+    :param derived_keys: 已经派生好的(key, mac_key)，为空时根据盐值重新派生
+    :return: True 解密成功，None 密钥错误，False 文件不存在或损坏
+    """
+    if not os.path.exists(in_db_path):
+        print(f"【!!!】{in_db_path} does not exist.")
+        return False
+    file_size = os.path.getsize(in_db_path)
+    with open(in_db_path, 'rb') as f_in:
+        first_page = f_in.read(PAGE_SIZE)
+    if len(first_page) < SALT_SIZE:
+        print("File is empty or corrupted.")
+        return False
+
+    key, mac_key = derived_keys or derive_key_v4(pkey, first_page[:SALT_SIZE])
+    # 先校验第一页，密钥错误时不必启动进程池
+    if first_page.strip(b'\x00') and decrypt_page_v4(key, mac_key, first_page, 0) is None:
+        print(f'Key error: {key}')
+        return None
+
+    # 输出页与输入页等长，预分配与输入文件同样大小的输出文件
+    with open(out_db_path, 'wb') as f_out:
+        f_out.truncate(file_size)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    total_pages = (file_size + PAGE_SIZE - 1) // PAGE_SIZE
+    # 保证每个进程能分到多个任务，进度回调也更平滑
+    pages_per_task = max(256, min(PAGES_PER_TASK, total_pages // (max_workers * 4) + 1))
+    page_ranges = [(start, min(start + pages_per_task, total_pages)) for start in
+                   range(0, total_pages, pages_per_task)]
+
+    st = time.time()
+    done_pages = 0
+    success = True
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_decrypt_page_range, key, mac_key, in_db_path, out_db_path, start, end)
+            for start, end in page_ranges
+        ]
+        for future in as_completed(futures):
+            pages, ok = future.result()
+            done_pages += pages
+            success &= ok
+            if progress_callback:
+                elapsed = time.time() - st
+                progress_callback(done_pages, total_pages, done_pages / elapsed if elapsed > 0 else 0.0)
+
+    if not success:
+        print(f'Key error: {key}')
+        return None
+    print(f"Decryption completed. {total_pages} pages in {time.time() - st:.2f}s")
+    return True
+
+
+def _decrypt_page_with_keys(derived_keys, page, page_index):
+    return decrypt_page_v4(derived_keys[0], derived_keys[1], page, page_index)
+
+
+def decrypt_db_file_v4_incremental(pkey, in_db_path, out_db_path, progress_callback=None):
+    """
+    增量解密：借助输出文件旁的页清单，只解密密文发生变化或新增的页
+    第一次解密大文件时没有清单，走多进程全量解密后再生成清单
+    :return: True 解密成功，None 密钥错误，False 文件不存在或损坏
+    """
+    if not os.path.exists(in_db_path):
+        print(f"【!!!】{in_db_path} does not exist.")
+        return False
+    with open(in_db_path, 'rb') as f_in:
+        salt = f_in.read(SALT_SIZE)
+    if len(salt) != SALT_SIZE:
+        print("File is empty or corrupted.")
+        return False
+    manifest = PageManifest.load(out_db_path)
+    if not (manifest and manifest.matches(PAGE_SIZE, salt, get_key_id(pkey))) and \
+            os.path.getsize(in_db_path) >= PARALLEL_THRESHOLD:
+        derived_keys = derive_key_v4(pkey, salt)
+        ret = decrypt_db_file_v4_parallel(pkey, in_db_path, out_db_path, progress_callback=progress_callback,
+                                          derived_keys=derived_keys)
+        if ret:
+            build_manifest(pkey, in_db_path, out_db_path, PAGE_SIZE, derived_keys)
+        return ret
+    ok, decrypted_pages, total_pages = incremental_decrypt(pkey, in_db_path, out_db_path, PAGE_SIZE, derive_key_v4,
+                                                           _decrypt_page_with_keys)
+    if not ok:
+        print(f'Key error: {in_db_path}')
+        return None
+    print(f"Incremental decryption completed. {decrypted_pages}/{total_pages} pages: {out_db_path}")
     return True
 
 
@@ -108,7 +243,21 @@ def decode_wrapper(tasks):
     return decrypt_db_file_v4(*tasks)
 
 
-def decrypt_db_files(key, src_dir: str, dest_dir: str):
+def incremental_decode_wrapper(tasks):
+    """用于包装增量解码函数的顶层定义"""
+    return decrypt_db_file_v4_incremental(*tasks)
+
+
+def decrypt_db_files(key, src_dir: str, dest_dir: str, progress_callback=None, incremental=False):
+    """
+    解密src_dir下的所有数据库，小文件每个文件一个进程，大文件逐个使用多进程分页解密
+    :param key: 密钥 64位16进制字符串
+    :param src_dir: 微信数据库文件夹
+    :param dest_dir: 输出文件夹
+    :param progress_callback: 大文件解密的进度回调函数，见 decrypt_db_file_v4_parallel
+    :param incremental: 是否增量解密，只解密上次解密之后发生变化的页
+    :return:
+    """
     if not os.path.exists(src_dir):
         print(f"源文件夹 {src_dir} 不存在")
         return
@@ -116,6 +265,7 @@ def decrypt_db_files(key, src_dir: str, dest_dir: str):
     if not os.path.exists(dest_dir):
         os.makedirs(dest_dir)  # 如果目标文件夹不存在，创建它
     decrypt_tasks = []
+    large_tasks = []
     for root, dirs, files in os.walk(src_dir):
         for file in files:
             if file.endswith(".db"):
@@ -131,7 +281,17 @@ def decrypt_db_files(key, src_dir: str, dest_dir: str):
                 if not os.path.exists(dest_sub_dir):
                     os.makedirs(dest_sub_dir)
                 print(dest_file_path)
-                decrypt_tasks.append((key, src_file_path, dest_file_path))
+                if os.path.getsize(src_file_path) >= PARALLEL_THRESHOLD:
+                    large_tasks.append((key, src_file_path, dest_file_path))
+                else:
+                    decrypt_tasks.append((key, src_file_path, dest_file_path))
                 # decrypt_db_file_v4(key, src_file_path, dest_file_path)
+    wrapper = incremental_decode_wrapper if incremental else decode_wrapper
     with ProcessPoolExecutor(max_workers=16) as executor:
-        results = list(executor.map(decode_wrapper, decrypt_tasks))  # 使用顶层定义的函数
+        results = list(executor.map(wrapper, decrypt_tasks))  # 使用顶层定义的函数
+    # 大文件单独处理，避免一个大文件占满一个核心拖慢整体进度
+    for task in large_tasks:
+        if incremental:
+            results.append(decrypt_db_file_v4_incremental(*task, progress_callback=progress_callback))
+        else:
+            results.append(decrypt_db_file_v4_parallel(*task, progress_callback=progress_callback))
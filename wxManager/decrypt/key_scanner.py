@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/15 22:41
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-key_scanner.py
+@Description : 微信4.0数据库密钥的候选扫描和校验，不依赖Windows API，既可以扫描进程内存也可以扫描离线的内存转储文件
+               候选密钥先去重、按熵过滤，再多进程做PBKDF2校验，任意一个进程校验成功后立即终止其它进程
+"""
+import bisect
+import math
+import mmap
+import multiprocessing
+import re
+import struct
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+from wxManager.log import logger
+from wxManager.decrypt.decrypt_v4 import KEY_SIZE, PAGE_SIZE, SALT_SIZE, derive_key_v4, decrypt_page_v4
+
+# 指向密钥的结构体：8字节指针 + 8字节0 + 长度0x20 + 容量0x2f，和wx_info_v4里的yara规则GetKeyAddrStub一致
+KEY_POINTER_PATTERN = re.compile(rb'.{6}\x00{2}\x00{8}\x20\x00{7}\x2f\x00{7}', re.DOTALL)
+MIN_KEY_ENTROPY = 4.0  # 32字节随机数据的香农熵约为4.8比特，低于这个值的基本不可能是密钥
+
+
+def key_entropy(key: bytes) -> float:
+    counter = Counter(key)
+    length = len(key)
+    return -sum(count / length * math.log2(count / length) for count in counter.values())
+
+
+def filter_candidates(candidates: Iterable[bytes]) -> List[bytes]:
+    """
+    去重并去掉明显不是密钥的候选（长度不对、低熵：全0、ASCII字符串、指针之类）
+    :return: 保持原始顺序的候选列表
+    """
+    keys = []
+    key_set = set()
+    for key in candidates:
+        if not key or len(key) != KEY_SIZE or key in key_set:
+            continue
+        key_set.add(key)
+        if key_entropy(key) < MIN_KEY_ENTROPY:
+            continue
+        keys.append(key)
+    return keys
+
+
+def verify_key(key: bytes, buf: bytes) -> bool:
+    """
+    用数据库第一页的HMAC校验密钥
+    :param key: 32字节候选密钥
+    :param buf: 加密数据库的开头（至少一页）
+    """
+    key_, mac_key = derive_key_v4(key.hex(), buf[:SALT_SIZE])
+    first_page = buf[:PAGE_SIZE]
+    if not first_page.strip(b'\x00'):
+        return False
+    return decrypt_page_v4(key_, mac_key, first_page, 0) is not None
+
+
+_found_event = None
+_db_buf = b''
+
+
+def _init_worker(found_event, buf):
+    global _found_event, _db_buf
+    _found_event = found_event
+    _db_buf = buf
+
+
+def _check_candidate(key):
+    # 其它进程已经找到密钥了，剩下的候选直接跳过
+    if _found_event.is_set():
+        return None
+    if verify_key(key, _db_buf):
+        _found_event.set()
+        return key
+    return None
+
+
+def find_valid_key(candidates: Iterable[bytes], buf: bytes, processes=None) -> str | None:
+    """
+    多进程校验候选密钥，找到之后立即终止进程池
+    :param candidates: 候选密钥
+    :param buf: 加密数据库的开头（至少一页）
+    :param processes: 进程数，默认为CPU核数的一半
+    :return: 64位16进制字符串密钥，没找到返回None
+    """
+    keys = filter_candidates(candidates)
+    if not keys:
+        return None
+    buf = bytes(buf[:PAGE_SIZE])
+    processes = min(processes or max(1, multiprocessing.cpu_count() // 2), len(keys))
+    found_event = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes=processes, initializer=_init_worker, initargs=(found_event, buf))
+    try:
+        for key in pool.imap_unordered(_check_candidate, keys):
+            if key:
+                # 密钥本身不写进日志
+                logger.info(f'在{len(keys)}个候选里找到了数据库密钥')
+                return key.hex()
+    finally:
+        # terminate而不是close：正在跑PBKDF2的进程也一起结束
+        pool.terminate()
+        pool.join()
+    return None
+
+
+class MemoryDump:
+    """
+    离线内存转储文件，用mmap访问，不会一次性读入内存
+    regions描述文件里依次存放的内存区域[(base_address, size), ...]，用于把指针换算成文件偏移；
+    为空时把整个文件当作从地址0开始的一块内存
+    """
+
+    def __init__(self, dump_path, regions: List[Tuple[int, int]] = None):
+        self.dump_path = dump_path
+        self.file = open(dump_path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if not regions:
+            regions = [(0, len(self.mm))]
+        self.regions = []  # (base_address, size, file_offset)
+        file_offset = 0
+        for base_address, size in regions:
+            self.regions.append((base_address, size, file_offset))
+            file_offset += size
+        if file_offset > len(self.mm):
+            raise ValueError(f'Memory regions exceed dump size: {dump_path}')
+        self.sorted_regions = sorted(self.regions)
+        self.region_bases = [region[0] for region in self.sorted_regions]
+
+    def iter_regions(self):
+        """依次返回每个区域的(base_address, file_offset, file_end)"""
+        for base_address, size, file_offset in self.regions:
+            yield base_address, file_offset, file_offset + size
+
+    def read(self, address, size) -> bytes:
+        index = bisect.bisect_right(self.region_bases, address) - 1
+        if index < 0:
+            return b''
+        base_address, region_size, file_offset = self.sorted_regions[index]
+        if address + size > base_address + region_size:
+            return b''
+        start = file_offset + address - base_address
+        return self.mm[start:start + size]
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_key_candidates(dump: MemoryDump):
+    """按区域扫描指向密钥的结构体，匹配不会跨越区域边界"""
+    for base_address, start, end in dump.iter_regions():
+        for match in KEY_POINTER_PATTERN.finditer(dump.mm, start, end):
+            pointer = struct.unpack_from('<Q', dump.mm, match.start())[0]
+            key = dump.read(pointer, KEY_SIZE)
+            if key:
+                yield key
+
+
+def scan_dump_for_key(dump_path, buf: bytes, regions: List[Tuple[int, int]] = None, processes=None) -> str | None:
+    """
+    从内存转储文件里找数据库密钥
+    :param dump_path: 内存转储文件路径
+    :param buf: 加密数据库的开头（至少一页），用于校验密钥
+    :param regions: 转储文件里依次存放的内存区域[(base_address, size), ...]
+    :param processes: 校验密钥的进程数
+    :return: 64位16进制字符串密钥，没找到返回None
+    """
+    with MemoryDump(dump_path, regions) as dump:
+        candidates = filter_candidates(iter_key_candidates(dump))
+    return find_valid_key(candidates, buf, processes)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/12 21:16
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-manifest.py
+@Description : 增量解密用的页清单，每个输出数据库旁边保存一份，记录每一页密文的哈希和派生出的密钥，
+               再次解密时只解密发生变化或新增的页并原地写回
+"""
+import hashlib
+import json
+import os
+import struct
+
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_MAGIC = b'WXPM'
+MANIFEST_VERSION = 1
+DIGEST_SIZE = 8  # 每页密文哈希的字节数
+
+
+def page_digest(page) -> bytes:
+    return hashlib.blake2b(page, digest_size=DIGEST_SIZE).digest()
+
+
+def get_key_id(pkey: str) -> str:
+    """清单里只保存主密钥的哈希，用来判断缓存的派生密钥是否还能用"""
+    return hashlib.sha256(pkey.strip().lower().encode('utf-8')).hexdigest()
+
+
+def get_manifest_path(out_db_path):
+    return out_db_path + MANIFEST_SUFFIX
+
+
+class PageManifest:
+    """
+    文件格式：MANIFEST_MAGIC + 4字节头长度 + json头 + 每页DIGEST_SIZE字节的密文哈希
+    """
+
+    def __init__(self, page_size, salt: bytes, key_id: str, derived_keys, digests: bytes = b''):
+        self.page_size = page_size
+        self.salt = salt
+        self.key_id = key_id
+        self.derived_keys = tuple(derived_keys)
+        self.digests = digests
+
+    @property
+    def page_count(self):
+        return len(self.digests) // DIGEST_SIZE
+
+    def digest_at(self, page_index) -> bytes:
+        return self.digests[page_index * DIGEST_SIZE:(page_index + 1) * DIGEST_SIZE]
+
+    def matches(self, page_size, salt: bytes, key_id: str) -> bool:
+        return self.page_size == page_size and self.salt == salt and self.key_id == key_id
+
+    @classmethod
+    def load(cls, out_db_path):
+        manifest_path = get_manifest_path(out_db_path)
+        if not os.path.exists(manifest_path) or not os.path.exists(out_db_path):
+            return None
+        try:
+            with open(manifest_path, 'rb') as f:
+                if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                    return None
+                header_length = struct.unpack('<I', f.read(4))[0]
+                header = json.loads(f.read(header_length).decode('utf-8'))
+                digests = f.read()
+            if header.get('version') != MANIFEST_VERSION:
+                return None
+            manifest = cls(
+                page_size=header['page_size'],
+                salt=bytes.fromhex(header['salt']),
+                key_id=header['key_id'],
+                derived_keys=[bytes.fromhex(k) for k in header['derived_keys']],
+                digests=digests
+            )
+        except:
+            return None
+        # 输出文件被改动过（比如被删了一半）的话清单就不可信了
+        if os.path.getsize(out_db_path) < (manifest.page_count - 1) * manifest.page_size:
+            return None
+        return manifest
+
+    def save(self, out_db_path):
+        header = json.dumps({
+            'version': MANIFEST_VERSION,
+            'page_size': self.page_size,
+            'salt': self.salt.hex(),
+            'key_id': self.key_id,
+            'derived_keys': [k.hex() for k in self.derived_keys],
+        }).encode('utf-8')
+        manifest_path = get_manifest_path(out_db_path)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MANIFEST_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(self.digests)
+        os.replace(tmp_path, manifest_path)
+
+
+def build_manifest(pkey, in_db_path, out_db_path, page_size, derived_keys):
+    """
+    全量解密完成后，根据加密数据库生成清单
+    """
+    digests = bytearray()
+    with open(in_db_path, 'rb') as f_in:
+        salt = f_in.read(16)
+        f_in.seek(0)
+        while True:
+            page = f_in.read(page_size)
+            if not page:
+                break
+            digests += page_digest(page)
+    PageManifest(page_size, salt, get_key_id(pkey), derived_keys, bytes(digests)).save(out_db_path)
+
+
+def incremental_decrypt(pkey, in_db_path, out_db_path, page_size, derive_keys, decrypt_page):
+    """
+    增量解密：只解密与上次相比密文发生变化或者新增的页，并写回输出文件的对应偏移
+    :param pkey: 密钥 64位16进制字符串
+    :param in_db_path: 待解密的数据库路径
+    :param out_db_path: 解密后的数据库输出路径
+    :param page_size: 页大小
+    :param derive_keys: func(pkey, salt) -> tuple[bytes]，派生解密所需的密钥
+    :param decrypt_page: func(derived_keys, page, page_index) -> bytes | None，解密单页，密钥错误返回None
+    :return: (是否成功, 本次解密的页数, 总页数)
+    """
+    with open(in_db_path, 'rb') as f_in:
+        salt = f_in.read(16)
+    if len(salt) != 16:
+        return False, 0, 0
+    key_id = get_key_id(pkey)
+    manifest = PageManifest.load(out_db_path)
+    if manifest and manifest.matches(page_size, salt, key_id):
+        derived_keys = manifest.derived_keys
+        old_count = manifest.page_count
+    else:
+        # 没有清单或者数据库被重建过，全部重新解密
+        manifest = None
+        derived_keys = derive_keys(pkey, salt)
+        old_count = 0
+
+    digests = bytearray()
+    decrypted_pages = 0
+    page_index = 0
+    total_size = 0
+    key_error = False
+    with open(in_db_path, 'rb') as f_in, open(out_db_path, 'r+b' if manifest else 'wb') as f_out:
+        while True:
+            page = f_in.read(page_size)
+            if not page:
+                break
+            digest = page_digest(page)
+            digests += digest
+            total_size += len(page)
+            if page_index < old_count and manifest.digest_at(page_index) == digest:
+                page_index += 1
+                continue
+            decrypted = decrypt_page(derived_keys, page, page_index)
+            if decrypted is None:
+                key_error = True
+                break
+            f_out.seek(page_index * page_size)
+            f_out.write(decrypted)
+            decrypted_pages += 1
+            page_index += 1
+        if not key_error:
+            # 数据库变小了（比如VACUUM之后）
+            f_out.truncate(total_size)
+
+    if key_error:
+        # 输出文件已经不完整了，旧清单作废
+        if os.path.exists(get_manifest_path(out_db_path)):
+            os.remove(get_manifest_path(out_db_path))
+        return False, decrypted_pages, page_index
+    PageManifest(page_size, salt, key_id, derived_keys, bytes(digests)).save(out_db_path)
+    return True, decrypted_pages, page_index
+
+
+if __name__ == '__main__':
+    pass
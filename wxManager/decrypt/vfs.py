@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/13 15:02
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-vfs.py
+@Description : 只读的解密SQLite VFS，SQLite读到哪一页就解密哪一页，不用先把整个数据库解密到硬盘上
+               依赖apsw（pip install apsw），热点页保存在LRU页缓存里
+"""
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+try:
+    import apsw
+except ImportError:
+    apsw = None
+
+from wxManager.decrypt.decrypt_v3 import DEFAULT_PAGESIZE, derive_key_v3, check_first_page_v3, decrypt_page_v3
+from wxManager.decrypt.decrypt_v4 import PAGE_SIZE, SALT_SIZE, derive_key_v4, decrypt_page_v4
+
+SQLITE_FILE_HEADER = b'SQLite format 3\x00'
+DEFAULT_CACHE_PAGES = 4096  # 页缓存默认大小（16MB）
+
+_VFSBase = apsw.VFS if apsw else object
+_VFSFileBase = apsw.VFSFile if apsw else object
+
+
+def is_encrypted_database(db_path) -> bool:
+    """有文件头的是已经解密过的数据库，可以直接用sqlite3打开"""
+    if not os.path.isfile(db_path) or os.path.getsize(db_path) == 0:
+        return False
+    with open(db_path, 'rb') as f:
+        return f.read(len(SQLITE_FILE_HEADER)) != SQLITE_FILE_HEADER
+
+
+class PageCipherV3:
+    page_size = DEFAULT_PAGESIZE
+
+    def __init__(self, key: str, salt: bytes):
+        self.byte_key, self.mac_key = derive_key_v3(bytes.fromhex(key.strip()), salt)
+
+    def decrypt_page(self, page, page_index):
+        if page_index == 0 and not check_first_page_v3(self.mac_key, page):
+            return None
+        return decrypt_page_v3(self.byte_key, page, page_index)
+
+
+class PageCipherV4:
+    page_size = PAGE_SIZE
+
+    def __init__(self, key: str, salt: bytes):
+        self.key, self.mac_key = derive_key_v4(key, salt)
+
+    def decrypt_page(self, page, page_index):
+        return decrypt_page_v4(self.key, self.mac_key, page, page_index)
+
+
+PAGE_CIPHERS = {
+    3: PageCipherV3,
+    4: PageCipherV4,
+}
+
+
+class PageCache:
+    """线程安全的LRU页缓存，多个数据库文件共用"""
+
+    def __init__(self, max_pages=DEFAULT_CACHE_PAGES):
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+
+
+class DecryptVFSFile(_VFSFileBase):
+    def __init__(self, vfs, filename, flags):
+        super().__init__(vfs.basevfs, filename, flags)
+        self.path = filename.filename() if hasattr(filename, 'filename') else filename
+        self.page_cache = vfs.page_cache
+        stat = os.stat(self.path)
+        self.file_size = stat.st_size
+        # 文件被微信改写之后旧缓存自然失效
+        self.cache_token = (self.path, stat.st_mtime_ns, stat.st_size)
+        salt = super().xRead(min(SALT_SIZE, self.file_size), 0)
+        self.cipher = vfs.get_cipher(salt)
+        self.page_size = self.cipher.page_size
+        if self._read_page(0) is None:
+            raise apsw.NotADBError(f'Key error: {self.path}')
+
+    def _read_page(self, page_index):
+        cache_key = (self.cache_token, page_index)
+        page = self.page_cache.get(cache_key)
+        if page is not None:
+            return page
+        offset = page_index * self.page_size
+        amount = min(self.page_size, self.file_size - offset)
+        if amount <= 0:
+            return b''
+        page = self.cipher.decrypt_page(super().xRead(amount, offset), page_index)
+        if page is not None:
+            self.page_cache.put(cache_key, page)
+        return page
+
+    def xRead(self, amount, offset):
+        # SQLite基本按页读取，只有打开时会先读100字节的文件头
+        first_page = offset // self.page_size
+        last_page = (min(offset + amount, self.file_size) - 1) // self.page_size
+        data = bytearray()
+        for page_index in range(first_page, last_page + 1):
+            page = self._read_page(page_index)
+            if page is None:
+                raise apsw.CorruptError(f'HMAC check failed: {self.path} page {page_index}')
+            data += page
+        start = offset - first_page * self.page_size
+        return bytes(data[start:start + amount])
+
+    def xFileSize(self):
+        return self.file_size
+
+    def xWrite(self, data, offset):
+        raise apsw.ReadOnlyError('Encrypted database is read-only')
+
+    def xTruncate(self, newsize):
+        raise apsw.ReadOnlyError('Encrypted database is read-only')
+
+
+class DecryptVFS(_VFSBase):
+    def __init__(self, vfsname, key: str, version=4, cache_pages=DEFAULT_CACHE_PAGES, basevfs=''):
+        if apsw is None:
+            raise ImportError('Decrypting VFS requires apsw, please run: pip install apsw')
+        self.vfsname = vfsname
+        self.basevfs = basevfs
+        self.key = key
+        self.cipher_class = PAGE_CIPHERS[version]
+        self.page_cache = PageCache(cache_pages)
+        # 派生密钥很慢（v4要PBKDF2 256000轮），按盐值缓存
+        self.ciphers = {}
+        self.lock = threading.Lock()
+        super().__init__(self.vfsname, self.basevfs)
+
+    def get_cipher(self, salt: bytes):
+        with self.lock:
+            cipher = self.ciphers.get(salt)
+            if cipher is None:
+                cipher = self.cipher_class(self.key, salt)
+                self.ciphers[salt] = cipher
+            return cipher
+
+    def xOpen(self, name, flags):
+        # 只有主数据库需要解密，临时文件之类的交给默认VFS
+        if name is not None and flags[0] & apsw.SQLITE_OPEN_MAIN_DB:
+            return DecryptVFSFile(self, name, flags)
+        return super().xOpen(name, flags)
+
+
+class EncryptedConnection:
+    """
+    把apsw连接包装成sqlite3连接的样子，数据库类里只用到了cursor、execute、commit、rollback、close
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def execute(self, sql, args=()):
+        return self.connection.cursor().execute(sql, args)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+
+_vfs_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_decrypt_vfs(key: str, version=4, cache_pages=DEFAULT_CACHE_PAGES) -> DecryptVFS:
+    """同一个密钥只注册一个VFS，共用派生密钥和页缓存"""
+    with _registry_lock:
+        vfs = _vfs_registry.get((key, version))
+        if vfs is None:
+            vfs = DecryptVFS(f'wxdecrypt{version}-{len(_vfs_registry)}', key, version, cache_pages)
+            _vfs_registry[(key, version)] = vfs
+        return vfs
+
+
+def open_encrypted_database(db_path, key: str, version=4, cache_pages=DEFAULT_CACHE_PAGES) -> EncryptedConnection:
+    """
+    只读打开加密数据库
+    :param db_path: 微信的加密数据库路径
+    :param key: 密钥 64位16进制字符串
+    :param version: 微信版本，3或4
+    :param cache_pages: 页缓存最多保存的页数
+    :return: 和sqlite3.Connection用法一致的连接
+    """
+    vfs = get_decrypt_vfs(key, version, cache_pages)
+    # immutable=1：微信还开着的时候也不去碰-wal和-journal文件，它们的内容同样是加密的
+    uri = 'file:' + quote(os.path.abspath(db_path).replace('\\', '/'), safe='/:') + '?immutable=1'
+    connection = apsw.Connection(
+        uri,
+        flags=apsw.SQLITE_OPEN_READONLY | apsw.SQLITE_OPEN_URI,
+        vfs=vfs.vfsname
+    )
+    return EncryptedConnection(connection)
+
+
+if __name__ == '__main__':
+    pass
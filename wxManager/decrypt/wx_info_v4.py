@@ -13,7 +13,6 @@ import ctypes
 import multiprocessing
 import os.path
 
-import hmac
 import os
 import struct
 import time
@@ -21,12 +20,11 @@ from ctypes import wintypes
 from multiprocessing import freeze_support
 
 import pymem
-from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Hash import SHA512
 import yara
 
 from wxManager.decrypt.common import WeChatInfo
 from wxManager.decrypt.common import get_version
+from wxManager.decrypt.key_scanner import find_valid_key
 
 # 定义必要的常量
 PROCESS_ALL_ACCESS = 0x1F0FFF
@@ -35,16 +33,7 @@ MEM_COMMIT = 0x1000
 MEM_PRIVATE = 0x20000
 
 # Constants
-IV_SIZE = 16
-HMAC_SHA256_SIZE = 64
-HMAC_SHA512_SIZE = 64
 KEY_SIZE = 32
-AES_BLOCK_SIZE = 16
-ROUND_COUNT = 256000
-PAGE_SIZE = 4096
-SALT_SIZE = 16
-
-finish_flag = False
 
 
 # 定义 MEMORY_BASIC_INFORMATION 结构
@@ -218,71 +207,9 @@ def read_string_from_pid(pid: int, addr: int, size: int):
         return ''
 
 
-def is_ok(passphrase, buf):
-    global finish_flag
-    if finish_flag:
-        return False
-    # 获取文件开头的 salt
-    salt = buf[:SALT_SIZE]
-    # salt 异或 0x3a 得到 mac_salt，用于计算 HMAC
-    mac_salt = bytes(x ^ 0x3a for x in salt)
-    # 使用 PBKDF2 生成新的密钥
-    new_key = PBKDF2(passphrase, salt, dkLen=KEY_SIZE, count=ROUND_COUNT, hmac_hash_module=SHA512)
-    # 使用新的密钥和 mac_salt 计算 mac_key
-    mac_key = PBKDF2(new_key, mac_salt, dkLen=KEY_SIZE, count=2, hmac_hash_module=SHA512)
-    # 计算 hash 校验码的保留空间
-    reserve = IV_SIZE + HMAC_SHA512_SIZE
-    reserve = ((reserve + AES_BLOCK_SIZE - 1) // AES_BLOCK_SIZE) * AES_BLOCK_SIZE
-    # 校验 HMAC
-    start = SALT_SIZE
-    end = PAGE_SIZE
-    mac = hmac.new(mac_key, buf[start:end - reserve + IV_SIZE], SHA512)
-    mac.update(struct.pack('<I', 1))  # page number as 1
-    hash_mac = mac.digest()
-    # 校验 HMAC 是否一致
-    hash_mac_start_offset = end - reserve + IV_SIZE
-    hash_mac_end_offset = hash_mac_start_offset + len(hash_mac)
-    if hash_mac == buf[hash_mac_start_offset:hash_mac_end_offset]:
-        print(f"[v] found key at 0x{start:x}")
-        finish_flag = True
-        return True
-    return False
-
-
-def check_chunk(chunk, buf):
-    global finish_flag
-    if finish_flag:
-        return False
-    if is_ok(chunk, buf):
-        return chunk
-    return False
-
-
-def verify_key(key: bytes, buffer: bytes, flag, result):
-    if len(key) != 32:
-        return False
-    if flag.value:  # 如果其他进程已找到结果，提前退出
-        return False
-    if is_ok(key, buffer):  # 替换为实际的目标检测条件
-        print("Key found!", key)
-        with flag.get_lock():  # 保证线程安全
-            flag.value = True
-            return key
-    else:
-        return False
-
-
 def get_key_(keys, buf):
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count() // 2)
-    results = pool.starmap(check_chunk, ((key, buf) for key in keys))
-    pool.close()
-    pool.join()
-
-    for r in results:
-        if r:
-            print("Key found!", r)
-            return bytes.hex(r)
-    return None
+    # 去重、过滤低熵候选后多进程校验，任意一个进程找到密钥就终止整个进程池
+    return find_valid_key(keys, buf)
 
 
 def get_key_inner(pid, process_infos):
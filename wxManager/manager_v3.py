@@ -9,12 +9,16 @@
 @Description : 
 """
 import concurrent
+import copy
+import heapq
 import os
 import re
+import threading
 import traceback
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import date
-from typing import Tuple, List, Any
+from types import MappingProxyType
+from typing import Tuple, List, Any, Mapping, Iterator
 
 import xmltodict
 
@@ -26,7 +30,7 @@ from wxManager.db_v3.hard_link_image import HardLinkImage
 from wxManager.db_v3.hard_link_video import HardLinkVideo
 
 from wxManager.db_v3.misc import Misc
-from wxManager.db_v3.msg import Msg
+from wxManager.db_v3.msg import Msg, convert_to_timestamp
 from wxManager.db_v3.media_msg import MediaMsg
 from wxManager.db_v3.emotion import Emotion
 from wxManager.db_v3.open_im_contact import OpenIMContactDB
@@ -36,7 +40,9 @@ from wxManager.db_v3.public_msg import PublicMsg
 from wxManager.db_v3.micro_msg import MicroMsg
 from wxManager.db_v3.favorite import Favorite
 from wxManager.log import logger
+from wxManager.model.message_cache import MESSAGE_CACHE_DIR, MessageCache
 from wxManager.model.contact import Contact, Me, ContactType, Person
+from wxManager.model.db_model import DataBaseBase
 from wxManager.parser.file_parser import get_image_type
 from wxManager.parser.util.protocbuf.roomdata_pb2 import ChatRoomData
 from wxManager.parser.wechat_v3 import FACTORY_REGISTRY, parser_sub_type, Singleton
@@ -141,9 +147,11 @@ def decodeExtraBuf(extra_buf_content: bytes):
         }
 
 
-def parser_messages(messages, username, db_dir=''):
-    context = DataBaseV3()
-    context.init_database(db_dir)
+def parser_messages(messages, username, db_dir='', context=None):
+    if context is None:
+        # 多进程里没有现成的数据库实例，需要重新打开
+        context = DataBaseV3()
+        context.init_database(db_dir, read_only=True)
     if username.endswith('@chatroom'):
         contacts = context.get_chatroom_members(username)
     else:
@@ -162,10 +170,26 @@ def parser_messages(messages, username, db_dir=''):
         yield FACTORY_REGISTRY[msg_type].create(message, username, context)
 
 
+_worker_db = None  # 解析进程里的数据库实例
+
+
+def _init_parse_worker(db_dir, encrypt_key, encrypt_version, snapshot_mode, cache_dir, contacts=None):
+    global _worker_db
+    # Windows下子进程是spawn出来的，数据库的类配置要重新设置一遍
+    DataBaseBase.set_encrypt_key(encrypt_key, encrypt_version)
+    DataBaseBase.snapshot_mode = snapshot_mode
+    DataBaseBase.set_cache_dir(cache_dir)
+    _worker_db = DataBaseV3()
+    _worker_db.init_database(db_dir, read_only=True)
+    if contacts is not None:
+        # 直接用主进程读好的联系人表，不再每个进程都查一遍
+        _worker_db.set_contact_table(contacts)
+
+
 def _process_messages_batch(messages_batch, username, db_dir) -> List:
     """Helper function to process a batch of messages."""
     processed = []
-    for message in parser_messages(messages_batch, username, db_dir):
+    for message in parser_messages(messages_batch, username, db_dir, context=_worker_db):
         processed.append(message)
     return processed
 
@@ -177,6 +201,9 @@ class DataBaseV3(DataBaseInterface):
         self.db_dir = None
         self.chatroom_members_map = {}
         self.contacts_map = {}
+        self.contact_table = None  # wxid -> 联系人，只读，第一次查联系人时整表加载
+        self._contact_rows = None  # 加载联系人表过程中的原始数据
+        self.contact_lock = threading.RLock()
 
         self.misc_db = Misc('Misc.db')
         self.msg_db = Msg('Multi/MSG0.db', is_series=True)
@@ -191,8 +218,13 @@ class DataBaseV3(DataBaseInterface):
         self.open_media_db = OpenIMMediaDB('OpenIMMedia.db')
         self.open_msg_db = OpenIMMsgDB('OpenIMMsg.db')
         self.audio2text_db = Audio2TextDB('Audio2Text.db')
+        self.message_cache = None  # 解析结果缓存
 
-    def init_database(self, db_dir=''):
+    def init_database(self, db_dir='', read_only=False):
+        """
+        @param db_dir: 解密后的数据库文件夹
+        @param read_only: 只读取（解析进程用），不创建语音转文字的表
+        """
         # print('初始化数据库', db_dir)
         Me().load_from_json(os.path.join(db_dir, 'info.json'))  # 加载自己的信息
         flag = True
@@ -210,8 +242,9 @@ class DataBaseV3(DataBaseInterface):
         flag &= self.open_media_db.init_database(db_dir)
         flag &= self.open_msg_db.init_database(db_dir)
         flag &= self.audio2text_db.init_database(db_dir)
-        if flag:
+        if flag and not read_only:
             self.audio2text_db.create()  # 初始化语音转文字数据库
+        self.message_cache = MessageCache(os.path.join(DataBaseBase.get_cache_dir(db_dir), MESSAGE_CACHE_DIR))
         return flag
         # self.sns_db.init_database(db_dir)
 
@@ -273,30 +306,100 @@ class DataBaseV3(DataBaseInterface):
         #     for message in self.parser_messages(messages, username_):
         #         res.append(message)
 
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
         # # # Step 1: Retrieve raw message batches
+        cached = None
         if username_.startswith('gh_'):
             messages = self.public_msg_db.get_messages_by_username(username_, time_range)
         elif username_.endswith('@openim'):
             messages = self.open_msg_db.get_messages_by_username(username_, time_range)
         else:
-            messages = self.msg_db.get_messages_by_username(username_, time_range)
+            cached = self._get_cached_messages(username_, time_range)
+            messages = [] if cached is not None else self.msg_db.get_messages_by_username(username_, time_range)
 
+        if cached is not None:
+            res = cached
+        elif messages:
+            res = self._parse_raw_messages(messages, username_)
+
+        et = time.time()
+        logger.error(f'获取聊天记录完成：{et}')
+        logger.error(f'获取聊天记录耗时：{et - st:.2f}s/{len(res)}条消息')
+        res.sort()
+        return res
+
+    def _get_cached_messages(self, username_, time_range=None) -> List | None:
+        """
+        从解析结果缓存里取消息：没变化的历史消息直接用缓存，只解析新增的部分
+        @return: 未排序的消息列表；缓存不可用，或者还没有缓存而且只查一段时间时返回None，由调用方直接查这段时间的消息
+        """
+        if not (self.message_cache and self.message_cache.enabled):
+            return None
+        res = self.message_cache.get_messages(
+            username_, self.msg_db,
+            lambda file_name, start_local_id, end_local_id: self._parse_shard_messages(
+                username_, file_name, start_local_id, end_local_id
+            ),
+            self._message_cache_stamp(),
+            fill=not time_range
+        )
+        if res is not None and time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            res = [message for message in res if start_time < message.timestamp < end_time]
+        return res
+
+    def _message_cache_stamp(self):
+        # 解析结果里带有备注、群昵称和语音转文字，这些数据库变化之后缓存整体作废
+        return tuple(
+            os.path.getmtime(db.db_path) if db.db_path and os.path.exists(db.db_path) else 0
+            for db in (self.micro_msg_db, self.audio2text_db)
+        )
+
+    def _parse_shard_messages(self, username_, file_name, start_local_id, end_local_id) -> List:
+        """
+        解析某个分库里localId在(start_local_id, end_local_id]之间的消息，供解析结果缓存补齐新增消息
+        """
+        return self._parse_raw_messages(
+            self.msg_db.get_messages_by_local_id(username_, file_name, start_local_id, end_local_id), username_
+        )
+
+    def _iter_shard_filling_cache(self, writer, username_, file_name, batch_size) -> Iterator:
+        for messages in self.msg_db.iter_shard_messages(username_, file_name, batch_size):
+            messages = list(parser_messages(messages, username_, self.db_dir, context=self))
+            writer.add(file_name, messages)
+            yield from messages
+
+    def _iter_messages_filling_cache(self, username_, batch_size=1000) -> Iterator:
+        """
+        还没有解析结果缓存时导出全部消息：各分库分批解析之后归并返回，同时把每批追加到对应分库的缓存里，
+        全部返回之后缓存才生效，导出中途取消时丢弃
+        """
+        writer = self.message_cache.writer(username_, self.msg_db, self._message_cache_stamp())
+        try:
+            yield from heapq.merge(*(
+                self._iter_shard_filling_cache(writer, username_, file_name, batch_size)
+                for file_name in writer.watermarks
+            ))
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+
+    def _parse_raw_messages(self, messages, username_) -> List:
+        """解析原始消息，数量多时用多进程"""
+        def split_list(lst, n):
+            k, m = divmod(len(lst), n)
+            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
+
+        res = []
         if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
+            for message in parser_messages(messages, username_, self.db_dir, context=self):
                 res.append(message)
         else:
             raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            #
-            # # Step 2: Use multiprocessing to process the message batches
-            # res = []
-            # for batch in raw_message_batches:
-            #     print(len(batch))
-
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
+            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16), initializer=_init_parse_worker,
+                                     initargs=(self.db_dir, DataBaseBase.encrypt_key, DataBaseBase.encrypt_version,
+                                               DataBaseBase.snapshot_mode, DataBaseBase.cache_dir,
+                                               dict(self.get_contact_table()))) as executor:
                 # Submit tasks
                 future_to_batch = {
                     executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
@@ -306,13 +409,56 @@ class DataBaseV3(DataBaseInterface):
                 # Collect results
                 for future in future_to_batch.keys():
                     res.extend(future.result())
-
-        et = time.time()
-        logger.error(f'获取聊天记录完成：{et}')
-        logger.error(f'获取聊天记录耗时：{et - st:.2f}s/{len(res)}条消息')
-        res.sort()
         return res
 
+    def iter_messages(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size=1000
+    ):
+        """
+        按时间顺序逐条返回解析好的聊天记录，数据库按批读取，不会一次性把所有消息读进内存
+        @param username_:
+        @param time_range:
+        @param batch_size: 每次从数据库读取的消息数
+        @return: 生成器
+        """
+        if username_.startswith('gh_'):
+            batches = self.public_msg_db.iter_messages(username_, time_range, batch_size)
+        elif username_.endswith('@openim'):
+            batches = self.open_msg_db.iter_messages(username_, time_range, batch_size)
+        else:
+            if self.message_cache and self.message_cache.enabled:
+                shards = self.message_cache.refresh(
+                    username_, self.msg_db, self._parse_shard_messages, self._message_cache_stamp(), fill=False
+                )
+                if shards is not None:
+                    # 同一个联系人反复导出时直接用缓存，各分库逐段读取之后归并
+                    messages = self.message_cache.iter_cached(username_, shards)
+                    if time_range:
+                        start_time, end_time = convert_to_timestamp(time_range)
+                        messages = (message for message in messages if start_time < message.timestamp < end_time)
+                    yield from messages
+                    return
+                if not time_range:
+                    yield from self._iter_messages_filling_cache(username_, batch_size)
+                    return
+            batches = self.msg_db.iter_messages(username_, time_range, batch_size)
+        for messages in batches:
+            yield from parser_messages(messages, username_, self.db_dir, context=self)
+
+    def get_messages_number(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        if username_.startswith('gh_'):
+            return self.public_msg_db.get_messages_number(username_, time_range)
+        elif username_.endswith('@openim'):
+            return self.open_msg_db.get_messages_number(username_, time_range)
+        return self.msg_db.get_messages_number(username_, time_range)
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -329,7 +475,7 @@ class DataBaseV3(DataBaseInterface):
             messages = self.msg_db.get_messages_by_num(username, start_sort_seq, msg_num)
         result = []
         for messages_ in messages:
-            for message in parser_messages(messages_, username, self.db_dir):
+            for message in parser_messages(messages_, username, self.db_dir, context=self):
                 result.append(message)
         result.sort(reverse=True)
         res = result[:msg_num]
@@ -344,7 +490,7 @@ class DataBaseV3(DataBaseInterface):
         """
         message = self.msg_db.get_message_by_server_id(username, server_id)
         if message:
-            messages_iter = parser_messages([message], username, self.db_dir)
+            messages_iter = parser_messages([message], username, self.db_dir, context=self)
             return next(messages_iter)
         return None
 
@@ -374,11 +520,14 @@ class DataBaseV3(DataBaseInterface):
             messages = self.msg_db.get_messages_by_type(username_, type_, time_range)
 
         if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
+            for message in parser_messages(messages, username_, self.db_dir, context=self):
                 res.append(message)
         else:
             raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
+            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16), initializer=_init_parse_worker,
+                                     initargs=(self.db_dir, DataBaseBase.encrypt_key, DataBaseBase.encrypt_version,
+                                               DataBaseBase.snapshot_mode, DataBaseBase.cache_dir,
+                                               dict(self.get_contact_table()))) as executor:
                 # Submit tasks
                 future_to_batch = {
                     executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
@@ -435,6 +584,12 @@ class DataBaseV3(DataBaseInterface):
         else:
             return self.media_msg_db.get_media_buffer(server_id)
 
+    def iter_media_buffers(self, server_ids, is_open_im=False) -> Iterator[Tuple[int, bytes]]:
+        if is_open_im:
+            return self.open_media_db.iter_media_buffers(server_ids)
+        else:
+            return self.media_msg_db.iter_media_buffers(server_ids)
+
     def get_audio(self, reserved0, output_path, open_im=False, filename=''):
         if open_im:
             pass
@@ -578,6 +733,11 @@ class DataBaseV3(DataBaseInterface):
     def set_remark(self, username: str, remark) -> bool:
         if username in self.contacts_map:
             self.contacts_map[username].remark = remark
+        with self.contact_lock:
+            if self.contact_table is not None and username in self.contact_table and remark:
+                contact = copy.copy(self.contact_table[username])
+                contact.remark = remark
+                self.contact_table = MappingProxyType({**self.contact_table, username: contact})
         if username.endswith('@openim'):
             return self.open_contact_db.set_remark(username, remark)
         else:
@@ -586,27 +746,52 @@ class DataBaseV3(DataBaseInterface):
     def set_avatar_buffer(self, username, avatar_path):
         return self.misc_db.set_avatar_buffer(username, avatar_path)
 
+    def get_contact_table(self) -> Mapping[str, Person]:
+        """
+        所有联系人（包括陌生人、群成员和企业微信联系人）的只读字典，第一次调用时一次性读出整张联系人表，
+        之后解析消息、获取群成员都不再逐个查询数据库
+        @return: {wxid: 联系人}
+        """
+        if self.contact_table is None:
+            with self.contact_lock:
+                if self.contact_table is None:
+                    self._contact_rows = {row[0]: row for row in self.micro_msg_db.get_all_contacts()}
+                    self._contact_rows.update({row[0]: row for row in self.open_contact_db.get_all_contacts()})
+                    try:
+                        table = {wxid: self._create_contact(row) for wxid, row in self._contact_rows.items()}
+                    finally:
+                        self._contact_rows = None
+                    self.contact_table = MappingProxyType(table)
+        return self.contact_table
+
+    def set_contact_table(self, contacts: Mapping[str, Person]):
+        """
+        直接使用已经加载好的联系人表（解析进程用）
+        @param contacts: {wxid: 联系人}
+        """
+        self.contact_table = MappingProxyType(dict(contacts))
+
+    def _create_contact(self, contact_info_list) -> Person:
+        if contact_info_list[0].endswith('@openim'):
+            return self.create_open_im_contact(contact_info_list)
+        return self.create_contact(contact_info_list)
+
     def get_contact_by_username(self, wxid: str) -> Contact:
-        if wxid.endswith('@openim'):
-            contact_info_list = self.open_contact_db.get_contact_by_username(wxid)
-            if contact_info_list:
-                contact = self.create_open_im_contact(contact_info_list)
-            else:
-                contact = Contact(
-                    wxid=wxid,
-                    nickname=wxid,
-                    remark=wxid
-                )
+        rows = self._contact_rows
+        if rows is not None and self.contact_table is None:
+            # 正在加载联系人表，没有昵称的群聊要用群成员拼群名称
+            contact_info_list = rows.get(wxid)
+            contact = self._create_contact(contact_info_list) if contact_info_list else None
         else:
-            contact_info_list = self.micro_msg_db.get_contact_by_username(wxid)
-            if contact_info_list:
-                contact = self.create_contact(contact_info_list)
-            else:
-                contact = Contact(
-                    wxid=wxid,
-                    nickname=wxid,
-                    remark=wxid
-                )
+            contact = self.get_contact_table().get(wxid)
+        if contact:
+            # 返回副本，调用方修改备注（例如换成群昵称）不影响共享的联系人表
+            return copy.copy(contact)
+        contact = Contact(
+            wxid=wxid,
+            nickname=wxid,
+            remark=wxid
+        )
         return contact
 
     def get_chatroom_members(self, chatroom_name) -> dict[Any, Contact] | Any:
@@ -696,3 +881,6 @@ class DataBaseV3(DataBaseInterface):
                     print(f"成功合并数据库: {path}")
                 except Exception as e:
                     print(f"合并 {path} 失败: {e}")
+
+        with self.contact_lock:
+            self.contact_table = None  # 合并了新的联系人，下次使用时重新加载
@@ -9,14 +9,18 @@
 @Description : 
 """
 import concurrent
+import copy
 import os
 import re
+import threading
+import traceback
+from collections import deque
 from concurrent.futures import ProcessPoolExecutor, as_completed, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date, datetime
 from multiprocessing import Pool, cpu_count
-from typing import Tuple, List, Any
-
-import zstandard as zstd
+from types import MappingProxyType
+from typing import Tuple, List, Any, Mapping, Iterator
 
 from wxManager import MessageType
 from wxManager.db_v4.audio2text import Audio2TextDB
@@ -24,32 +28,46 @@ from wxManager.db_v4.biz_message import BizMessageDB
 from wxManager.db_v4.emotion import EmotionDB
 from wxManager.db_v4.media import MediaDB
 from wxManager.db_v4 import ContactDB, HeadImageDB, SessionDB, MessageDB, HardLinkDB
+from wxManager.db_v4.fts_index import context_window
+from wxManager.db_v4.message import convert_to_timestamp
 from wxManager.db_main import DataBaseInterface, Context
 from wxManager.model.contact import Contact, ContactType, Person
 from wxManager.model import Me
+from wxManager.model.db_model import DataBaseBase
+from wxManager.model.message_cache import MESSAGE_CACHE_DIR, MessageCache
 from wxManager.parser.util.protocbuf.roomdata_pb2 import ChatRoomData
 from wxManager.parser.wechat_v4 import FACTORY_REGISTRY, Singleton
+from wxManager.parser.util import zstd_service
 from wxManager.log import logger
 from wxManager.parser.util.protocbuf import contact_pb2
 from google.protobuf.json_format import MessageToDict
 
 
 def decompress(data):
-    dctx = zstd.ZstdDecompressor()  # 创建解压对象
-    x = dctx.decompress(data)
-    return x.decode('utf-8')
+    return zstd_service.decompress(data).decode('utf-8')
+
 
+PARSE_BATCH_SIZE = 10000  # 多进程解析时每个任务的消息数
+PARSE_PROCESS_THRESHOLD = 20000  # 消息数超过这个值才用多进程解析
+PARSE_PREFETCH = min(cpu_count(), 16)  # 流式导出时最多同时在进程池里解析的区间数，和进程池大小一致
 
-def parser_messages(messages, username, db_dir=''):
-    context = DataBaseV4()
-    context.init_database(db_dir)
+
+def _load_contacts(context, username):
     if username.endswith('@chatroom'):
-        contacts = context.get_chatroom_members(username)
-    else:
-        contacts = {
-            Me().wxid: context.get_contact_by_username(Me().wxid),
-            username: context.get_contact_by_username(username)
-        }
+        return context.get_chatroom_members(username)
+    return {
+        Me().wxid: context.get_contact_by_username(Me().wxid),
+        username: context.get_contact_by_username(username)
+    }
+
+
+def parser_messages(messages, username, db_dir='', context=None, contacts=None):
+    if context is None:
+        # 没有现成的数据库实例，需要重新打开
+        context = DataBaseV4()
+        context.init_database(db_dir)
+    if contacts is None:
+        contacts = _load_contacts(context, username)
     # FACTORY_REGISTRY[-1].set_contacts(contacts) # 不知道为什么用对象修改类属性每个实例对象的contacts不一样
     Singleton.set_contacts(contacts)
 
@@ -60,12 +78,67 @@ def parser_messages(messages, username, db_dir=''):
         yield FACTORY_REGISTRY[type_].create(message, username, context)
 
 
-def _process_messages_batch(messages_batch, username, db_dir) -> List:
-    """Helper function to process a batch of messages."""
-    processed = []
-    for message in parser_messages(messages_batch, username, db_dir):
-        processed.append(message)
-    return processed
+# 解析进程池：进程常驻，每个进程只在启动时打开一次数据库，联系人和群成员也缓存在进程里
+_parse_pool = None
+_parse_pool_db_dir = ''
+_parse_pool_lock = threading.Lock()
+
+# 以下是解析进程里的全局变量
+_worker_db = None
+_worker_contacts = {}
+
+
+def _init_parse_worker(db_dir, encrypt_key, encrypt_version, snapshot_mode, cache_dir, contacts=None):
+    global _worker_db
+    # Windows下子进程是spawn出来的，数据库的类配置要重新设置一遍
+    DataBaseBase.set_encrypt_key(encrypt_key, encrypt_version)
+    DataBaseBase.snapshot_mode = snapshot_mode
+    DataBaseBase.set_cache_dir(cache_dir)
+    _worker_db = DataBaseV4()
+    _worker_db.init_database(db_dir)
+    if contacts is not None:
+        # 直接用主进程读好的联系人表，不再每个进程都查一遍
+        _worker_db.set_contact_table(contacts)
+
+
+def _parse_messages_range(username, file_name, start_sort_seq, end_sort_seq, time_range=None, type_=None) -> List:
+    """在解析进程里按分库和sort_seq区间读取并解析消息，主进程只需要传区间，不用传原始数据"""
+    db = _worker_db.biz_message_db if username.startswith('gh_') else _worker_db.message_db
+    messages = db.get_messages_by_range(username, file_name, start_sort_seq, end_sort_seq, time_range, type_)
+    contacts = _worker_contacts.get(username)
+    if contacts is None:
+        contacts = _worker_contacts[username] = _load_contacts(_worker_db, username)
+    return list(parser_messages(messages, username, context=_worker_db, contacts=contacts))
+
+
+def get_parse_pool(db_dir, contacts: Mapping[str, Person] = None) -> ProcessPoolExecutor:
+    """
+    获取常驻的解析进程池，数据库目录变化时重建
+    @param db_dir: 解密后的数据库文件夹
+    @param contacts: 联系人表，创建进程池时传给每个解析进程
+    """
+    global _parse_pool, _parse_pool_db_dir
+    with _parse_pool_lock:
+        if _parse_pool is None or _parse_pool_db_dir != db_dir:
+            if _parse_pool is not None:
+                _parse_pool.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=min(cpu_count(), 16),
+                initializer=_init_parse_worker,
+                initargs=(db_dir, DataBaseBase.encrypt_key, DataBaseBase.encrypt_version, DataBaseBase.snapshot_mode,
+                          DataBaseBase.cache_dir, dict(contacts) if contacts is not None else None)
+            )
+            _parse_pool_db_dir = db_dir
+        return _parse_pool
+
+
+def shutdown_parse_pool():
+    global _parse_pool, _parse_pool_db_dir
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+        _parse_pool_db_dir = ''
 
 
 class DataBaseV4(DataBaseInterface):
@@ -74,6 +147,9 @@ class DataBaseV4(DataBaseInterface):
         self.db_dir = ''
         self.chatroom_members_map = {}
         self.contacts_map = {}
+        self.contact_table = None  # wxid -> 联系人，只读，第一次查联系人时整表加载
+        self._contact_rows = None  # 加载联系人表过程中的原始数据
+        self.contact_lock = threading.RLock()
 
         # V4
         self.contact_db = ContactDB('contact/contact.db')
@@ -85,6 +161,7 @@ class DataBaseV4(DataBaseInterface):
         self.hardlink_db = HardLinkDB('hardlink/hardlink.db')
         self.emotion_db = EmotionDB('emoticon/emoticon.db')
         self.audio2text_db = Audio2TextDB('Audio2Text.db')
+        self.message_cache = None  # 解析结果缓存
 
     def init_database(self, db_dir=''):
         Me().load_from_json(os.path.join(db_dir, 'info.json'))  # 加载自己的信息
@@ -102,10 +179,11 @@ class DataBaseV4(DataBaseInterface):
         flag &= self.audio2text_db.init_database(db_dir)
         if flag:
             self.audio2text_db.create()  # 初始化语音转文字数据库
+        self.message_cache = MessageCache(os.path.join(DataBaseBase.get_cache_dir(db_dir), MESSAGE_CACHE_DIR))
         return flag
 
     def close(self):
-        pass
+        shutdown_parse_pool()
 
         # self.head_image_db.close()
         # self.contact_db.close()
@@ -134,38 +212,16 @@ class DataBaseV4(DataBaseInterface):
         #     for message in parser_messages(messages_, username_, self.db_dir):
         #         res.append(message)
 
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
-        #
-        # # # Step 1: Retrieve raw message batches
-        if username_.startswith('gh_'):
-            messages = self.biz_message_db.get_messages_by_username(username_, time_range)
-        else:
-            messages = self.message_db.get_messages_by_username(username_, time_range)
-
-        if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
+        db = self.biz_message_db if username_.startswith('gh_') else self.message_db
+        cached = self._get_cached_messages(db, username_, time_range)
+        if cached is not None:
+            res = cached
+        elif db.get_messages_number(username_, time_range) < PARSE_PROCESS_THRESHOLD:
+            messages = db.get_messages_by_username(username_, time_range)
+            for message in parser_messages(messages, username_, self.db_dir, context=self):
                 res.append(message)
         else:
-            raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            #
-            # # Step 2: Use multiprocessing to process the message batches
-            # res = []
-            # for batch in raw_message_batches:
-            #     print(len(batch))
-
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
-                # Submit tasks
-                future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
-                    for batch in raw_message_batches
-                }
-
-                # Collect results
-                for future in future_to_batch.keys():
-                    res.extend(future.result())
+            res = self._parse_messages_in_pool(db, username_, time_range)
 
         et = time.time()
         logger.error(f'获取聊天记录完成：{et}')
@@ -173,6 +229,187 @@ class DataBaseV4(DataBaseInterface):
         res.sort()
         return res
 
+    def _get_cached_messages(self, db, username_, time_range=None) -> List | None:
+        """
+        从解析结果缓存里取消息：没变化的历史消息直接用缓存，只解析新增的部分
+        @return: 未排序的消息列表；缓存不可用，或者还没有缓存而且只查一段时间时返回None，由调用方直接查这段时间的消息
+        """
+        if not (self.message_cache and self.message_cache.enabled):
+            return None
+        res = self.message_cache.get_messages(
+            username_, db,
+            lambda file_name, start_local_id, end_local_id: self._parse_shard_messages(
+                db, username_, file_name, start_local_id, end_local_id
+            ),
+            self._message_cache_stamp(),
+            fill=not time_range
+        )
+        if res is not None and time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            res = [message for message in res if start_time < message.timestamp < end_time]
+        return res
+
+    def _message_cache_stamp(self):
+        # 解析结果里带有备注、群昵称和语音转文字，这些数据库变化之后缓存整体作废
+        return tuple(
+            os.path.getmtime(db.db_path) if db.db_path and os.path.exists(db.db_path) else 0
+            for db in (self.contact_db, self.audio2text_db)
+        )
+
+    def _parse_shard_messages(self, db, username_, file_name, start_local_id, end_local_id) -> List:
+        """
+        解析某个分库里local_id在(start_local_id, end_local_id]之间的消息，供解析结果缓存补齐新增消息
+        """
+        if start_local_id == 0 and end_local_id > PARSE_PROCESS_THRESHOLD:
+            # 第一次缓存大量消息，交给解析进程池
+            ranges = [item for item in db.get_sort_seq_ranges(username_, None, PARSE_BATCH_SIZE) if item[0] == file_name]
+            return [
+                message for message in self._parse_messages_in_pool(db, username_, ranges=ranges)
+                if message.local_id <= end_local_id
+            ]
+        messages = db.get_messages_by_local_id(username_, file_name, start_local_id, end_local_id)
+        return list(parser_messages(messages, username_, self.db_dir, context=self))
+
+    def _parse_messages_in_pool(self, db, username_, time_range=None, type_=None, ranges=None) -> List:
+        """
+        用常驻进程池解析大量消息，每个任务只传分库名和sort_seq区间，由解析进程自己读取数据库
+        """
+        if ranges is None:
+            ranges = db.get_sort_seq_ranges(username_, time_range, PARSE_BATCH_SIZE, type_)
+        res = []
+        try:
+            pool = get_parse_pool(self.db_dir, self.get_contact_table())
+            futures = [
+                pool.submit(_parse_messages_range, username_, file_name, start_sort_seq, end_sort_seq, time_range, type_)
+                for file_name, start_sort_seq, end_sort_seq in ranges
+            ]
+            for future in futures:
+                res.extend(future.result())
+        except BrokenProcessPool:
+            # 解析进程异常退出，重建进程池留给下一次，这一次在当前进程里解析
+            logger.error(traceback.format_exc())
+            shutdown_parse_pool()
+            res = []
+            for file_name, start_sort_seq, end_sort_seq in ranges:
+                messages = db.get_messages_by_range(username_, file_name, start_sort_seq, end_sort_seq, time_range, type_)
+                res.extend(parser_messages(messages, username_, self.db_dir, context=self))
+        return res
+
+    def _iter_messages_in_pool(self, db, username_, time_range=None) -> Iterator:
+        """
+        和_parse_messages_in_pool一样交给常驻进程池解析，但按sort_seq顺序逐个区间返回，
+        同时最多只有PARSE_PREFETCH个区间在解析，导出大量消息时内存里只有这几个区间的结果
+        """
+        for _, messages in self._iter_ranges_in_pool(db, username_, time_range):
+            yield from messages
+
+    def _iter_ranges_in_pool(self, db, username_, time_range=None, ranges=None) -> Iterator[Tuple[str, List]]:
+        """
+        见_iter_messages_in_pool
+        @return: 生成器，每次返回(分库文件名, 这个区间解析好的消息)
+        """
+        if ranges is None:
+            ranges = sorted(db.get_sort_seq_ranges(username_, time_range, PARSE_BATCH_SIZE), key=lambda item: item[1])
+        pending = deque()
+        done = 0  # 已经返回的区间数
+        try:
+            pool = get_parse_pool(self.db_dir, self.get_contact_table())
+            while done < len(ranges):
+                while done + len(pending) < len(ranges) and len(pending) < PARSE_PREFETCH:
+                    file_name, start_sort_seq, end_sort_seq = ranges[done + len(pending)]
+                    pending.append(
+                        pool.submit(_parse_messages_range, username_, file_name, start_sort_seq, end_sort_seq, time_range)
+                    )
+                messages = pending.popleft().result()
+                done += 1
+                yield ranges[done - 1][0], messages
+        except BrokenProcessPool:
+            # 解析进程异常退出，重建进程池留给下一次，剩下的区间在当前进程里解析
+            logger.error(traceback.format_exc())
+            shutdown_parse_pool()
+            yield from self._iter_ranges(db, username_, ranges[done:], time_range)
+        finally:
+            # 导出中途取消时，还没开始的区间不再解析
+            for future in pending:
+                future.cancel()
+
+    def _iter_ranges(self, db, username_, ranges, time_range=None) -> Iterator[Tuple[str, List]]:
+        """
+        在当前进程里逐个区间解析
+        @return: 生成器，每次返回(分库文件名, 这个区间解析好的消息)
+        """
+        for file_name, start_sort_seq, end_sort_seq in ranges:
+            messages = db.get_messages_by_range(username_, file_name, start_sort_seq, end_sort_seq, time_range)
+            yield file_name, list(parser_messages(messages, username_, self.db_dir, context=self))
+
+    def _iter_messages_filling_cache(self, db, username_) -> Iterator:
+        """
+        还没有解析结果缓存时导出全部消息：逐个区间解析、返回，同时把每个区间追加到对应分库的缓存里，
+        全部返回之后缓存才生效，导出中途取消时丢弃
+        """
+        writer = self.message_cache.writer(username_, db, self._message_cache_stamp())
+        ranges = sorted(db.get_sort_seq_ranges(username_, None, PARSE_BATCH_SIZE), key=lambda item: item[1])
+        if db.get_messages_number(username_) >= PARSE_PROCESS_THRESHOLD:
+            batches = self._iter_ranges_in_pool(db, username_, ranges=ranges)
+        else:
+            batches = self._iter_ranges(db, username_, ranges)
+        try:
+            for file_name, messages in batches:
+                writer.add(file_name, messages)
+                yield from messages
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+
+    def iter_messages(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size=1000
+    ):
+        """
+        按时间顺序逐条返回解析好的聊天记录，数据库按批读取，不会一次性把所有消息读进内存
+        @param username_:
+        @param time_range:
+        @param batch_size: 每次从数据库读取的消息数
+        @return: 生成器
+        """
+        db = self.biz_message_db if username_.startswith('gh_') else self.message_db
+        if self.message_cache and self.message_cache.enabled:
+            shards = self.message_cache.refresh(
+                username_, db,
+                lambda file_name, start_local_id, end_local_id: self._parse_shard_messages(
+                    db, username_, file_name, start_local_id, end_local_id
+                ),
+                self._message_cache_stamp(),
+                fill=False
+            )
+            if shards is not None:
+                # 同一个联系人反复导出时直接用缓存，各分库逐段读取之后归并
+                messages = self.message_cache.iter_cached(username_, shards)
+                if time_range:
+                    start_time, end_time = convert_to_timestamp(time_range)
+                    messages = (message for message in messages if start_time < message.timestamp < end_time)
+                yield from messages
+                return
+            if not time_range:
+                yield from self._iter_messages_filling_cache(db, username_)
+                return
+        if db.get_messages_number(username_, time_range) >= PARSE_PROCESS_THRESHOLD:
+            yield from self._iter_messages_in_pool(db, username_, time_range)
+            return
+        for messages in db.iter_messages(username_, time_range, batch_size):
+            yield from parser_messages(messages, username_, self.db_dir, context=self)
+
+    def get_messages_number(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        db = self.biz_message_db if username_.startswith('gh_') else self.message_db
+        return db.get_messages_number(username_, time_range)
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -187,7 +424,7 @@ class DataBaseV4(DataBaseInterface):
         else:
             messages = self.message_db.get_messages_by_num(username, start_sort_seq, msg_num)
         for messages in messages:
-            for message in parser_messages(messages, username, self.db_dir):
+            for message in parser_messages(messages, username, self.db_dir, context=self):
                 result.append(message)
         result.sort(reverse=True)
         res = result[:msg_num]
@@ -202,8 +439,9 @@ class DataBaseV4(DataBaseInterface):
         """
         message = self.message_db.get_message_by_server_id(username, server_id)
         if message:
-            messages_iter = parser_messages([message], username, self.db_dir)
-            return next(messages_iter)
+            # 引用消息解析时会频繁调用，直接用当前实例解析，不再重新初始化一遍数据库
+            type_ = message[2] if message[2] in FACTORY_REGISTRY else -1
+            return FACTORY_REGISTRY[type_].create(message, username, self)
         return None
 
     def get_messages_by_type(
@@ -212,39 +450,95 @@ class DataBaseV4(DataBaseInterface):
             type_: MessageType,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
     ):
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
         res = []
-        # # # Step 1: Retrieve raw message batches
-        if username_.startswith('gh_'):
-            messages = self.biz_message_db.get_messages_by_type(username_, time_range)
-        else:
-            messages = self.message_db.get_messages_by_type(username_, type_, time_range)
-
-        if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
+        db = self.biz_message_db if username_.startswith('gh_') else self.message_db
+        ranges = db.get_sort_seq_ranges(username_, time_range, PARSE_BATCH_SIZE, type_)
+        if len(ranges) * PARSE_BATCH_SIZE <= PARSE_PROCESS_THRESHOLD:
+            messages = db.get_messages_by_type(username_, type_, time_range)
+            for message in parser_messages(messages, username_, self.db_dir, context=self):
                 res.append(message)
         else:
-            raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
-                # Submit tasks
-                future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
-                    for batch in raw_message_batches
-                }
-                # Collect results
-                for future in future_to_batch.keys():
-                    res.extend(future.result())
+            res = self._parse_messages_in_pool(db, username_, time_range, type_, ranges)
         res.sort()
         return res
 
+    def get_messages_by_keyword(self, username_, keyword, num=5, max_len=10, time_range=None, year_='all'):
+        """
+        全文搜索聊天记录（只搜索文本消息），第一次调用时建立全文索引，之后增量更新
+        @param username_: 联系人wxid，为空时搜索所有联系人
+        @param keyword: 关键词
+        @param num: 最多返回条数
+        @param max_len: 关键词前后各保留的字符数
+        @param time_range:
+        @param year_: 只搜某一年，'all'表示不限
+        @return: [(消息, 关键词前后的文本), ...]，按相关度排序
+        """
+        if not time_range and year_ != 'all':
+            time_range = (f'{year_}-01-01 00:00:00', f'{int(year_) + 1}-01-01 00:00:00')
+        hits = self.message_db.search_messages(keyword, username_, num, time_range)
+        res = []
+        if hits is None:
+            # 全文索引不可用，只能逐条解压查找
+            if not username_:
+                return res
+            for message in self.iter_messages(username_, time_range):
+                if message.type == MessageType.Text and keyword in message.to_text():
+                    res.append((message, context_window(message.to_text(), keyword, max_len)))
+                    if len(res) >= num:
+                        break
+            return res
+        for username, raw_message, content in hits:
+            message = next(parser_messages([raw_message], username, self.db_dir, context=self))
+            res.append((message, context_window(content, keyword, max_len)))
+        return res
+
+    # 统计分析都查预聚合的统计表（message/stats_cube.db），第一次调用时建表，之后增量更新
+    @staticmethod
+    def _stats_time_range(time_range, year_='all') -> Tuple[int, int]:
+        if not time_range and year_ != 'all':
+            time_range = (f'{year_}-01-01 00:00:00', f'{int(year_) + 1}-01-01 00:00:00')
+        return convert_to_timestamp(time_range)
+
+    def _count_by(self, group_by, username_='', sender='', time_range=None, year_='all') -> list:
+        stats_cube = self.message_db.get_stats_cube()
+        if not stats_cube:
+            return []
+        start_time, end_time = self._stats_time_range(time_range, year_)
+        return stats_cube.count_by(group_by, username_, sender, None, start_time, end_time)
+
     def get_messages_calendar(self, username_: str):
         if username_.startswith('gh_'):
             return self.biz_message_db.get_messages_calendar(username_)
-        else:
+        stats_cube = self.message_db.get_stats_cube()
+        if not stats_cube:
             return self.message_db.get_messages_calendar(username_)
+        return [day for day, _ in stats_cube.count_by('day', username_)]
+
+    def get_messages_by_days(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ):
+        """
+        @return: [('YYYY-MM-DD', 消息数), ...]
+        """
+        return self._count_by('day', username_, time_range=time_range)
+
+    def get_messages_by_month(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ):
+        """
+        @return: [('YYYY-MM', 消息数), ...]
+        """
+        return self._count_by('month', username_, time_range=time_range)
+
+    def get_messages_by_hour(self, username_, time_range=None, year_='all'):
+        """
+        @return: [('00'-'23', 消息数), ...]
+        """
+        return self._count_by('hour', username_, time_range=time_range, year_=year_)
 
     def get_chatted_top_contacts(
             self,
@@ -252,7 +546,49 @@ class DataBaseV4(DataBaseInterface):
             contain_chatroom=False,
             top_n=10
     ) -> list:
-        return []
+        """
+        @return: [(联系人, 消息数), ...]，按消息数从多到少
+        """
+        stats_cube = self.message_db.get_stats_cube()
+        if not stats_cube:
+            return []
+        start_time, end_time = convert_to_timestamp(time_range)
+        return [
+            (self.get_contact_by_username(username), num)
+            for username, num in stats_cube.top_talkers(start_time, end_time, contain_chatroom, top_n)
+        ]
+
+    def get_send_messages_number_sum(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        stats_cube = self.message_db.get_stats_cube()
+        if not stats_cube:
+            return 0
+        start_time, end_time = convert_to_timestamp(time_range)
+        return stats_cube.total(sender=Me().wxid, start_time=start_time, end_time=end_time)[0]
+
+    def get_send_messages_number_by_hour(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        return self._count_by('hour', sender=Me().wxid, time_range=time_range)
+
+    def get_message_length(
+            self,
+            username_='',
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        """
+        文字消息的总字数（群聊不含发送人前缀）
+        @param username_: 为空时统计所有联系人
+        @param time_range:
+        """
+        stats_cube = self.message_db.get_stats_cube()
+        if not stats_cube:
+            return 0
+        start_time, end_time = convert_to_timestamp(time_range)
+        return stats_cube.total(username_, start_time=start_time, end_time=end_time)[1]
 
     def get_emoji_url(self, md5: str, thumb: bool = False) -> str | bytes:
         return self.emotion_db.get_emoji_url(md5, thumb)
@@ -274,6 +610,9 @@ class DataBaseV4(DataBaseInterface):
     def get_media_buffer(self, server_id, is_open_im=False) -> bytes:
         return self.media_db.get_media_buffer(server_id)
 
+    def iter_media_buffers(self, server_ids, is_open_im=False) -> Iterator[Tuple[int, bytes]]:
+        return self.media_db.iter_media_buffers(server_ids)
+
     def get_audio_path(self, reserved0, output_path, filename=''):
         return self.media_db.get_audio_path(reserved0, output_path, filename)
 
@@ -380,22 +719,57 @@ class DataBaseV4(DataBaseInterface):
     def set_remark(self, username: str, remark) -> bool:
         if username in self.contacts_map:
             self.contacts_map[username].remark = remark
+        with self.contact_lock:
+            if self.contact_table is not None and username in self.contact_table and remark:
+                contact = copy.copy(self.contact_table[username])
+                contact.remark = remark
+                self.contact_table = MappingProxyType({**self.contact_table, username: contact})
+                shutdown_parse_pool()  # 解析进程里的联系人表过期了
         return self.contact_db.set_remark(username, remark)
 
     def set_avatar_buffer(self, username, avatar_path):
         return self.head_image_db.set_avatar_buffer(username, avatar_path)
 
+    def get_contact_table(self) -> Mapping[str, Person]:
+        """
+        所有联系人（包括陌生人和群成员）的只读字典，第一次调用时一次性读出整张contact表，
+        之后解析消息、获取群成员都不再逐个查询数据库
+        @return: {wxid: 联系人}
+        """
+        if self.contact_table is None:
+            with self.contact_lock:
+                if self.contact_table is None:
+                    self._contact_rows = {row[0]: row for row in self.contact_db.get_all_contacts()}
+                    try:
+                        table = {wxid: self.create_contact(row) for wxid, row in self._contact_rows.items()}
+                    finally:
+                        self._contact_rows = None
+                    self.contact_table = MappingProxyType(table)
+        return self.contact_table
+
+    def set_contact_table(self, contacts: Mapping[str, Person]):
+        """
+        直接使用已经加载好的联系人表（解析进程用）
+        @param contacts: {wxid: 联系人}
+        """
+        self.contact_table = MappingProxyType(dict(contacts))
+
     def get_contact_by_username(self, wxid: str) -> Person:
-        contact_info_list = self.contact_db.get_contact_by_username(wxid)
-        if contact_info_list:
-            contact = self.create_contact(contact_info_list)
-            return contact
+        rows = self._contact_rows
+        if rows is not None and self.contact_table is None:
+            # 正在加载联系人表，没有昵称的群聊要用群成员拼群名称
+            contact_info_list = rows.get(wxid)
+            contact = self.create_contact(contact_info_list) if contact_info_list else None
         else:
-            contact = Contact(
-                wxid=wxid,
-                nickname=wxid,
-                remark=wxid
-            )
+            contact = self.get_contact_table().get(wxid)
+        if contact:
+            # 返回副本，调用方修改备注（例如换成群昵称）不影响共享的联系人表
+            return copy.copy(contact)
+        contact = Contact(
+            wxid=wxid,
+            nickname=wxid,
+            remark=wxid
+        )
         return contact
 
     def get_chatroom_members(self, chatroom_name) -> dict[Any, Person] | Any:
@@ -482,3 +856,8 @@ class DataBaseV4(DataBaseInterface):
                     print(f"成功合并数据库: {path}")
                 except Exception as e:
                     print(f"合并 {path} 失败: {e}")
+
+        with self.contact_lock:
+            self.contact_table = None  # 合并了新的联系人，下次使用时重新加载
+        # 解析进程里的联系人表和分库目录都是启动时读的，合并之后重建进程池
+        shutdown_parse_pool()
@@ -8,47 +8,242 @@
 @File        : MemoTrace-db_model.py 
 @Description : 
 """
+import hashlib
 import os
 import sqlite3
+import threading
 import traceback
+from contextlib import contextmanager
+from urllib.parse import quote
+
+DEFAULT_POOL_SIZE = 8  # 每个数据库文件最多同时打开的只读连接数
+
+# 快照模式下的连接参数
+SNAPSHOT_MMAP_SIZE = 1 << 30  # 1GB，数据库文件直接映射到内存，读页不再经过read系统调用
+SNAPSHOT_CACHE_SIZE = -256 * 1024  # 负数表示KiB，即每个连接256MB页缓存
+DEFAULT_CACHE_DIR = 'cache'  # 直接读取加密数据库时，程序自己生成的文件默认放在当前目录的这个文件夹下
+
+
+class ConnectionPool:
+    """
+    只读连接池，每个线程独占一个连接，线程之间的查询不会在同一个连接的互斥锁上排队
+    线程结束后它的连接回收给新的线程复用；同时查询的线程超过size个时，多出来的线程共用fallback连接
+    """
+
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE, fallback=None):
+        """
+        @param connect: 创建新连接的函数，func() -> connection
+        @param size: 最多打开的连接数
+        @param fallback: 连接数用完或者打开失败时使用的共享连接
+        """
+        self._connect = connect
+        self.size = size
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._owners = {}  # 线程 -> 该线程独占的连接
+        self._idle = []
+        self._closed = False
+
+    def _reclaim(self):
+        for thread in [thread for thread in self._owners if not thread.is_alive()]:
+            self._idle.append(self._owners.pop(thread))
+
+    def get(self):
+        """获取当前线程的连接"""
+        thread = threading.current_thread()
+        conn = self._owners.get(thread)
+        if conn is not None:
+            return conn
+        with self._lock:
+            if self._closed:
+                return self.fallback
+            self._reclaim()
+            if self._idle:
+                conn = self._idle.pop()
+            elif len(self._owners) < self.size:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    print(traceback.format_exc())
+                    conn = None
+            if conn is None:
+                return self.fallback
+            self._owners[thread] = conn
+            return conn
+
+    def release(self):
+        """当前线程不再查询时可以主动归还连接，否则等线程结束后再回收"""
+        with self._lock:
+            conn = self._owners.pop(threading.current_thread(), None)
+            if conn is not None and not self._closed:
+                self._idle.append(conn)
+
+    @contextmanager
+    def connection(self):
+        yield self.get()
+
+    def cursor(self):
+        return self.get().cursor()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            connections = list(self._owners.values()) + self._idle
+            self._owners.clear()
+            self._idle.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                print(traceback.format_exc())
 
 
 class DataBaseBase:
+    # 设置了密钥之后直接只读打开微信的加密数据库，查询时按页解密，见 wxManager.decrypt.vfs
+    encrypt_key = None
+    encrypt_version = 4
+    pool_size = DEFAULT_POOL_SIZE  # 每个数据库文件的只读连接池大小，为0时所有线程共用一个连接
+    # 快照模式：解密出来的数据库不会再被修改，以immutable方式打开，省掉文件锁和日志检查，并加大mmap和页缓存
+    snapshot_mode = False
+    snapshot_mmap_size = SNAPSHOT_MMAP_SIZE
+    snapshot_cache_size = SNAPSHOT_CACHE_SIZE
+    writable = False  # 会被程序自己写入的数据库（如Audio2Text.db）为True，不使用快照模式
+    cache_dir = ''  # 直接读取加密数据库时，索引、统计表、解析结果缓存等文件放在这里，见get_cache_dir
+
     def __init__(self, db_file_name, is_series=False):
         self.DB = None
         self.cursor = None
+        self.pool = None  # 只读连接池，系列数据库时为列表，和self.DB一一对应
         self.open_flag = False
         self.db_file_name = db_file_name
+        self.db_path = ''  # 数据库文件的完整路径，系列数据库时为列表，和self.DB一一对应
         self.is_series = is_series  # 是否是一系列数据库，例如MSG0、MSG1、MSG2······
         self.db_dir = ''
 
+    @classmethod
+    def set_encrypt_key(cls, key, version=4):
+        """
+        设置数据库密钥，之后init_database遇到加密数据库时不再需要提前解密
+        :param key: 密钥 64位16进制字符串，为None时关闭
+        :param version: 微信版本，3或4
+        """
+        DataBaseBase.encrypt_key = key
+        DataBaseBase.encrypt_version = version
+
+    @classmethod
+    def set_snapshot_mode(cls, enabled=True, mmap_size=SNAPSHOT_MMAP_SIZE, cache_size=SNAPSHOT_CACHE_SIZE):
+        """
+        开启快照模式，只对之后init_database打开的数据库生效；合并数据库时不要开启
+        :param enabled: 是否开启
+        :param mmap_size: PRAGMA mmap_size，字节
+        :param cache_size: PRAGMA cache_size，正数为页数，负数为KiB
+        """
+        DataBaseBase.snapshot_mode = enabled
+        DataBaseBase.snapshot_mmap_size = mmap_size
+        DataBaseBase.snapshot_cache_size = cache_size
+
+    @classmethod
+    def set_cache_dir(cls, cache_dir):
+        """
+        :param cache_dir: 直接读取加密数据库时程序自己生成的文件放在哪个文件夹，为空时用当前目录下的cache
+        """
+        DataBaseBase.cache_dir = cache_dir
+
+    @staticmethod
+    def get_cache_dir(db_dir) -> str:
+        """
+        程序自己生成的文件（索引、统计表、解析结果缓存、Audio2Text.db）放在哪个文件夹。
+        设置了密钥时db_dir是微信自己的db_storage，不能往里面写，每个db_dir在cache_dir下单独一个文件夹
+        :param db_dir: 数据库文件夹
+        :return: 没有设置密钥时就是db_dir
+        """
+        if not DataBaseBase.encrypt_key:
+            return db_dir
+        name = hashlib.md5(os.path.abspath(db_dir).encode('utf-8')).hexdigest()
+        return os.path.join(os.path.abspath(DataBaseBase.cache_dir or DEFAULT_CACHE_DIR), name)
+
+    def _use_snapshot(self):
+        return DataBaseBase.snapshot_mode and not self.writable
+
+    def _connect_snapshot(self, db_path):
+        if DataBaseBase.encrypt_key:
+            # 加密数据库走解密VFS，本身已经是只读+immutable
+            conn = self._connect(db_path)
+        else:
+            uri = 'file:' + quote(os.path.abspath(db_path).replace('\\', '/'), safe='/:') + '?mode=ro&immutable=1'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size={int(DataBaseBase.snapshot_mmap_size)}')
+        conn.execute(f'PRAGMA cache_size={int(DataBaseBase.snapshot_cache_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _connect(self, db_path):
+        if DataBaseBase.encrypt_key:
+            from wxManager.decrypt.vfs import is_encrypted_database, open_encrypted_database
+            if is_encrypted_database(db_path):
+                return open_encrypted_database(db_path, DataBaseBase.encrypt_key, DataBaseBase.encrypt_version)
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+    def _connect_readonly(self, db_path):
+        if self._use_snapshot():
+            return self._connect_snapshot(db_path)
+        if DataBaseBase.encrypt_key:
+            # 加密数据库本身就是以只读方式打开的
+            return self._connect(db_path)
+        uri = 'file:' + quote(os.path.abspath(db_path).replace('\\', '/'), safe='/:') + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def connect_writable(self, db_path):
+        """
+        单独打开一个可写连接，用于平时只读（快照模式下是immutable）、偶尔需要写入的数据库，用完要关闭
+        :param db_path: 数据库文件路径
+        :return: 设置了密钥时打开的是微信自己的加密数据库，不允许写入，返回None
+        """
+        if DataBaseBase.encrypt_key:
+            return None
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+    def _create_pool(self, db_path, fallback):
+        return ConnectionPool(lambda: self._connect_readonly(db_path), self.pool_size, fallback)
+
     def init_database(self, db_dir=''):
         self.db_dir = db_dir
         if not os.path.exists(db_dir):
             return False
         db_path = os.path.join(db_dir, self.db_file_name)
-        if not os.path.exists(db_path) and self.db_file_name != 'Audio2Text.db':
+        if self.db_file_name == 'Audio2Text.db':
+            # 程序自己建的数据库，加密模式下不能放在微信的文件夹里
+            cache_dir = self.get_cache_dir(db_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+            db_path = os.path.join(cache_dir, self.db_file_name)
+        elif not os.path.exists(db_path):
             return False
         db_file_name = self.db_file_name
         if self.is_series:
             self.db_file_name = []
+            self.db_path = []
             self.DB = []
             self.cursor = []
+            self.pool = []
             for i in range(100):
                 new_file_name = db_file_name.replace('0', f'{i}')
                 db_path = os.path.join(db_dir, new_file_name)
                 if os.path.exists(db_path):
                     self.db_file_name.append(os.path.basename(new_file_name))
+                    self.db_path.append(db_path)
                     # print('初始化数据库：', db_path)
-                    DB = sqlite3.connect(db_path, check_same_thread=False)
+                    DB = self._connect_snapshot(db_path) if self._use_snapshot() else self._connect(db_path)
                     cursor = DB.cursor()
                     self.DB.append(DB)
                     self.cursor.append(cursor)
+                    self.pool.append(self._create_pool(db_path, DB))
                     self.open_flag = True
         else:
-            self.DB = sqlite3.connect(db_path, check_same_thread=False)
+            self.db_path = db_path
+            self.DB = self._connect_snapshot(db_path) if self._use_snapshot() else self._connect(db_path)
             # '''创建游标'''
             self.cursor = self.DB.cursor()
+            self.pool = self._create_pool(db_path, self.DB)
             self.open_flag = True
         # print('初始化数据库完成：', db_path)
         self.self_init()
@@ -57,6 +252,11 @@ class DataBaseBase:
     def self_init(self):
         pass
 
+    @staticmethod
+    def _with_cursor(pool, func, *args):
+        """在线程池的工作线程里使用该线程自己的连接执行func(cursor, *args)"""
+        return func(pool.cursor(), *args)
+
     def commit(self):
         if self.is_series:
             for db in self.DB:
@@ -72,9 +272,13 @@ class DataBaseBase:
             try:
                 self.open_flag = False
                 if self.is_series:
+                    for pool in self.pool:
+                        pool.close()
                     for db in self.DB:
                         db.close()
                 else:
+                    if self.pool:
+                        self.pool.close()
                     if self.DB:
                         self.DB.close()
             except:
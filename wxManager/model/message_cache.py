@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/28 21:37
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-message_cache.py
+@Description : 解析结果缓存
+               同一个联系人反复导出（不同格式、不同时间范围）时，每次都要重新查库、解压、解析XML和protobuf；
+               这里把解析好的Message按联系人、按分库保存到磁盘，每个分库一个文件，
+               文件里是一段一段排好序的消息（每段pickle之后zstd压缩，前面是8字节长度），可以逐段读出，也可以直接在末尾追加；
+               每个分库记录(最大local_id, 文件修改时间, 行数和类型校验和)：
+               分库没变直接用缓存；只追加了新消息时只解析新增的部分；历史消息被修改（撤回等）时重新解析这个分库；
+               每个联系人单独加锁，解析一个联系人的消息时不影响其它联系人
+"""
+import hashlib
+import heapq
+import os
+import pickle
+import shutil
+import struct
+import threading
+import traceback
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import zstandard as zstd
+
+from wxManager.log import logger
+
+CACHE_VERSION = 2  # 消息解析逻辑、Message字段或缓存格式变化时加1，旧缓存自动失效
+MESSAGE_CACHE_DIR = os.path.join('cache', 'messages')
+META_FILE = 'meta.bin'
+CHUNK_HEADER = struct.Struct('<Q')
+
+
+def _write_chunk(f, messages: List):
+    data = zstd.ZstdCompressor(level=3).compress(pickle.dumps(messages, protocol=pickle.HIGHEST_PROTOCOL))
+    f.write(CHUNK_HEADER.pack(len(data)))
+    f.write(data)
+
+
+def _read_chunks(path) -> Iterator[List]:
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        while header := f.read(CHUNK_HEADER.size):
+            size = CHUNK_HEADER.unpack(header)[0]
+            yield pickle.loads(zstd.ZstdDecompressor().decompress(f.read(size)))
+
+
+def _is_sorted(messages: List, last=None) -> bool:
+    if last is not None and messages and messages[0] < last:
+        return False
+    return all(not messages[i] < messages[i - 1] for i in range(1, len(messages)))
+
+
+class MessageCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()  # 只保护user_locks
+        self.user_locks = {}  # 联系人wxid -> 这个联系人的缓存锁
+        self.enabled = True  # 缓存目录不可写时关闭
+
+    def _user_lock(self, username) -> threading.Lock:
+        with self.lock:
+            lock = self.user_locks.get(username)
+            if lock is None:
+                lock = self.user_locks[username] = threading.Lock()
+            return lock
+
+    def _dir(self, username) -> str:
+        return os.path.join(self.cache_dir, hashlib.md5(username.encode('utf-8')).hexdigest())
+
+    def _shard_path(self, username, file_name) -> str:
+        return os.path.join(self._dir(username), f'{file_name}.bin')
+
+    def load(self, username, stamp=None) -> Dict[str, dict]:
+        """
+        :param username: 联系人wxid
+        :param stamp: 缓存整体的版本标记（例如联系人数据库的修改时间，备注和群昵称会写进解析结果），不一致时整个作废
+        :return: {分库文件名: {'max_local_id', 'mtime', 'checksum', 'last', 'sorted'}}，
+                 last是这个分库最后写入的一条消息，sorted表示整个分库文件里的消息是否有序
+        """
+        path = os.path.join(self._dir(username), META_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.loads(zstd.ZstdDecompressor().decompress(f.read()))
+        except Exception:
+            logger.error(f'聊天记录缓存读取失败：{traceback.format_exc()}')
+            return {}
+        if data.get('version') != CACHE_VERSION or data.get('username') != username or data.get('stamp') != stamp:
+            return {}
+        return data['shards']
+
+    def save(self, username, shards: Dict[str, dict], stamp=None):
+        path = os.path.join(self._dir(username), META_FILE)
+        data = {'version': CACHE_VERSION, 'username': username, 'stamp': stamp, 'shards': shards}
+        try:
+            os.makedirs(self._dir(username), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(zstd.ZstdCompressor(level=3).compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.error(f'聊天记录缓存写入失败：{traceback.format_exc()}')
+            self.enabled = False
+
+    def _write_shard(self, username, file_name, messages: List, append=False):
+        os.makedirs(self._dir(username), exist_ok=True)
+        path = self._shard_path(username, file_name)
+        if append:
+            with open(path, 'ab') as f:
+                _write_chunk(f, messages)
+            return
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            if messages:
+                _write_chunk(f, messages)
+        os.replace(tmp_path, path)
+
+    def refresh(self, username, db, parse: Callable[[str, int, int], List], stamp=None,
+                fill=True) -> Optional[Dict[str, dict]]:
+        """
+        补上新增的消息，重新解析有变化的分库，每次只有一个分库的消息在内存里
+        :param username: 联系人wxid
+        :param db: 消息数据库，需要实现get_cache_watermarks(username)和get_cache_checksum(username, file_name, max_local_id)
+        :param parse: parse(分库文件名, 起始local_id（不含）, 结束local_id（包含）)，返回解析好的消息列表
+        :param stamp: 见load
+        :param fill: 还没有缓存（或缓存已作废）时是否解析全部消息建立缓存，为False时直接返回None
+        :return: 见load，fill为False且没有可用的缓存时返回None
+        """
+        with self._user_lock(username):
+            cached = self.load(username, stamp)
+            if not cached and not fill:
+                return None
+            shards = {}
+            changed = False
+            try:
+                for file_name, (max_local_id, mtime) in db.get_cache_watermarks(username).items():
+                    entry = cached.get(file_name)
+                    if entry and entry['mtime'] == mtime and entry['max_local_id'] == max_local_id:
+                        shards[file_name] = entry
+                        continue
+                    if not changed and cached:
+                        # 改分库文件之前先删掉描述文件，中途出错时不会把追加了一半的分库当成有效缓存
+                        os.remove(os.path.join(self._dir(username), META_FILE))
+                    changed = True
+                    if entry and entry['max_local_id'] <= max_local_id and \
+                            db.get_cache_checksum(username, file_name, entry['max_local_id']) == entry['checksum']:
+                        # 已缓存部分没有变化，只解析新增的消息，追加到分库文件末尾
+                        messages = sorted(parse(file_name, entry['max_local_id'], max_local_id)) \
+                            if max_local_id > entry['max_local_id'] else []
+                        if messages:
+                            self._write_shard(username, file_name, messages, append=True)
+                        is_sorted = entry['sorted'] and _is_sorted(messages, entry['last'])
+                        last = messages[-1] if messages else entry['last']
+                    else:
+                        messages = sorted(parse(file_name, 0, max_local_id))
+                        self._write_shard(username, file_name, messages)
+                        is_sorted = True
+                        last = messages[-1] if messages else None
+                    shards[file_name] = {
+                        'max_local_id': max_local_id,
+                        'mtime': mtime,
+                        'checksum': db.get_cache_checksum(username, file_name, max_local_id),
+                        'last': last,
+                        'sorted': is_sorted,
+                    }
+            except OSError:
+                logger.error(f'聊天记录缓存写入失败：{traceback.format_exc()}')
+                self.enabled = False
+                return None
+            if changed or shards.keys() != cached.keys():
+                self.save(username, shards, stamp)
+            return shards
+
+    def _iter_shard(self, username, file_name, entry) -> Iterator:
+        path = self._shard_path(username, file_name)
+        if entry['sorted']:
+            for messages in _read_chunks(path):
+                yield from messages
+        else:
+            yield from sorted(message for messages in _read_chunks(path) for message in messages)
+
+    def iter_cached(self, username, shards: Dict[str, dict]) -> Iterator:
+        """
+        按顺序逐条返回缓存的消息，各分库逐段读取之后归并，内存里只有每个分库的一段消息
+        :param shards: refresh的返回值
+        """
+        return heapq.merge(*(self._iter_shard(username, file_name, entry) for file_name, entry in shards.items()))
+
+    def get_messages(self, username, db, parse: Callable[[str, int, int], List], stamp=None,
+                     fill=True) -> Optional[List]:
+        """
+        读取缓存并补上新增的消息，参数见refresh
+        :return: 该联系人的全部消息（未排序），fill为False且没有可用的缓存时返回None
+        """
+        shards = self.refresh(username, db, parse, stamp, fill)
+        if shards is None:
+            return None
+        return [
+            message
+            for file_name in shards
+            for messages in _read_chunks(self._shard_path(username, file_name))
+            for message in messages
+        ]
+
+    def writer(self, username, db, stamp=None) -> 'MessageCacheWriter':
+        """
+        导出时边解析边写缓存，见MessageCacheWriter
+        """
+        return MessageCacheWriter(self, username, db, stamp)
+
+    def clear(self, username=''):
+        """
+        :param username: 为空时清空所有缓存
+        """
+        if username:
+            with self._user_lock(username):
+                shutil.rmtree(self._dir(username), ignore_errors=True)
+            return
+        if not os.path.isdir(self.cache_dir):
+            return
+        for file in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+
+class MessageCacheWriter:
+    """
+    流式导出时顺便建立缓存：解析好的消息按分库追加到临时文件，全部写完调用commit之后才生效，中途放弃时调用discard
+    只缓存开始时各分库水位以内的消息，导出过程中新收到的消息留给下次refresh补上
+    """
+
+    def __init__(self, cache: MessageCache, username, db, stamp=None):
+        self.cache = cache
+        self.username = username
+        self.db = db
+        self.stamp = stamp
+        self.watermarks = db.get_cache_watermarks(username)
+        self.files = {}  # 分库文件名 -> 临时文件
+        self.last = {}  # 分库文件名 -> 最后写入的一条消息
+        self.sorted = {}  # 分库文件名 -> 写入的消息是否有序
+        self.failed = False  # 写缓存出错之后不再写，不影响导出
+
+    def add(self, file_name, messages: Iterable):
+        """
+        :param file_name: 这批消息所在的分库
+        :param messages: 解析好的消息
+        """
+        watermark = self.watermarks.get(file_name)
+        if self.failed or watermark is None:
+            return
+        messages = [message for message in messages if message.local_id <= watermark[0]]
+        if not messages:
+            return
+        try:
+            f = self.files.get(file_name)
+            if f is None:
+                os.makedirs(self.cache._dir(self.username), exist_ok=True)
+                tmp_path = f'{self.cache._shard_path(self.username, file_name)}.{os.getpid()}.{threading.get_ident()}.tmp'
+                f = self.files[file_name] = open(tmp_path, 'wb')
+                self.sorted[file_name] = True
+            _write_chunk(f, messages)
+        except OSError:
+            logger.error(f'聊天记录缓存写入失败：{traceback.format_exc()}')
+            self.cache.enabled = False
+            self.discard()
+            return
+        self.sorted[file_name] = self.sorted[file_name] and _is_sorted(messages, self.last.get(file_name))
+        self.last[file_name] = messages[-1]
+
+    def commit(self):
+        """
+        所有分库都写完之后替换旧的缓存
+        """
+        if self.failed:
+            return
+        with self.cache._user_lock(self.username):
+            shards = {}
+            try:
+                # 先清掉旧的描述文件，替换分库文件的过程中出错时旧缓存直接作废
+                meta_path = os.path.join(self.cache._dir(self.username), META_FILE)
+                if os.path.exists(meta_path):
+                    os.remove(meta_path)
+                for file_name, (max_local_id, mtime) in self.watermarks.items():
+                    path = self.cache._shard_path(self.username, file_name)
+                    f = self.files.pop(file_name, None)
+                    if f is not None:
+                        f.close()
+                        os.replace(f.name, path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                    shards[file_name] = {
+                        'max_local_id': max_local_id,
+                        'mtime': mtime,
+                        'checksum': self.db.get_cache_checksum(self.username, file_name, max_local_id),
+                        'last': self.last.get(file_name),
+                        'sorted': self.sorted.get(file_name, True),
+                    }
+            except OSError:
+                logger.error(f'聊天记录缓存写入失败：{traceback.format_exc()}')
+                self.cache.enabled = False
+                self.discard()
+                return
+            self.cache.save(self.username, shards, self.stamp)
+
+    def discard(self):
+        """
+        导出中途取消或出错时删除临时文件，原有的缓存不受影响
+        """
+        self.failed = True
+        for f in self.files.values():
+            f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+        self.files.clear()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/21 22:05
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-shard_cursor.py
+@Description : 跨分库的分页游标
+               每个分库各自记住上一次读到的位置（keyset分页，不用offset），
+               多个分库的结果用堆按排序键归并，每页只返回msg_num条，没用完的行留到下一页，不会被丢弃重查
+"""
+import heapq
+import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Sequence, Tuple
+
+MAX_SORT_KEY = sys.maxsize  # 倒序时从最新一条消息开始使用的起始位置
+MIN_SORT_KEY = -sys.maxsize - 1  # 正序时从最早一条消息开始使用的起始位置
+
+
+class ShardCursor:
+    def __init__(self, shards: Sequence, fetch: Callable, key: Callable[[tuple], Tuple], position: Tuple,
+                 descending=True):
+        """
+        :param shards: 每个分库的连接池
+        :param fetch: fetch(cursor, position, limit) -> 排序键在position之后、按排序键排列的最多limit行
+        :param key: 从一行数据里取排序键，必须是由数字组成的元组，并且在整个会话内唯一
+        :param position: 起始位置（不含），之后是最后一条已返回消息的排序键
+        :param descending: True为倒序（从新到旧，fetch返回小于position的行），False为正序（fetch返回大于position的行）
+        """
+        self.shards = list(shards)
+        self.fetch = fetch
+        self.key = key
+        self.descending = descending
+        self.position = position
+        self.buffers = [deque() for _ in self.shards]
+        self.positions = [position] * len(self.shards)  # 每个分库已经读到的位置
+        self.exhausted = [False] * len(self.shards)
+        self.heap = []  # (排序键, 分库下标)，倒序时排序键取反，堆顶就是下一条要返回的消息
+        self.started = False
+        self.lock = threading.Lock()
+
+    def _fill(self, index, limit):
+        rows = self.fetch(self.shards[index].cursor(), self.positions[index], limit)
+        if len(rows) < limit:
+            self.exhausted[index] = True
+        if rows:
+            self.positions[index] = self.key(rows[-1])
+            self.buffers[index].extend(rows)
+
+    def _push(self, index, limit):
+        if not self.buffers[index] and not self.exhausted[index]:
+            self._fill(index, limit)
+        if self.buffers[index]:
+            key = self.key(self.buffers[index][0])
+            heapq.heappush(self.heap, (tuple(-k for k in key) if self.descending else key, index))
+
+    def next_page(self, msg_num=20) -> List[tuple]:
+        """
+        按排序键顺序返回接下来的msg_num条消息，没有更多消息时返回空列表
+        """
+        with self.lock:
+            if not self.started:
+                self.started = True
+                if len(self.shards) > 1:
+                    with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+                        list(executor.map(lambda index: self._fill(index, msg_num), range(len(self.shards))))
+                for index in range(len(self.shards)):
+                    self._push(index, msg_num)
+            result = []
+            while self.heap and len(result) < msg_num:
+                _, index = heapq.heappop(self.heap)
+                row = self.buffers[index].popleft()
+                result.append(row)
+                self.position = self.key(row)
+                self._push(index, msg_num)
+            return result
+
+    @property
+    def has_more(self):
+        return bool(self.heap) or not self.started
+
+
+class ShardCursorCache:
+    """
+    按联系人缓存游标，继续上一次的位置翻页时直接复用，不必每页重新查询所有分库
+    """
+
+    def __init__(self, k=16):
+        self.k = k
+        self.cursors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, username, start_sort_seq, factory: Callable[[], ShardCursor]) -> ShardCursor:
+        """
+        :param username: 联系人wxid
+        :param start_sort_seq: 本页的起始位置，等于缓存游标排序键的第一项时复用该游标
+        :param factory: 没有可复用的游标时用来创建新游标
+        """
+        with self.lock:
+            cursor = self.cursors.pop(username, None)
+            if cursor is None or not cursor.started or cursor.position[0] != start_sort_seq:
+                cursor = factory()
+            self.cursors[username] = cursor
+            while len(self.cursors) > self.k:
+                self.cursors.popitem(last=False)
+            return cursor
+
+    def clear(self):
+        with self.lock:
+            self.cursors.clear()
+
+
+if __name__ == '__main__':
+    pass
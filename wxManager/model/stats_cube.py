@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/27 16:03
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-stats_cube.py
+@Description : 聊天统计预聚合
+               按(联系人, 发送人, 消息类型, 日期, 小时)聚合消息条数和文字长度，保存在单独的SQLite文件里；
+               按时、按天、按月统计、聊天日历、聊天最多的联系人、发送消息数、消息字数都直接查这张表，不再全表扫描聊天记录；
+               按(分库, 表)记录已经统计到的最大local_id和这部分消息的校验和，之后只增量统计新增的消息；
+               校验和变了（删除、撤回了消息，或者合并数据库时改写了已有的消息）时删掉这个联系人的统计，在所有分库里重新统计
+               时间范围按小时对齐，结束时间不包含在内：范围的起止时间正好是整点时和直接查聊天记录的结果一样；
+               起止时间不是整点时，开头和结尾那两个小时里的消息全部计入（聊天记录只能精确到小时）
+"""
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+STATS_CUBE_FILE = 'stats_cube.db'
+STATS_CUBE_VERSION = 1  # 表结构变化时加1，旧的统计表整个重建
+
+
+def _day_hour(timestamp) -> Tuple[str, int]:
+    t = time.localtime(timestamp)
+    return f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}', t.tm_hour
+
+
+class StatsCube:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = None
+        self.ready = False  # 至少完整统计过一次
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            if conn.execute('PRAGMA user_version').fetchone()[0] != STATS_CUBE_VERSION:
+                conn.executescript(f'''
+                    DROP TABLE IF EXISTS StatsCube;
+                    DROP TABLE IF EXISTS Watermark;
+                    PRAGMA user_version={STATS_CUBE_VERSION};
+                ''')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS StatsCube(
+                    talker TEXT,
+                    sender TEXT,
+                    type INTEGER,
+                    day TEXT,
+                    hour INTEGER,
+                    msg_count INTEGER,
+                    char_length INTEGER,
+                    PRIMARY KEY (talker, sender, type, day, hour)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS StatsCube_day ON StatsCube(day, hour);
+                CREATE TABLE IF NOT EXISTS Watermark(
+                    shard TEXT,
+                    table_name TEXT,
+                    talker TEXT,
+                    max_local_id INTEGER,
+                    checksum TEXT,
+                    PRIMARY KEY (shard, table_name)
+                );
+            ''')
+            self.conn = conn
+        return self.conn
+
+    def get_watermarks(self) -> dict:
+        """{(分库文件名, 表名): (联系人, 已经统计到的最大local_id, 这部分消息的校验和)}"""
+        with self.lock:
+            conn = self._open()
+            return {
+                (shard, table_name): (talker, max_local_id, checksum)
+                for shard, table_name, talker, max_local_id, checksum in conn.execute(
+                    'SELECT shard, table_name, talker, max_local_id, checksum FROM Watermark'
+                )
+            }
+
+    def remove_talkers(self, talkers: Iterable[str]):
+        """
+        删除联系人的统计结果和所有分库里的水位，下次update时从头统计
+        """
+        with self.lock:
+            conn = self._open()
+            args = [(talker,) for talker in talkers]
+            conn.executemany('DELETE FROM StatsCube WHERE talker=?', args)
+            conn.executemany('DELETE FROM Watermark WHERE talker=?', args)
+            conn.commit()
+
+    def update(self, batches: Iterable[Tuple[str, str, str, int, str, Iterable[Tuple[str, str, int, int, int]]]]) -> int:
+        """
+        增量统计
+        :param batches: [(分库文件名, 表名, 联系人, 这一批的最大local_id, 统计到这里时的校验和,
+                          [(联系人, 发送人, 类型, create_time, 文字长度), ...]), ...]
+        :return: 本次统计的消息条数
+        """
+        with self.lock:
+            conn = self._open()
+            total = 0
+            for shard, table_name, talker, max_local_id, checksum, rows in batches:
+                counter = Counter()
+                lengths = Counter()
+                for talker, sender, type_, create_time, length in rows:
+                    key = (talker, sender or '', type_) + _day_hour(create_time)
+                    counter[key] += 1
+                    lengths[key] += length
+                conn.executemany(
+                    '''
+                    INSERT INTO StatsCube VALUES (?,?,?,?,?,?,?)
+                    ON CONFLICT(talker, sender, type, day, hour) DO UPDATE SET
+                    msg_count=msg_count+excluded.msg_count, char_length=char_length+excluded.char_length
+                    ''',
+                    (key + (count, lengths[key]) for key, count in counter.items())
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO Watermark VALUES (?,?,?,?,?)',
+                    (shard, table_name, talker, max_local_id, checksum)
+                )
+                total += sum(counter.values())
+            conn.commit()
+            self.ready = True
+            return total
+
+    @staticmethod
+    def _where(talker='', sender='', type_=None, start_time=0, end_time=0, contain_chatroom=True):
+        conditions = []
+        args = []
+        if talker:
+            conditions.append('talker=?')
+            args.append(talker)
+        if sender:
+            conditions.append('sender=?')
+            args.append(sender)
+        if type_ is not None:
+            conditions.append('type=?')
+            args.append(type_)
+        if not contain_chatroom:
+            conditions.append("talker NOT LIKE '%@chatroom'")
+        if end_time:
+            start_day, start_hour = _day_hour(start_time)
+            # 结束时间不包含在内，2025-01-01 00:00:00结束的范围最后一个小时是2024-12-31 23点
+            end_day, end_hour = _day_hour(end_time - 1)
+            conditions.append('(day>? OR (day=? AND hour>=?)) AND (day<? OR (day=? AND hour<=?))')
+            args.extend([start_day, start_day, start_hour, end_day, end_day, end_hour])
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), args
+
+    def _query(self, sql, args):
+        with self.lock:
+            conn = self._open()
+            return conn.execute(sql, args).fetchall()
+
+    def count_by(self, group_by='day', talker='', sender='', type_=None, start_time=0, end_time=0) -> List[Tuple]:
+        """
+        分组统计消息条数
+        :param group_by: hour（0-23点）、day（YYYY-MM-DD）、month（YYYY-MM）、year（YYYY）
+        :return: [(分组, 条数), ...]，按分组排序
+        """
+        group = {
+            'hour': "printf('%02d', hour)",
+            'day': 'day',
+            'month': 'substr(day, 1, 7)',
+            'year': 'substr(day, 1, 4)',
+        }[group_by]
+        where, args = self._where(talker, sender, type_, start_time, end_time)
+        return self._query(f'SELECT {group} AS g, sum(msg_count) FROM StatsCube{where} GROUP BY g ORDER BY g', args)
+
+    def total(self, talker='', sender='', type_=None, start_time=0, end_time=0) -> Tuple[int, int]:
+        """
+        :return: (消息条数, 文字长度)
+        """
+        where, args = self._where(talker, sender, type_, start_time, end_time)
+        count, length = self._query(f'SELECT sum(msg_count), sum(char_length) FROM StatsCube{where}', args)[0]
+        return count or 0, length or 0
+
+    def top_talkers(self, start_time=0, end_time=0, contain_chatroom=False, top_n=10) -> List[Tuple[str, int]]:
+        """
+        :return: [(联系人wxid, 条数), ...]，按条数从多到少
+        """
+        where, args = self._where(start_time=start_time, end_time=end_time, contain_chatroom=contain_chatroom)
+        return self._query(
+            f'SELECT talker, sum(msg_count) AS num FROM StatsCube{where} GROUP BY talker ORDER BY num DESC LIMIT ?',
+            args + [top_n]
+        )
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            self.ready = False
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/5/3 20:41
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-audio_service.py
+@Description : 语音消息转MP3
+               以前每条语音都要写.silk、.pcm两个临时文件，再通过shell启动一次ffmpeg；
+               这里在内存里用pysilk解码成PCM，优先用lameenc（pip install lameenc）在进程内编码成MP3，
+               没有安装lameenc时才通过管道调用ffmpeg（不写临时文件、不经过shell）；
+               大批量导出时放到常驻的进程池里转码，并统计吞吐量
+"""
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import cpu_count
+from typing import Iterable, Tuple
+
+import pysilk
+
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+from wxManager.log import logger
+
+SAMPLE_RATE = 44100
+BIT_RATE = 64  # kbps，单声道语音足够了
+LAME_QUALITY = 5  # 2最好最慢，7最快
+MAX_PENDING_AUDIOS = 64  # 最多同时有这么多条语音数据在等待转码
+
+
+def get_ffmpeg_path() -> str:
+    """
+    依次查找打包后的资源目录、源码运行时的资源目录和PATH里的ffmpeg
+    :return: 找不到时返回空字符串
+    """
+    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    candidates = [
+        os.path.join(resource_dir, 'ffmpeg.exe'),
+        os.path.join(resource_dir, 'resources', 'ffmpeg.exe'),
+        os.path.join(resource_dir, 'app', 'resources', 'data', 'ffmpeg.exe'),
+        os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe'),
+    ]
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return shutil.which('ffmpeg') or ''
+
+
+def get_encoder_name() -> str:
+    if lameenc:
+        return 'lameenc'
+    return 'ffmpeg' if get_ffmpeg_path() else ''
+
+
+def silk_to_pcm(silk_buffer: bytes, sample_rate=SAMPLE_RATE) -> bytes:
+    """
+    :param silk_buffer: 数据库里的语音数据
+    :param sample_rate: 采样率
+    :return: 16位单声道PCM
+    """
+    return pysilk.decode(silk_buffer, to_wav=False, sample_rate=sample_rate)
+
+
+def pcm_to_mp3(pcm: bytes, sample_rate=SAMPLE_RATE) -> bytes:
+    """
+    :param pcm: 16位单声道PCM
+    :param sample_rate: 采样率
+    :return: MP3数据，没有可用的编码器时返回b''
+    """
+    if not pcm:
+        return b''
+    if lameenc:
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(BIT_RATE)
+        encoder.set_in_sample_rate(sample_rate)
+        encoder.set_channels(1)
+        encoder.set_quality(LAME_QUALITY)
+        return bytes(encoder.encode(pcm) + encoder.flush())
+    ffmpeg_path = get_ffmpeg_path()
+    if not ffmpeg_path:
+        logger.error('没有找到lameenc和ffmpeg，语音无法转换成MP3')
+        return b''
+    cmd = [
+        ffmpeg_path, '-loglevel', 'quiet', '-f', 's16le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+        '-b:a', f'{BIT_RATE}k', '-f', 'mp3', 'pipe:1'
+    ]
+    result = subprocess.run(cmd, input=pcm, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout
+
+
+def transcode(silk_buffer: bytes) -> Tuple[bytes, float]:
+    """
+    :param silk_buffer: 数据库里的语音数据
+    :return: (MP3数据, 语音时长（秒）)
+    """
+    pcm = silk_to_pcm(silk_buffer)
+    return pcm_to_mp3(pcm), len(pcm) / 2 / SAMPLE_RATE
+
+
+def _transcode_file(silk_buffer: bytes, mp3_path: str) -> Tuple[float, int, float]:
+    """
+    进程池里执行的任务
+    :return: (语音时长（秒）, MP3字节数, 转码耗时（秒）)
+    """
+    st = time.perf_counter()
+    mp3, duration = transcode(silk_buffer)
+    if mp3:
+        tmp_path = f'{mp3_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(mp3)
+        os.replace(tmp_path, mp3_path)
+    return duration, len(mp3), time.perf_counter() - st
+
+
+class AudioEngine:
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: 转码进程数，默认CPU核数（最多8个）
+        """
+        self.max_workers = max_workers or min(cpu_count(), 8)
+        self.executor = None
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                'clips': 0,  # 成功转码的语音条数
+                'failed': 0,
+                'silk_bytes': 0,
+                'mp3_bytes': 0,
+                'audio_seconds': 0.0,  # 语音总时长
+                'clip_seconds': 0.0,  # 所有语音转码耗时之和
+                'wall_seconds': 0.0,  # 实际经过的时间
+            }
+
+    def _record(self, silk_size, result):
+        duration, mp3_size, elapsed = result
+        with self.lock:
+            if mp3_size:
+                self.stats['clips'] += 1
+            else:
+                self.stats['failed'] += 1
+            self.stats['silk_bytes'] += silk_size
+            self.stats['mp3_bytes'] += mp3_size
+            self.stats['audio_seconds'] += duration
+            self.stats['clip_seconds'] += elapsed
+
+    def _record_failure(self):
+        logger.error(f'语音转码失败\n{traceback.format_exc()}')
+        with self.lock:
+            self.stats['failed'] += 1
+
+    def transcode_to_file(self, silk_buffer: bytes, mp3_path: str) -> str:
+        """
+        在当前进程里转码一条语音
+        :param silk_buffer: 数据库里的语音数据
+        :param mp3_path: 输出文件
+        :return: mp3_path，失败时返回空字符串
+        """
+        if os.path.exists(mp3_path):
+            return mp3_path
+        if not silk_buffer:
+            return ''
+        os.makedirs(os.path.dirname(mp3_path) or '.', exist_ok=True)
+        st = time.perf_counter()
+        try:
+            result = _transcode_file(silk_buffer, mp3_path)
+        except Exception:
+            self._record_failure()
+            return ''
+        finally:
+            with self.lock:
+                self.stats['wall_seconds'] += time.perf_counter() - st
+        self._record(len(silk_buffer), result)
+        return mp3_path if result[1] else ''
+
+    def transcode_many(self, tasks: Iterable[Tuple[bytes, str, str]], max_pending=MAX_PENDING_AUDIOS) -> int:
+        """
+        在进程池里批量转码，tasks可以是生成器，等待转码的语音超过max_pending条时暂停读取
+        :param tasks: Iterable[
+            (语音数据,
+                输出文件夹,
+                输出文件名（不含扩展名）
+                )]
+        :param max_pending: 最多同时提交给进程池的语音条数
+        :return: 提交转码的语音条数（已经存在的MP3不算）
+        """
+        futures = {}
+        created_dirs = set()
+        count = 0
+
+        def collect(done):
+            for future in done:
+                silk_size = futures.pop(future)
+                try:
+                    self._record(silk_size, future.result())
+                except Exception:
+                    self._record_failure()
+
+        st = time.perf_counter()
+        try:
+            executor = self._get_executor()
+            for silk_buffer, output_dir, filename in tasks:
+                mp3_path = f"{output_dir}/{filename}.mp3"
+                if not silk_buffer or os.path.exists(mp3_path):
+                    continue
+                if output_dir not in created_dirs:
+                    os.makedirs(output_dir, exist_ok=True)
+                    created_dirs.add(output_dir)
+                if len(futures) >= max_pending:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    collect(done)
+                futures[executor.submit(_transcode_file, silk_buffer, mp3_path)] = len(silk_buffer)
+                count += 1
+            collect(list(futures))
+        finally:
+            with self.lock:
+                self.stats['wall_seconds'] += time.perf_counter() - st
+        return count
+
+    def get_stats(self) -> dict:
+        """
+        :return: 累计的转码统计，另外包括
+            encoder: 使用的MP3编码器
+            clips_per_second: 每秒转码条数
+            avg_clip_ms: 平均每条语音的转码耗时（毫秒）
+            realtime_factor: 转码速度是实时播放速度的多少倍
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        wall_seconds = stats['wall_seconds']
+        stats['encoder'] = get_encoder_name()
+        stats['clips_per_second'] = stats['clips'] / wall_seconds if wall_seconds else 0
+        stats['avg_clip_ms'] = stats['clip_seconds'] / stats['clips'] * 1000 if stats['clips'] else 0
+        stats['realtime_factor'] = stats['audio_seconds'] / wall_seconds if wall_seconds else 0
+        return stats
+
+
+audio_engine = AudioEngine()
+
+if __name__ == '__main__':
+    pass
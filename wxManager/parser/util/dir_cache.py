@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/30 22:05
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-dir_cache.py
+@Description : 目录列表缓存
+               解析图片、视频消息时要逐个试探几个候选文件名是否存在，wx_dir在网络盘上时每次os.path.exists都很慢；
+               这里第一次访问某个目录时用os.scandir读出整个目录的文件名，之后的判断都是集合查询；
+               判断结果为不存在时再看一下目录的修改时间，目录变了（微信又写入了新文件）就重新读取
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable
+
+
+class DirListingCache:
+    def __init__(self, max_dirs=4096):
+        """
+        :param max_dirs: 最多缓存的目录数，超过之后淘汰最久没用的
+        """
+        self.max_dirs = max_dirs
+        self.listings = OrderedDict()  # 目录 -> (目录修改时间, frozenset(文件名))，目录不存在时为(None, 空集合)
+        self.lock = threading.Lock()
+        self.scans = 0  # scandir次数
+        self.checks = 0  # 没找到文件时检查目录修改时间的次数
+        self.rescans = 0  # 目录变化后重新读取的次数
+        self.lookups = 0  # 文件是否存在的判断次数（不缓存时每次都是一次stat）
+
+    @staticmethod
+    def _key(path) -> str:
+        # Windows下文件名不区分大小写
+        return os.path.normcase(path)
+
+    @staticmethod
+    def _mtime(dir_path):
+        try:
+            return os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _scan(self, dir_path, key) -> frozenset:
+        mtime = self._mtime(dir_path)
+        try:
+            with os.scandir(dir_path) as it:
+                names = frozenset(self._key(entry.name) for entry in it)
+        except OSError:
+            names = frozenset()
+        with self.lock:
+            self.scans += 1
+            self.listings[key] = (mtime, names)
+            self.listings.move_to_end(key)
+            if len(self.listings) > self.max_dirs:
+                self.listings.popitem(last=False)
+        return names
+
+    def list_dir(self, dir_path) -> frozenset:
+        key = self._key(dir_path)
+        with self.lock:
+            entry = self.listings.get(key)
+            if entry is not None:
+                self.listings.move_to_end(key)
+                return entry[1]
+        return self._scan(dir_path, key)
+
+    def _refresh(self, dir_path) -> frozenset | None:
+        """
+        没找到文件时调用，目录修改时间变化（或者目录新建出来了）就重新读取
+        :return: 新的文件名集合，目录没变化时返回None
+        """
+        key = self._key(dir_path)
+        with self.lock:
+            self.checks += 1
+            entry = self.listings.get(key)
+        if entry is not None and entry[0] == self._mtime(dir_path):
+            return None
+        with self.lock:
+            self.rescans += 1
+        return self._scan(dir_path, key)
+
+    def exists(self, path) -> bool:
+        """代替os.path.exists"""
+        dir_path, name = os.path.split(path)
+        names = self.list_dir(dir_path)
+        with self.lock:
+            self.lookups += 1
+        if self._key(name) in names:
+            return True
+        names = self._refresh(dir_path)
+        return names is not None and self._key(name) in names
+
+    def first_existing(self, dir_path, names: Iterable[str]) -> str | None:
+        """
+        按顺序返回第一个存在的文件名
+        :param dir_path: 目录
+        :param names: 候选文件名
+        :return: 文件名，都不存在时返回None
+        """
+        names = list(names)
+        listing = self.list_dir(dir_path)
+        with self.lock:
+            self.lookups += len(names)
+        for listing_ in (listing, self._refresh(dir_path)):
+            if listing_ is None:
+                break
+            for name in names:
+                if self._key(name) in listing_:
+                    return name
+        return None
+
+    def invalidate(self, dir_path=''):
+        """
+        微信又写入了新文件时调用
+        :param dir_path: 为空时清空所有目录
+        """
+        with self.lock:
+            if dir_path:
+                self.listings.pop(self._key(dir_path), None)
+            else:
+                self.listings.clear()
+
+    def get_stats(self) -> dict:
+        """
+        :return: {'dirs': 缓存的目录数, 'scans': scandir次数（包括重新读取）, 'checks': 检查目录修改时间的次数,
+                  'rescans': 目录变化后重新读取的次数, 'lookups': 判断次数, 'stats_avoided': 省掉的stat调用数}
+        """
+        with self.lock:
+            return {
+                'dirs': len(self.listings),
+                'scans': self.scans,
+                'checks': self.checks,
+                'rescans': self.rescans,
+                'lookups': self.lookups,
+                'stats_avoided': max(self.lookups - self.scans - self.checks, 0),
+            }
+
+
+dir_cache = DirListingCache()
+
+if __name__ == '__main__':
+    pass
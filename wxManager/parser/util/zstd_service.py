@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2025/4/23 21:48
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-zstd_service.py
+@Description : 微信4.0消息内容（message_content、compress_content）的zstd解压
+               每个线程只创建一个解压上下文反复使用，不再每条消息都新建ZstdDecompressor；
+               支持整批解压，也可以设置字典（如果以后发现微信的数据是用字典压缩的）
+"""
+import threading
+import time
+from typing import Iterable, List
+
+import zstandard as zstd
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+_local = threading.local()
+_dict_data = None  # zstd.ZstdCompressionDict
+_dict_generation = 0  # 字典变化之后各线程重新创建解压上下文
+
+
+def set_dictionary(dict_bytes: bytes | None):
+    """
+    设置解压字典，None表示不使用字典
+    :param dict_bytes: zstd字典文件内容
+    """
+    global _dict_data, _dict_generation
+    _dict_data = zstd.ZstdCompressionDict(dict_bytes) if dict_bytes else None
+    _dict_generation += 1
+
+
+def train_dictionary(samples: Iterable[bytes], dict_size=112640) -> bytes:
+    """
+    用解压后的消息内容训练字典，用于验证微信的数据能否从字典中获益
+    :param samples: 样本
+    :param dict_size: 字典大小
+    :return: 字典文件内容
+    """
+    return zstd.train_dictionary(dict_size, list(samples)).as_bytes()
+
+
+def get_decompressor() -> zstd.ZstdDecompressor:
+    """当前线程的解压上下文"""
+    dctx = getattr(_local, 'dctx', None)
+    if dctx is None or _local.generation != _dict_generation:
+        dctx = zstd.ZstdDecompressor(dict_data=_dict_data) if _dict_data else zstd.ZstdDecompressor()
+        _local.dctx = dctx
+        _local.generation = _dict_generation
+    return dctx
+
+
+def decompress(data: bytes) -> bytes:
+    dctx = get_decompressor()
+    try:
+        return dctx.decompress(data)
+    except zstd.ZstdError:
+        # 帧头里没有记录原始长度时只能流式解压
+        return dctx.decompressobj().decompress(data)
+
+
+def decompress_text(data: bytes) -> str:
+    """解压并解码成字符串，失败返回空字符串"""
+    try:
+        return decompress(data).strip(b'\x00').strip().decode('utf-8').strip()
+    except:
+        return ''
+
+
+def decompress_batch(blobs: Iterable[bytes | str | None]) -> List[bytes | str | None]:
+    """
+    整批解压，不是zstd数据的（字符串、None、未压缩的bytes）原样返回
+    :param blobs: 一批查询结果里的message_content/compress_content
+    """
+    dctx = get_decompressor()
+    result = []
+    for blob in blobs:
+        if isinstance(blob, bytes) and blob[:4] == ZSTD_MAGIC:
+            try:
+                blob = dctx.decompress(blob)
+            except zstd.ZstdError:
+                blob = dctx.decompressobj().decompress(blob)
+        result.append(blob)
+    return result
+
+
+def benchmark(blobs: List[bytes], repeat=3) -> dict:
+    """
+    对比每次新建解压对象、线程复用解压对象、整批解压三种方式的耗时
+    :param blobs: zstd压缩的数据
+    :param repeat: 每种方式重复次数，取最快的一次
+    :return: {'new_context': 秒, 'thread_local': 秒, 'batch': 秒, 'count': 条数}
+    """
+    blobs = [blob for blob in blobs if isinstance(blob, bytes) and blob[:4] == ZSTD_MAGIC]
+
+    def new_context():
+        for blob in blobs:
+            zstd.ZstdDecompressor().decompress(blob)
+
+    def thread_local():
+        for blob in blobs:
+            decompress(blob)
+
+    def batch():
+        decompress_batch(blobs)
+
+    result = {'count': len(blobs)}
+    for name, func in (('new_context', new_context), ('thread_local', thread_local), ('batch', batch)):
+        timings = []
+        for _ in range(repeat):
+            st = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - st)
+        result[name] = min(timings)
+    return result
+
+
+if __name__ == '__main__':
+    pass
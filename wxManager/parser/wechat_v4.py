@@ -16,7 +16,6 @@ from collections import OrderedDict
 from abc import ABC, abstractmethod
 
 import xmltodict
-import zstandard as zstd
 from google.protobuf.json_format import MessageToDict
 
 from wxManager.model.message import VoipMessage, BusinessCardMessage, MergedMessage, WeChatVideoMessage, \
@@ -24,6 +23,8 @@ from wxManager.model.message import VoipMessage, BusinessCardMessage, MergedMess
 from wxManager.parser.link_parser import parser_link, parser_voip, parser_applet, parser_business, \
     parser_merged_messages, parser_wechat_video, parser_position, parser_reply, parser_transfer, parser_red_envelop, \
     parser_file, parser_favorite_note, parser_pat
+from wxManager.parser.util.dir_cache import dir_cache
+from wxManager.parser.util.zstd_service import decompress_text
 from wxManager.parser.util.protocbuf import packed_info_data_pb2, packed_info_data_merged_pb2, packed_info_data_img_pb2, \
     packed_info_data_img2_pb2
 from .audio_parser import parser_audio
@@ -42,12 +43,8 @@ source,message_content,compress_content"
 
 
 def decompress(data):
-    try:
-        dctx = zstd.ZstdDecompressor()  # 创建解压对象
-        x = dctx.decompress(data).strip(b'\x00').strip()
-        return x.decode('utf-8').strip()
-    except:
-        return ''
+    # 复用线程内的解压对象
+    return decompress_text(data)
 
 
 class LimitedDict:
@@ -395,18 +392,16 @@ class VideoMessageFactory(MessageFactory, Singleton):
             # 微信4.0.3正式版增加
             video_dir = os.path.join('msg', 'video', month)
             video_path = os.path.join(video_dir, f'{filename}_raw.mp4')
-            if os.path.exists(os.path.join(Me().wx_dir, video_path)):
+            if dir_cache.exists(os.path.join(Me().wx_dir, video_path)):
                 msg.path = video_path
                 msg.thumb_path = os.path.join(video_dir, f'{filename}.jpg')
             else:
                 msg.path = os.path.join(video_dir, f'{filename}.mp4')
                 msg.thumb_path = os.path.join(video_dir, f'{filename}.jpg')
         else:
-            msg.path = manager.hardlink_db.get_video(msg.raw_md5, False)
-            msg.thumb_path = manager.hardlink_db.get_video(msg.raw_md5, True)
+            msg.path, msg.thumb_path = manager.hardlink_db.get_video_paths(msg.raw_md5)
             if not msg.path:
-                msg.path = manager.hardlink_db.get_video(msg.md5, False)
-                msg.thumb_path = manager.hardlink_db.get_video(msg.md5, True)
+                msg.path, msg.thumb_path = manager.hardlink_db.get_video_paths(msg.md5)
             # logger.error(f'{msg.path} {msg.thumb_path}')
 
         self.add_message(msg)